@@ -1,9 +1,15 @@
 import django.core.files.uploadedfile as dcfu
 import django.test as dt
 import django.contrib.auth.models as dcam
+import fragments.utils as fu
+import tilesets.file_handles as tfh
 import tilesets.models as tm
+import cooler
 import json
 import numpy as np
+import os.path as op
+import pandas as pd
+import tempfile
 
 from urllib.parse import urlencode
 
@@ -344,3 +350,71 @@ class FragmentsTest(dt.TestCase):
                 np.rint(max1 * 10000000) / 10000000,
                 np.rint(percentile * 10000000) / 10000000
             )
+
+
+class CollectFragsTest(dt.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = op.join(self.tmpdir.name, 'a.mcool')
+        base_path = op.join(self.tmpdir.name, 'a.cool')
+
+        rng = np.random.RandomState(0)
+        chromsizes = pd.Series({'chr1': 12345, 'chr2': 8001})
+        bins = cooler.binnify(chromsizes, 100)
+        bins['weight'] = rng.uniform(0.5, 2, len(bins))
+        bins.loc[::7, 'weight'] = np.nan
+
+        bin1 = rng.randint(0, len(bins), 5000)
+        bin2 = rng.randint(0, len(bins), 5000)
+        pixels = pd.DataFrame({
+            'bin1_id': np.minimum(bin1, bin2),
+            'bin2_id': np.maximum(bin1, bin2),
+            'count': rng.randint(1, 10, len(bin1)),
+        }).groupby(['bin1_id', 'bin2_id'], as_index=False).sum()
+
+        cooler.create_cooler(base_path, bins, pixels)
+        cooler.zoomify_cooler(base_path, self.path, [100, 200], 10 ** 6)
+
+    def tearDown(self):
+        tfh.pool.close(self.path)
+        self.tmpdir.cleanup()
+
+    def test_collect_frags(self):
+        # overlapping loci, loci at the start of a chromosome and
+        # between chromosomes
+        loci = [
+            ['chr1', 1000, 3000, 'chr1', 1000, 3000, 0, 0],
+            ['chr1', 2000, 4000, 'chr1', 2500, 5000, 0, 0],
+            ['chr1', 0, 500, 'chr1', 0, 500, 8, 0],
+            ['chr1', 11000, 12000, 'chr1', 11000, 12300, 0, 0],
+            ['chr1', 5000, 6000, 'chr2', 1000, 2000, 0, 0],
+            ['chr2', 4000, 7000, 'chr2', 4000, 7000, 20, 0],
+        ]
+
+        for balanced in [True, False]:
+            for ignore_diags in [0, 2]:
+                with tfh.borrow(self.path):
+                    state = fu.get_cooler_state(self.path, 100)
+                    resolution = state.resolution
+                    chromsizes = np.ceil(
+                        state.chromsizes / resolution).astype(int)
+                    offsets = np.cumsum(chromsizes) - chromsizes
+
+                    kwargs = {
+                        'padding': 10,
+                        'balanced': balanced,
+                        'ignore_diags': ignore_diags,
+                    }
+
+                    frags = fu.collect_frags(
+                        state.cooler, loci, 12, resolution, offsets,
+                        state=state, **kwargs)
+
+                    for locus, frag in zip(loci, frags):
+                        expected = fu.get_frag(
+                            state.cooler, resolution, offsets, *locus[:6],
+                            width=locus[6] or 12, **kwargs)
+
+                        self.assertEqual(frag.shape, expected.shape)
+                        self.assertTrue(
+                            np.array_equal(frag, expected, equal_nan=True))
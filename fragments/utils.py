@@ -3,11 +3,9 @@ from __future__ import (
 )
 
 import cooler
-import h5py
 import logging
 import numpy as np
 import pandas as pd
-import sqlite3
 import requests
 import math
 
@@ -18,13 +16,17 @@ from sklearn.cluster import KMeans
 from scipy.ndimage.interpolation import zoom
 from cachecontrol import CacheControl
 from zipfile import ZipFile
+from contextlib import ExitStack, contextmanager
 
 from django.http import HttpResponse
 
 from clodius.tiles.geo import get_tile_pos_from_lng_lat
 
 import higlass_server.settings as hss
+import tilesets.cooler_state as tco
+import tilesets.file_handles as tfh
 
+from higlass_server.cache import BatchedCache
 from higlass_server.utils import getRdb
 from fragments.exceptions import SnippetTooLarge
 
@@ -32,6 +34,7 @@ import zlib
 import struct
 
 rdb = getRdb()
+cache = BatchedCache(rdb)
 
 logger = logging.getLogger(__name__)
 
@@ -231,10 +234,19 @@ def rel_2_abs_loci(loci, chr_info):
     return list(map(absolutize_tuple, loci))
 
 
-def get_cooler(f, zoomout_level=None):
-    c = None
+def cooler_root(f, zoomout_level=None):
+    '''
+    The path of the cooler to read snippets from in a cooler file
 
-    try:
+    Args:
+        f: The open cooler file
+        zoomout_level: The resolution for cooler v2 files, the number of
+            zoom levels above the highest one for v1 files
+
+    Returns:
+        The path of the cooler in the file
+    '''
+    if 'resolutions' in f:
         # Cooler v2
         # In this case `zoomout_level` is the resolution
         # See fragments/views.py line 431
@@ -245,40 +257,68 @@ def get_cooler(f, zoomout_level=None):
         # Get the closest zoomlevel
         resolution = resolutions[np.argsort([abs(r - resolution) for r in resolutions])[0]]
 
-        return cooler.Cooler(f['resolutions/{}'.format(resolution)])
-    except:
-        # We're not logging this exception as the user might just try to open
-        # a cooler v1 file
-        pass
-
+        return 'resolutions/{}'.format(resolution)
 
     try:
         # v1
-        zoomout_level = 0 if zoomout_level is None else zoomout_level
         zoom_levels = np.array(list(f.keys()), dtype=int)
+    except ValueError:
+        # a single cooler
+        return '/'
 
-        max_zoom = np.max(zoom_levels)
-        min_zoom = np.min(zoom_levels)
+    zoomout_level = 0 if zoomout_level is None else zoomout_level
 
-        zoom_level = max_zoom - max(zoomout_level, 0)
+    max_zoom = np.max(zoom_levels)
+    min_zoom = np.min(zoom_levels)
 
-        if (zoom_level >= min_zoom and zoom_level <= max_zoom):
-            c = cooler.Cooler(f[str(zoom_level)])
-        else:
-            c = cooler.Cooler(f['0'])
+    zoom_level = max_zoom - max(zoomout_level, 0)
 
-        return c
-    except Exception as e:
-        logger.exception(e)
+    if (zoom_level >= min_zoom and zoom_level <= max_zoom):
+        return str(zoom_level)
+
+    return '0'
+
+
+def get_cooler(f, zoomout_level=None):
+    c = None
 
     try:
-        c = cooler.Cooler(f)
+        c = cooler.Cooler(f[cooler_root(f, zoomout_level)])
     except Exception as e:
         logger.exception(e)
 
     return c
 
 
+def get_cooler_state(cooler_file, zoomout_level=None):
+    '''
+    The warm state of the cooler to read snippets from in a cooler file
+    (see `get_cooler` and `tilesets.cooler_state`). The file should be
+    borrowed from the handle pool while its pixels are read.
+    '''
+    root = tfh.state(
+        cooler_file,
+        'cooler-root:{}'.format(zoomout_level),
+        lambda f: cooler_root(f, zoomout_level)
+    )
+
+    return tco.get_state(cooler_file, root)
+
+
+@contextmanager
+def borrow_cooler_state(c, state=None):
+    '''
+    The warm state of a cooler, looked up by its file name and root and
+    with the file borrowed from the handle pool unless it's given
+    '''
+    if state is not None:
+        yield state
+        return
+
+    with tfh.borrow(c.filename):
+        yield tco.get_state(c.filename, c.root)
+
+
 def get_frag_by_loc_from_cool(
     cooler_file,
     loci,
@@ -291,12 +331,13 @@ def get_frag_by_loc_from_cool(
     no_normalize=False,
     aggregate=False,
 ):
-    with h5py.File(cooler_file, 'r') as f:
-        c = get_cooler(f, zoomout_level)
+    with tfh.borrow(cooler_file):
+        state = get_cooler_state(cooler_file, zoomout_level)
+        c = state.cooler
 
         # Calculate the offsets once
-        resolution = c.info['bin-size']
-        chromsizes = np.ceil(c.chromsizes / resolution).astype(int)
+        resolution = state.resolution
+        chromsizes = np.ceil(state.chromsizes / resolution).astype(int)
         offsets = np.cumsum(chromsizes) - chromsizes
 
         fragments = collect_frags(
@@ -310,7 +351,8 @@ def get_frag_by_loc_from_cool(
             percentile=percentile,
             ignore_diags=ignore_diags,
             no_normalize=no_normalize,
-            aggregate=aggregate
+            aggregate=aggregate,
+            state=state
         )
 
     return fragments
@@ -367,16 +409,24 @@ def get_scale_frags_to_same_size(frags, loci_ids, out_size=-1, no_cache=False):
     else:
         out = np.zeros([len(frags), dim_x, dim_y])
 
+    ids = [
+        loci_ids[i] + '.' + '.'.join(map(str, out.shape[1:]))
+        for i in range(len(frags))
+    ]
+
+    cached_frags = [None] * len(frags)
+    frags_to_cache = []
+
+    if not no_cache:
+        cached_frags = cache.get_many(['im_snip_ds_%s' % id for id in ids])
+
     for i, frag in enumerate(frags):
-        id = loci_ids[i] + '.' + '.'.join(map(str, out.shape[1:]))
+        id = ids[i]
 
-        if not no_cache:
-            frag_ds = None
+        if cached_frags[i] is not None:
             try:
-                frag_ds = np.load(BytesIO(rdb.get('im_snip_ds_%s' % id)))
-                if frag_ds is not None:
-                    out[i] = frag_ds
-                    continue
+                out[i] = np.load(BytesIO(cached_frags[i]))
+                continue
             except:
                 pass
 
@@ -402,10 +452,12 @@ def get_scale_frags_to_same_size(frags, loci_ids, out_size=-1, no_cache=False):
         if not no_cache:
             with BytesIO() as b:
                 np.save(b, frag)
-                rdb.set('im_snip_ds_%s' % id, b.getvalue(), 60 * 30)
+                frags_to_cache.append(('im_snip_ds_%s' % id, b.getvalue()))
 
         out[i] = frag
 
+    cache.set_many(frags_to_cache, 60 * 30)
+
     return out, largest_frag_idx, smallest_frag_idx
 
 
@@ -647,89 +699,93 @@ def get_frag_by_loc_from_imtiles(
 
     got_info = False
 
-    for locus in loci:
-        id = locus[-1]
+    cached_snips = [None] * len(loci)
+    snips_to_cache = []
 
-        if not no_cache:
-            im_snip = None
-            try:
-                im_snip = np.load(BytesIO(rdb.get('im_snip_%s' % id)))
-                if im_snip is not None:
-                    ims.append(im_snip)
-                    continue
-            except:
-                pass
+    if not no_cache:
+        cached_snips = cache.get_many(['im_snip_%s' % l[-1] for l in loci])
 
-        if not got_info:
-            db = sqlite3.connect(imtiles_file)
-            info = db.execute('SELECT * FROM tileset_info').fetchone()
+    with ExitStack() as handles:
+        for locus, cached_snip in zip(loci, cached_snips):
+            id = locus[-1]
 
-            max_zoom = info[6]
-            max_width = info[8]
-            max_height = info[9]
-
-            div = 2 ** (max_zoom - zoom_level)
-            width = max_width / div
-            height = max_height / div
-
-            got_info = True
-
-        start1 = round(locus[0] / div)
-        end1 = round(locus[1] / div)
-        start2 = round(locus[2] / div)
-        end2 = round(locus[3] / div)
-
-        if not is_within(start1, end1, start2, end2, width, height):
-            ims.append(None)
-            continue
-
-        # Get tile ids
-        tile_start1_id = start1 // tile_size
-        tile_end1_id = end1 // tile_size
-        tile_start2_id = start2 // tile_size
-        tile_end2_id = end2 // tile_size
-
-        tiles_x_range = range(tile_start1_id, tile_end1_id + 1)
-        tiles_y_range = range(tile_start2_id, tile_end2_id + 1)
-
-        # Make sure that no more than 6 standard tiles (256px) are loaded.
-        if tile_size * len(tiles_x_range) > hss.SNIPPET_IMT_MAX_DATA_DIM:
-            raise SnippetTooLarge()
-        if tile_size * len(tiles_y_range) > hss.SNIPPET_IMT_MAX_DATA_DIM:
-            raise SnippetTooLarge()
-
-        # Extract image tiles
-        tiles = []
-        for y in tiles_y_range:
-            for x in tiles_x_range:
-                tiles.append(Image.open(BytesIO(db.execute(
-                    'SELECT image FROM tiles WHERE z=? AND y=? AND x=?',
-                    (zoom_level, y, x)
-                ).fetchone()[0])))
-
-        im_snip = get_frag_from_image_tiles(
-            tiles,
-            tile_size,
-            tiles_x_range,
-            tiles_y_range,
-            tile_start1_id,
-            tile_start2_id,
-            start1,
-            end1,
-            start2,
-            end2
-        )
+            if cached_snip is not None:
+                try:
+                    ims.append(np.load(BytesIO(cached_snip)))
+                    continue
+                except:
+                    pass
+
+            if not got_info:
+                db = handles.enter_context(
+                    tfh.borrow(imtiles_file, 'sqlite'))
+                info = db.execute('SELECT * FROM tileset_info').fetchone()
+
+                max_zoom = info[6]
+                max_width = info[8]
+                max_height = info[9]
+
+                div = 2 ** (max_zoom - zoom_level)
+                width = max_width / div
+                height = max_height / div
+
+                got_info = True
+
+            start1 = round(locus[0] / div)
+            end1 = round(locus[1] / div)
+            start2 = round(locus[2] / div)
+            end2 = round(locus[3] / div)
+
+            if not is_within(start1, end1, start2, end2, width, height):
+                ims.append(None)
+                continue
+
+            # Get tile ids
+            tile_start1_id = start1 // tile_size
+            tile_end1_id = end1 // tile_size
+            tile_start2_id = start2 // tile_size
+            tile_end2_id = end2 // tile_size
+
+            tiles_x_range = range(tile_start1_id, tile_end1_id + 1)
+            tiles_y_range = range(tile_start2_id, tile_end2_id + 1)
+
+            # Make sure that no more than 6 standard tiles (256px) are loaded.
+            if tile_size * len(tiles_x_range) > hss.SNIPPET_IMT_MAX_DATA_DIM:
+                raise SnippetTooLarge()
+            if tile_size * len(tiles_y_range) > hss.SNIPPET_IMT_MAX_DATA_DIM:
+                raise SnippetTooLarge()
+
+            # Extract image tiles
+            tiles = []
+            for y in tiles_y_range:
+                for x in tiles_x_range:
+                    tiles.append(Image.open(BytesIO(db.execute(
+                        'SELECT image FROM tiles WHERE z=? AND y=? AND x=?',
+                        (zoom_level, y, x)
+                    ).fetchone()[0])))
+
+            im_snip = get_frag_from_image_tiles(
+                tiles,
+                tile_size,
+                tiles_x_range,
+                tiles_y_range,
+                tile_start1_id,
+                tile_start2_id,
+                start1,
+                end1,
+                start2,
+                end2
+            )
 
-        # Cache for 30 min
-        if not no_cache:
-            with BytesIO() as b:
-                np.save(b, im_snip)
-                rdb.set('im_snip_%s' % id, b.getvalue(), 60 * 30)
+            if not no_cache:
+                with BytesIO() as b:
+                    np.save(b, im_snip)
+                    snips_to_cache.append(('im_snip_%s' % id, b.getvalue()))
 
-        ims.append(im_snip)
+            ims.append(im_snip)
 
-    if db:
-        db.close()
+    # Cache for 30 min
+    cache.set_many(snips_to_cache, 60 * 30)
 
     return ims
 
@@ -753,16 +809,19 @@ def get_frag_by_loc_from_osm(
 
     s = CacheControl(requests.Session())
 
-    for locus in loci:
+    cached_snips = [None] * len(loci)
+    snips_to_cache = []
+
+    if not no_cache:
+        cached_snips = cache.get_many(['osm_snip_%s' % l[-1] for l in loci])
+
+    for locus, cached_snip in zip(loci, cached_snips):
         id = locus[-1]
 
-        if not no_cache:
-            osm_snip = None
+        if cached_snip is not None:
             try:
-                osm_snip = np.load(BytesIO(rdb.get('osm_snip_%s' % id)))
-                if osm_snip is not None:
-                    ims.append(osm_snip)
-                    continue
+                ims.append(np.load(BytesIO(cached_snip)))
+                continue
             except:
                 pass
 
@@ -851,10 +910,12 @@ def get_frag_by_loc_from_osm(
         if not no_cache:
             with BytesIO() as b:
                 np.save(b, osm_snip)
-                rdb.set('osm_snip_%s' % id, b.getvalue(), 60 * 30)
+                snips_to_cache.append(('osm_snip_%s' % id, b.getvalue()))
 
         ims.append(osm_snip)
 
+    cache.set_many(snips_to_cache, 60 * 30)
+
     return ims
 
 
@@ -930,7 +991,7 @@ def calc_measure_sharpness(matrix):
 
 
 def get_bin_size(cooler_file, zoomout_level=-1):
-    with h5py.File(cooler_file, 'r') as f:
+    with tfh.borrow(cooler_file) as f:
         c = get_cooler(f, zoomout_level)
 
         return c.util.get_binsize()
@@ -952,19 +1013,44 @@ def collect_frags(
     percentile=100.0,
     ignore_diags=0,
     no_normalize=False,
-    aggregate=False
+    aggregate=False,
+    state=None
 ):
-    fragments = []
+    '''
+    Retrieve the matrix fragments of many loci. Same as `get_frag` for
+    every locus but the pixels of all of them are read together, with
+    every row of the pixel table read once (see
+    `tilesets.cooler_state.fetch_pixels_many`).
+    '''
+    frags_bins = []
+    widths = []
 
     for locus in loci:
         last_loc = len(locus) - 2
-        fragments.append(get_frag(
-            c,
+        width = locus[last_loc] if locus[last_loc] else dim
+
+        frags_bins.append(get_frag_bins(
             resolution,
             offsets,
             *locus[:6],
-            width=locus[last_loc] if locus[last_loc] else dim,
-            padding=padding,
+            width=width,
+            padding=padding
+        ))
+        widths.append(width)
+
+    with borrow_cooler_state(c, state) as state:
+        frags_pixels = tco.fetch_pixels_many(
+            state, [frag_window(frag_bins) for frag_bins in frags_bins]
+        )
+
+    fragments = []
+
+    for frag_bins, pixels, width in zip(frags_bins, frags_pixels, widths):
+        fragments.append(make_frag(
+            state,
+            pixels,
+            frag_bins,
+            width=width,
             balanced=balanced,
             percentile=percentile,
             ignore_diags=ignore_diags,
@@ -993,7 +1079,7 @@ def get_chroms(abs_pos, chr_info=None, cooler_file=None, zoomout_level=-1):
     chroms = np.zeros((abs_pos.shape[0], 2), dtype=object)
 
     if chr_info is None:
-        with h5py.File(cooler_file, 'r') as f:
+        with tfh.borrow(cooler_file) as f:
             c = get_cooler(f, zoomout_level)
             chr_info = get_chrom_names_cumul_len(c)
 
@@ -1060,7 +1146,8 @@ def get_frag(
     balanced: bool = True,
     percentile: float = 100.0,
     ignore_diags: int = 0,
-    no_normalize: bool = False
+    no_normalize: bool = False,
+    state: tco.CoolerState = None
 ) -> np.ndarray:
     """
     Retrieves a matrix fragment.
@@ -1104,12 +1191,70 @@ def get_frag(
         no_normalize:
             If `true` the returned matrix is not normalized.
             Defaults to `False`.
+        state:
+            The warm state of the cooler (see `tilesets.cooler_state`). If
+            `None` it's looked up by the file name and root of `c`.
 
     Returns:
 
     """
 
-    if height is -1:
+    if height == -1:
+        height = width
+
+    frag_bins = get_frag_bins(
+        resolution,
+        offsets,
+        chrom1, start1, end1,
+        chrom2, start2, end2,
+        width=width,
+        height=height,
+        padding=padding
+    )
+
+    # Get the data
+    with borrow_cooler_state(c, state) as state:
+        pixels = tco.fetch_pixels(state, *frag_window(frag_bins))
+
+    return make_frag(
+        state,
+        pixels,
+        frag_bins,
+        width=width,
+        height=height,
+        balanced=balanced,
+        percentile=percentile,
+        ignore_diags=ignore_diags,
+        no_normalize=no_normalize
+    )
+
+
+def get_frag_bins(
+    resolution: int,
+    offsets: pd.core.series.Series,
+    chrom1: str,
+    start1: int,
+    end1: int,
+    chrom2: str,
+    start2: int,
+    end2: int,
+    width: int = 22,
+    height: int = -1,
+    padding: int = 10
+) -> tuple:
+    """
+    Get the bins of a matrix fragment including its padding.
+
+    Args:
+        See `get_frag`.
+
+    Returns:
+        The first and end bins along both axes and the dimensions of the
+        fragment in bins: `(start_bin1, end_bin1, start_bin2, end_bin2,
+        abs_dim1, abs_dim2)`. The first bins can be negative.
+    """
+
+    if height == -1:
         height = width
 
     # Restrict padding to be [0, 100]%
@@ -1175,38 +1320,80 @@ def get_frag(
     if abs_dim1 > hss.SNIPPET_MAT_MAX_DATA_DIM: raise SnippetTooLarge()
     if abs_dim2 > hss.SNIPPET_MAT_MAX_DATA_DIM: raise SnippetTooLarge()
 
+    return start_bin1, end_bin1, start_bin2, end_bin2, abs_dim1, abs_dim2
+
+
+def frag_window(frag_bins: tuple) -> tuple:
+    """
+    Get the range of bins to read the pixels of a fragment from.
+    """
+
+    start_bin1, end_bin1, start_bin2, end_bin2 = frag_bins[:4]
+
     # Finally, adjust to negative values.
     # Since relative bin IDs are adjusted by the start this will lead to a
     # white offset.
     real_start_bin1 = start_bin1 if start_bin1 >= 0 else 0
     real_start_bin2 = start_bin2 if start_bin2 >= 0 else 0
 
-    # Get the data
-    data = c.matrix(
-        as_pixels=True, balance=False, max_chunk=np.inf
-    )[real_start_bin1:end_bin1, real_start_bin2:end_bin2]
+    return real_start_bin1, end_bin1, real_start_bin2, end_bin2
 
-    # Annotate pixels for balancing
-    bins = c.bins(convert_enum=False)[['weight']]
-    data = cooler.annotate(data, bins, replace=False)
+
+def make_frag(
+    state: tco.CoolerState,
+    pixels: tuple,
+    frag_bins: tuple,
+    width: int = 22,
+    height: int = -1,
+    balanced: bool = True,
+    percentile: float = 100.0,
+    ignore_diags: int = 0,
+    no_normalize: bool = False
+) -> np.ndarray:
+    """
+    Assemble a matrix fragment from its pixels.
+
+    Args:
+        state:
+            The warm state of the cooler (see `tilesets.cooler_state`).
+        pixels:
+            The bin1 ids, bin2 ids and counts of the pixels in the
+            window of the fragment (see `frag_window`).
+        frag_bins:
+            The bins of the fragment (see `get_frag_bins`).
+
+        See `get_frag` for the other arguments.
+
+    Returns:
+        The fragment (see `get_frag`).
+    """
+
+    if height == -1:
+        height = width
+
+    start_bin1, _, start_bin2, _, abs_dim1, abs_dim2 = frag_bins
+    bin1_ids, bin2_ids, counts = pixels
 
     # Calculate relative bin IDs
-    rel_bin1 = np.add(data['bin1_id'].values, -start_bin1)
-    rel_bin2 = np.add(data['bin2_id'].values, -start_bin2)
+    rel_bin1 = np.add(bin1_ids, -start_bin1)
+    rel_bin2 = np.add(bin2_ids, -start_bin2)
 
     # Balance counts
     if balanced:
-        values = data['count'].values.astype(np.float32)
-        values *= data['weight1'].values * data['weight2'].values
+        if state.weights is None:
+            raise ValueError('No column \'bins/weight\' found')
+
+        values = counts.astype(np.float32)
+        values *= state.weights[bin1_ids] * state.weights[bin2_ids]
     else:
-        values = data['count'].values
+        values = counts
 
     # Get pixel IDs for the upper triangle
     idx1 = np.add(np.multiply(rel_bin1, abs_dim1), rel_bin2)
 
     # Mirror matrix
-    idx2_1 = np.add(data['bin2_id'].values, -start_bin1)
-    idx2_2 = np.add(data['bin1_id'].values, -start_bin2)
+    idx2_1 = np.add(bin2_ids, -start_bin1)
+    idx2_2 = np.add(bin1_ids, -start_bin2)
     idx2 = np.add(np.multiply(idx2_1, abs_dim1), idx2_2)
     validBins = np.where((idx2_1 < abs_dim1) & (idx2_2 >= 0))
 
@@ -1215,7 +1402,7 @@ def get_frag(
     if ignore_diags > 0:
         try:
             diags_start_idx = np.min(
-                np.where(data['bin1_id'].values == data['bin2_id'].values)
+                np.where(bin1_ids == bin2_ids)
             )
             diags_start_row = (
                 rel_bin1[diags_start_idx] - rel_bin2[diags_start_idx]
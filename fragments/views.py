@@ -12,6 +12,8 @@ except:
     import pickle
 
 import higlass_server.settings as hss
+import tilesets.file_handles as tfh
+import tilesets.resolver as tsr
 
 from rest_framework.authentication import BasicAuthentication
 from .drf_disable_csrf import CsrfExemptSessionAuthentication
@@ -19,7 +21,6 @@ from io import BytesIO
 from os import path
 from django.http import HttpResponse, JsonResponse
 from rest_framework.decorators import api_view, authentication_classes
-from tilesets.models import Tileset
 from fragments.utils import (
     calc_measure_dtd,
     calc_measure_size,
@@ -38,14 +39,19 @@ from fragments.utils import (
     grey_to_rgb,
     blob_to_zip
 )
+from higlass_server.cache import BatchedCache, SingleFlight
 from higlass_server.utils import getRdb
 from fragments.exceptions import SnippetTooLarge
 
-import h5py
-
 from math import floor, log
 
 rdb = getRdb()
+cache = BatchedCache(rdb)
+fragments_flight = SingleFlight(
+    rdb,
+    lease_ttl=hss.GENERATION_LEASE_TTL,
+    wait_timeout=hss.GENERATION_WAIT_TIMEOUT
+)
 
 logger = logging.getLogger(__name__)
 
@@ -167,6 +173,17 @@ def fragments_by_loci(request):
     return get_fragments_by_loci(request)
 
 
+def fetch_cached_results(keys):
+    '''
+    Get the cached results of fragments_by_loci requests, None for the
+    ones which aren't cached
+    '''
+    return [
+        pickle.loads(results) if results else None
+        for results in cache.get_many(keys)
+    ]
+
+
 def get_fragments_by_loci_info(request):
     return JsonResponse(GET_FRAG_PARAMS)
 
@@ -245,50 +262,36 @@ def get_fragments_by_loci(request):
 
     filetype = None
     new_filetype = None
-    previews = []
-    previews_2d = []
-    ts_cache = {}
-    mat_idx = None
 
     total_valid_loci = 0
     loci_lists = {}
     loci_ids = []
+    tileset = None
+
     try:
+        # get the metadata of all the tilesets at once
+        tilesets = tsr.resolve(set(
+            locus[tileset_idx] for locus in loci
+            if locus[tileset_idx] and not locus[tileset_idx].endswith('.cool')
+        ))
+
         for locus in loci:
             tileset_file = ''
 
             if locus[tileset_idx]:
-                if locus[tileset_idx] in ts_cache:
-                    tileset = ts_cache[locus[tileset_idx]]['obj']
-                    tileset_file = ts_cache[locus[tileset_idx]]['path']
-                elif locus[tileset_idx].endswith('.cool'):
+                if locus[tileset_idx].endswith('.cool'):
                     tileset_file = path.join('data', locus[tileset_idx])
+                elif locus[tileset_idx] in tilesets:
+                    tileset = tilesets[locus[tileset_idx]]
+                    tileset_file = tileset.datafile.path
+                elif locus[tileset_idx].startswith('osm'):
+                    new_filetype = locus[tileset_idx]
                 else:
-                    try:
-                        tileset = Tileset.objects.get(
-                            uuid=locus[tileset_idx]
-                        )
-                        tileset_file = tileset.datafile.path
-                        ts_cache[locus[tileset_idx]] = {
-                            "obj": tileset,
-                            "path": tileset_file
-                        }
-
-                    except AttributeError:
-                        return JsonResponse({
-                            'error': 'Tileset ({}) does not exist'.format(
-                                locus[tileset_idx]
-                            ),
-                        }, status=400)
-                    except Tileset.DoesNotExist:
-                        if locus[tileset_idx].startswith('osm'):
-                            new_filetype = locus[tileset_idx]
-                        else:
-                            return JsonResponse({
-                                'error': 'Tileset ({}) does not exist'.format(
-                                    locus[tileset_idx]
-                                ),
-                            }, status=400)
+                    return JsonResponse({
+                        'error': 'Tileset ({}) does not exist'.format(
+                            locus[tileset_idx]
+                        ),
+                    }, status=400)
             else:
                 return JsonResponse({
                     'error': 'Tileset not specified',
@@ -322,7 +325,7 @@ def get_fragments_by_loci(request):
                 # Get max abs dim in base pairs
                 max_abs_dim = max(locus[2] - locus[1], locus[5] - locus[4])
 
-                with h5py.File(tileset_file, 'r') as f:
+                with tfh.borrow(tileset_file) as f:
                     # get base resolution (bin size) of cooler file
                     if 'resolutions' in f:
                         # v2
@@ -371,6 +374,11 @@ def get_fragments_by_loci(request):
 
             locus_id = '.'.join(map(str, locus))
 
+            if locus[tileset_idx] in tilesets:
+                # cached snippets of older versions of the tileset must
+                # not be reused
+                locus_id += '@' + tilesets[locus[tileset_idx]].version
+
             loci_lists[tileset_file][zoomout_level].append(
                 locus[0:tileset_idx] + [total_valid_loci, inset_dim, locus_id]
             )
@@ -401,11 +409,10 @@ def get_fragments_by_loci(request):
             'error_message': str(e)
         }, status=500)
 
-    mat_idx = list(range(len(loci_ids)))
-
     # Get a unique string for caching
     dump = (
         json.dumps(loci, sort_keys=True) +
+        json.dumps(loci_ids) +
         str(forced_rep_idx) +
         str(dims) +
         str(padding) +
@@ -421,19 +428,24 @@ def get_fragments_by_loci(request):
         str(representatives)
     )
     uuid = hashlib.md5(dump.encode('utf-8')).hexdigest()
+    cache_key = 'frag_by_loci_%s' % uuid
 
     # Check if something is cached
     if not no_cache:
         try:
-            results = rdb.get('frag_by_loci_%s' % uuid)
+            results = rdb.get(cache_key)
             if results:
                 return JsonResponse(pickle.loads(results))
         except:
             pass
 
-    matrices = [None] * total_valid_loci
-    data_types = [None] * total_valid_loci
-    try:
+    def generate(keys):
+        mat_idx = list(range(len(loci_ids)))
+        previews = []
+        previews_2d = []
+
+        matrices = [None] * total_valid_loci
+        data_types = [None] * total_valid_loci
         for dataset in loci_lists:
             for zoomout_level in loci_lists[dataset]:
                 if filetype == 'cooler' or filetype == 'cool':
@@ -477,15 +489,7 @@ def get_fragments_by_loci(request):
 
                         data_types[idx] = 'matrix'
 
-    except Exception as ex:
-        raise
-        return JsonResponse({
-            'error': 'Could not retrieve fragments.',
-            'error_message': str(ex)
-        }, status=500)
-
-    if aggregate and len(matrices) > 1:
-        try:
+        if aggregate and len(matrices) > 1:
             cover, previews_1d, previews_2d = aggregate_frags(
                 matrices,
                 loci_ids,
@@ -499,102 +503,100 @@ def get_fragments_by_loci(request):
                     previews_1d, range(1, previews_1d.shape[0])
                 )
             data_types = [data_types[0]]
-        except Exception as ex:
-            raise
-            return JsonResponse({
-                'error': 'Could not aggregate fragments.',
-                'error_message': str(ex)
-            }, status=500)
-
-    if representatives and len(matrices) > 1:
-        if forced_rep_idx and len(forced_rep_idx) <= len(matrices):
-            matrices = [matrices[i] for i in forced_rep_idx]
-            mat_idx = forced_rep_idx
-            data_types = [data_types[0]] * len(forced_rep_idx)
-        else:
-            try:
+
+        if representatives and len(matrices) > 1:
+            if forced_rep_idx and len(forced_rep_idx) <= len(matrices):
+                matrices = [matrices[i] for i in forced_rep_idx]
+                mat_idx = forced_rep_idx
+                data_types = [data_types[0]] * len(forced_rep_idx)
+            else:
                 rep_frags, rep_idx = get_rep_frags(
                     matrices, loci, loci_ids, representatives, no_cache
                 )
                 matrices = rep_frags
                 mat_idx = rep_idx
                 data_types = [data_types[0]] * len(rep_frags)
-            except Exception as ex:
-                raise
-                return JsonResponse({
-                    'error': 'Could get representative fragments.',
-                    'error_message': str(ex)
-                }, status=500)
-
-    if encoding != 'b64' and encoding != 'image':
-        # Adjust precision and convert to list
-        for i, matrix in enumerate(matrices):
-            if precision > 0:
-                matrix = np.round(matrix, decimals=precision)
-            matrices[i] = matrix.tolist()
 
-        if max_previews > 0:
-            for i, preview in enumerate(previews):
-                previews[i] = preview.tolist()
-            for i, preview_2d in enumerate(previews_2d):
-                previews_2d[i] = preview_2d.tolist()
-
-    # Encode matrix if required
-    if encoding == 'b64':
-        for i, matrix in enumerate(matrices):
-            id = loci_ids[mat_idx[i]]
-            data_types[i] = 'dataUrl'
-            if not no_cache and id:
-                mat_b64 = None
-                try:
-                    mat_b64 = rdb.get('im_b64_%s' % id)
-                    if mat_b64 is not None:
-                        matrices[i] = mat_b64.decode('ascii')
-                        continue
-                except:
-                    pass
-
-            mat_b64 = pybase64.b64encode(np_to_png(matrix)).decode('ascii')
+        if encoding != 'b64' and encoding != 'image':
+            # Adjust precision and convert to list
+            for i, matrix in enumerate(matrices):
+                if precision > 0:
+                    matrix = np.round(matrix, decimals=precision)
+                matrices[i] = matrix.tolist()
+
+            if max_previews > 0:
+                for i, preview in enumerate(previews):
+                    previews[i] = preview.tolist()
+                for i, preview_2d in enumerate(previews_2d):
+                    previews_2d[i] = preview_2d.tolist()
+
+        # Encode matrix if required
+        if encoding == 'b64':
+            ids = [loci_ids[mat_idx[i]] for i in range(len(matrices))]
+            cached_b64 = [None] * len(matrices)
+            b64_to_cache = []
 
             if not no_cache:
-                try:
-                    rdb.set('im_b64_%s' % id, mat_b64, 60 * 30)
-                except Exception as ex:
-                    # error caching a tile
-                    # log the error and carry forward, this isn't critical
-                    logger.warn(ex)
+                cached_b64 = cache.get_many(
+                    ['im_b64_%s' % id if id else '' for id in ids]
+                )
 
-            matrices[i] = mat_b64
+            for i, matrix in enumerate(matrices):
+                id = ids[i]
+                data_types[i] = 'dataUrl'
+                if id and cached_b64[i] is not None:
+                    matrices[i] = cached_b64[i].decode('ascii')
+                    continue
+
+                mat_b64 = pybase64.b64encode(np_to_png(matrix)).decode('ascii')
+
+                if not no_cache:
+                    b64_to_cache.append(('im_b64_%s' % id, mat_b64))
+
+                matrices[i] = mat_b64
+
+            cache.set_many(b64_to_cache, 60 * 30)
+
+            if max_previews > 0:
+                for i, preview in enumerate(previews):
+                    previews[i] = pybase64.b64encode(
+                        np_to_png(preview)
+                    ).decode('ascii')
+                for i, preview_2d in enumerate(previews_2d):
+                    previews_2d[i] = pybase64.b64encode(
+                        np_to_png(preview_2d)
+                    ).decode('ascii')
+
+        # Create results
+        results = {
+            'fragments': matrices,
+            'indices': [int(i) for i in mat_idx],
+            'dataTypes': data_types,
+        }
 
+        # Return Y aggregates as 1D previews on demand
         if max_previews > 0:
-            for i, preview in enumerate(previews):
-                previews[i] = pybase64.b64encode(
-                    np_to_png(preview)
-                ).decode('ascii')
-            for i, preview_2d in enumerate(previews_2d):
-                previews_2d[i] = pybase64.b64encode(
-                    np_to_png(preview_2d)
-                ).decode('ascii')
+            results['previews'] = previews
+            results['previews2d'] = previews_2d
 
-    # Create results
-    results = {
-        'fragments': matrices,
-        'indices': [int(i) for i in mat_idx],
-        'dataTypes': data_types,
-    }
+        # Cache results for 30 minutes
+        try:
+            rdb.set(cache_key, pickle.dumps(results), 60 * 30)
+        except Exception as ex:
+            # error caching a tile
+            # log the error and carry forward, this isn't critical
+            logger.warning(ex)
 
-    # Return Y aggregates as 1D previews on demand
-    if max_previews > 0:
-        results['previews'] = previews
-        results['previews2d'] = previews_2d
+        return {cache_key: results}
 
-    # Cache results for 30 minutes
-    try:
-        rdb.set('frag_by_loci_%s' % uuid, pickle.dumps(results), 60 * 30)
-    except Exception as ex:
-        # error caching a tile
-        # log the error and carry forward, this isn't critical
-        logger.warn(ex)
+    if no_cache:
+        results = generate([cache_key])[cache_key]
+    else:
+        # concurrent requests for the same snippets generate them once
+        results = fragments_flight.run(
+            [cache_key], generate, fetch_cached_results)[cache_key]
+
+    matrices = results['fragments']
 
     if encoding == 'image':
         if len(matrices) == 1:
@@ -621,16 +623,21 @@ def fragments_by_chr(request):
     cooler_file = request.GET.get('cooler', False)
     loop_list = request.GET.get('loop-list', False)
 
+    cooler_version = ''
+
     if cooler_file:
         if cooler_file.endswith('.cool'):
             cooler_file = path.join('data', cooler_file)
         else:
-            try:
-                cooler_file = Tileset.objects.get(uuid=cooler_file).datafile.path
-            except AttributeError:
+            tileset = tsr.get(cooler_file)
+
+            if tileset is None:
                 return JsonResponse({
                     'error': 'Cooler file not in database',
                 }, status=500)
+
+            cooler_file = tileset.datafile.path
+            cooler_version = tileset.version
     else:
         return JsonResponse({
             'error': 'Cooler file not specified',
@@ -670,6 +677,7 @@ def fragments_by_chr(request):
     uuid = hashlib.md5(
         '-'.join([
             cooler_file,
+            cooler_version,
             chrom,
             loop_list,
             str(limit),
@@ -0,0 +1,695 @@
+import collections as col
+import concurrent.futures as cf
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedCache:
+    '''
+    Batched access to the cache returned by `getRdb`.
+
+    All the keys of a lookup are fetched with a single MGET and all the
+    values of a write are sent in a single pipeline, so that every phase
+    of a request costs one round trip to the cache server regardless of
+    how many entries it touches.
+
+    Errors talking to the cache are logged and otherwise treated as
+    misses since caching is never critical.
+    '''
+    def __init__(self, rdb):
+        self.rdb = rdb
+
+    def get_many(self, keys):
+        '''
+        Retrieve a number of values from the cache
+
+        Parameters
+        ----------
+        keys: [str,...]
+            The keys to look up
+
+        Returns
+        -------
+        values: [bytes or None,...]
+            The cached values in the same order as the keys, None
+            for the keys which are not cached
+        '''
+        keys = list(keys)
+
+        if len(keys) == 0:
+            return []
+
+        try:
+            return self.rdb.mget(keys)
+        except Exception as ex:
+            # there was an error accessing the cache server
+            # log the error and carry forward as if nothing was cached
+            logger.warning(ex)
+            return [None] * len(keys)
+
+    def set_many(self, items, ex=None):
+        '''
+        Store a number of values in the cache
+
+        Parameters
+        ----------
+        items: [(str, bytes),...]
+            The key, value pairs to store
+        ex: int or None
+            The expiry time of the entries in seconds. None if they
+            shouldn't expire
+        '''
+        self.set_entries((key, value, ex) for key, value in items)
+
+    def set_entries(self, entries):
+        '''
+        Store a number of values, each with its own expiry time
+
+        Parameters
+        ----------
+        entries: [(str, bytes, int or None),...]
+            The key, value and expiry time (in seconds, None if it
+            shouldn't expire) of every entry
+        '''
+        entries = list(entries)
+
+        if len(entries) == 0:
+            return
+
+        try:
+            pipe = self.rdb.pipeline(transaction=False)
+
+            for key, value, ex in entries:
+                pipe.set(key, value, ex=ex)
+
+            pipe.execute()
+        except Exception as e:
+            # error caching the values
+            # log the error and carry forward, this isn't critical
+            logger.warning(e)
+
+
+class LRUCache:
+    '''
+    A thread-safe, in-process least recently used cache bounded by the
+    total size of its entries in bytes rather than by their number.
+
+    The size of every entry has to be passed in when it is stored since
+    the cached objects are usually decoded versions of serialized values
+    whose length is a good estimate of their footprint.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = col.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''
+        Get the value stored under key or None if it isn't cached
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[0]
+
+    def set(self, key, value, nbytes):
+        '''
+        Store a value which takes up nbytes, evicting the least recently
+        used entries if the cache grows beyond its size
+        '''
+        if nbytes > self.max_bytes:
+            # would evict everything else and still not fit
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+
+    def invalidate_prefix(self, prefix):
+        '''
+        Drop all the entries whose keys start with prefix
+        '''
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                self.nbytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        '''
+        The hit and miss counters and the current size of the cache
+        '''
+        lookups = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+        }
+
+
+class TieredCache(BatchedCache):
+    '''
+    A `BatchedCache` with an in-process `LRUCache` in front of it.
+
+    Values are decoded with `loads` when they come out of the shared
+    cache and kept decoded in the local tier, so that repeated hits in
+    the same worker cost neither a round trip nor a decode. Values that
+    `loads` returns None for are treated as misses.
+
+    If an invalidation channel is given, `invalidate_prefix` publishes
+    the prefix on it and every worker listening on the channel drops its
+    local copies of the matching entries.
+    '''
+    def __init__(self, rdb, max_bytes, loads, dumps, channel=None):
+        super().__init__(rdb)
+
+        self.local = LRUCache(max_bytes)
+        self.loads = loads
+        self.dumps = dumps
+        self.channel = channel
+
+        self._listener_pid = None
+
+    def get_many(self, keys):
+        '''
+        Retrieve a number of decoded values, first from the local tier
+        and then, in one round trip, from the shared cache
+
+        Returns
+        -------
+        values: [object or None,...]
+            The decoded values in the same order as the keys, None for
+            the keys which are not cached
+        '''
+        self._ensure_listener()
+
+        keys = list(keys)
+        values = [self.local.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+
+        remote_values = super().get_many([keys[i] for i in missing])
+
+        for i, raw in zip(missing, remote_values):
+            if raw is None:
+                continue
+
+            values[i] = self.loads(raw)
+
+            if values[i] is not None:
+                self.local.set(keys[i], values[i], len(raw))
+
+        return values
+
+    def set_many(self, items, ex=None):
+        '''
+        Encode a number of values with `dumps` and store them both in
+        the local tier and, in one round trip, in the shared cache
+        '''
+        encoded_items = []
+
+        for key, value in items:
+            raw = self.dumps(value)
+            self.local.set(key, value, len(raw))
+            encoded_items += [(key, raw)]
+
+        super().set_many(encoded_items, ex)
+
+    def put_many(self, entries, policy):
+        '''
+        Encode a number of generated tiles and store those that the policy
+        admits, with the expiry time it assigns, in both tiers
+
+        Parameters
+        ----------
+        entries: [(key, value, filetype, zoom, cost[, derived]),...]
+            The cache key and value of every tile, the filetype and zoom
+            level it was generated for, the time it took to generate in
+            seconds and optionally whether it was derived from other
+            cached data
+        policy: TileCachePolicy
+            Decides which tiles are cached and for how long
+        '''
+        encoded_entries = []
+
+        for key, value, filetype, zoom, cost, *derived in entries:
+            raw = self.dumps(value)
+
+            if not policy.admit(filetype, cost, len(raw), any(derived)):
+                continue
+
+            self.local.set(key, value, len(raw))
+            encoded_entries += [(key, raw, policy.ttl(filetype, zoom))]
+
+        self.set_entries(encoded_entries)
+
+    def invalidate_prefix(self, prefix):
+        '''
+        Drop the locally cached entries whose keys start with prefix in
+        this worker and, through the invalidation channel, in all others
+        '''
+        self.local.invalidate_prefix(prefix)
+
+        if self.channel is None:
+            return
+
+        try:
+            self.rdb.publish(self.channel, prefix)
+        except Exception as ex:
+            logger.warning(ex)
+
+    def stats(self):
+        return self.local.stats()
+
+    def _ensure_listener(self):
+        '''
+        Start the thread listening for invalidations. This is done lazily
+        and per process so that forked workers each get their own.
+        '''
+        if self.channel is None or self._listener_pid == os.getpid():
+            return
+
+        if not hasattr(self.rdb, 'pubsub'):
+            # e.g. the disk cache, which can't broadcast invalidations
+            logger.info('%s has no invalidation channel',
+                type(self.rdb).__name__)
+            self.channel = None
+            return
+
+        self._listener_pid = os.getpid()
+        self.local.clear()
+
+        try:
+            pubsub = self.rdb.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self.channel)
+        except Exception as ex:
+            # try again with the next lookup, until then the local tier
+            # can't be kept up to date
+            logger.warning(ex)
+            self._listener_pid = None
+            return
+
+        thread = threading.Thread(
+            target=self._listen, args=(pubsub,), daemon=True
+        )
+        thread.start()
+
+    def _listen(self, pubsub):
+        try:
+            for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+
+                prefix = message['data']
+                if isinstance(prefix, bytes):
+                    prefix = prefix.decode('utf-8')
+
+                self.local.invalidate_prefix(prefix)
+        except Exception as ex:
+            # the connection went away, the entries in this worker can
+            # no longer be trusted to be up to date
+            logger.warning(ex)
+            self.local.clear()
+            self._listener_pid = None
+
+
+class TileCachePolicy:
+    '''
+    Decides which generated tiles are worth caching and for how long, and
+    keeps per filetype hit / miss counters.
+
+    A tile is only cached if it isn't larger than `max_entry_bytes` and
+    took at least `min_cost` seconds per MB of its serialized size to
+    generate, so that tiles which are cheap to regenerate don't push out
+    expensive ones. Tiles derived from other cached data (e.g. aggregated
+    with tileset options) are held to `derived_min_cost` instead. Expiry
+    times are looked up by 'filetype:zoom', then
+    by 'filetype' in `ttls` and default to `default_ttl`. A TTL of 0
+    means that the entries don't expire.
+
+    Parameters
+    ----------
+    default_ttl: int
+        The TTL of tiles without a more specific one, in seconds
+    ttls: {str: int}
+        TTLs by 'filetype' or 'filetype:zoom'
+    min_cost: float
+        The minimum generation time in seconds per MB of a cached tile
+    max_entry_bytes: int
+        The size of the largest cached tile (0 for no limit)
+    derived_min_cost: float or None
+        The minimum generation time in seconds per MB of a cached derived
+        tile (`min_cost` if it's None)
+    '''
+    def __init__(self, default_ttl=0, ttls=None, min_cost=0, max_entry_bytes=0,
+            derived_min_cost=None):
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self.min_cost = min_cost
+        self.max_entry_bytes = max_entry_bytes
+        self.derived_min_cost = (
+            min_cost if derived_min_cost is None else derived_min_cost)
+
+        self._counters = col.defaultdict(col.Counter)
+        self._lock = threading.Lock()
+
+    def ttl(self, filetype, zoom=None):
+        '''
+        The expiry time of a tile in seconds or None if it shouldn't expire
+        '''
+        ttl = self.ttls.get(
+            '{}:{}'.format(filetype, zoom),
+            self.ttls.get(filetype, self.default_ttl)
+        )
+
+        return int(ttl) or None
+
+    def admit(self, filetype, cost, nbytes, derived=False):
+        '''
+        Whether a tile which took cost seconds to generate and takes up
+        nbytes bytes should be cached
+        '''
+        min_cost = self.derived_min_cost if derived else self.min_cost
+        admitted = (
+            (self.max_entry_bytes <= 0 or nbytes <= self.max_entry_bytes) and
+            cost * 1024 ** 2 >= min_cost * nbytes
+        )
+
+        self.count(filetype, 'admitted' if admitted else 'rejected')
+
+        return admitted
+
+    def count(self, filetype, counter, n=1):
+        '''
+        Increment one of the counters of a filetype ('hits', 'misses',
+        'admitted' or 'rejected')
+        '''
+        with self._lock:
+            self._counters[filetype][counter] += n
+
+    def stats(self):
+        '''
+        The counters and the hit ratio of every filetype
+        '''
+        with self._lock:
+            counters = {ft: dict(c) for ft, c in self._counters.items()}
+
+        stats = {}
+
+        for filetype, counter in counters.items():
+            hits = counter.get('hits', 0)
+            lookups = hits + counter.get('misses', 0)
+
+            stats[filetype] = {
+                'hits': hits,
+                'misses': counter.get('misses', 0),
+                'hit_ratio': hits / lookups if lookups else 0,
+                'admitted': counter.get('admitted', 0),
+                'rejected': counter.get('rejected', 0),
+            }
+
+        return stats
+
+
+class SingleFlight:
+    '''
+    Makes sure that a value which is requested by many clients at once is
+    only generated once, rather than by every request which misses the
+    cache.
+
+    Within a process, the first caller of `run` for a key generates the
+    value and concurrent callers for the same key wait for it. Across
+    processes, the generating caller holds a lease in the shared cache
+    (a key set with NX that expires after `lease_ttl` seconds) and
+    callers in other processes poll the cache for the value until the
+    lease is released or `wait_timeout` seconds have passed. Values which
+    don't turn up (e.g. because they weren't admitted to the cache or
+    the generating process died) are generated by the waiting callers
+    themselves, so coalescing never costs more than `wait_timeout`.
+
+    Parameters
+    ----------
+    rdb: object
+        The shared cache, as returned by `getRdb`
+    lease_ttl: float
+        How long a lease is held at most, in seconds
+    wait_timeout: float
+        How long to wait for a value generated by another caller
+    poll_interval: float
+        How often the cache is polled for values generated by other
+        processes, in seconds
+    '''
+    LEASE_PREFIX = 'lease:'
+
+    def __init__(self, rdb, lease_ttl=10., wait_timeout=5., poll_interval=0.02):
+        self.rdb = rdb
+        self.lease_ttl = lease_ttl
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._pid = os.getpid()
+        self._counters = col.Counter()
+
+    def run(self, keys, generate, fetch=None):
+        '''
+        Get the values for a number of keys, coalescing their generation
+        with concurrent calls for the same keys
+
+        Parameters
+        ----------
+        keys: [str,...]
+            The keys (usually cache keys) of the values
+        generate: function
+            Gets passed a list of keys and returns a {key: value} dict.
+            It's expected to store the values in the cache that fetch
+            reads from.
+        fetch: function or None
+            Gets passed a list of keys and returns their values in the
+            cache (None for the missing ones). Without it, generations
+            are only coalesced within this process.
+
+        Returns
+        -------
+        values: {str: object}
+            The values by key. Keys that generate returned no value for
+            are left out.
+        '''
+        keys = list(dict.fromkeys(keys))
+        owned = []
+        waiting = {}
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # the futures belong to the parent process
+                self._pid = os.getpid()
+                self._futures = {}
+
+            for key in keys:
+                future = self._futures.get(key)
+
+                if future is None:
+                    future = cf.Future()
+                    self._futures[key] = future
+                    owned.append(key)
+                else:
+                    waiting[key] = future
+
+        values = {}
+
+        try:
+            if owned:
+                values.update(self._lead(owned, generate, fetch))
+        except BaseException as ex:
+            self._resolve(owned, values, ex)
+            raise
+
+        self._resolve(owned, values)
+
+        retry = []
+
+        for key, future in waiting.items():
+            try:
+                value = future.result(timeout=self.wait_timeout)
+                self.count('local_waits')
+            except Exception:
+                # the generation failed or took too long
+                self.count('timeouts')
+                retry.append(key)
+                continue
+
+            if value is not None:
+                values[key] = value
+
+        if retry:
+            values.update(generate(retry))
+
+        return values
+
+    def _resolve(self, keys, values, ex=None):
+        with self._lock:
+            for key in keys:
+                future = self._futures.pop(key, None)
+
+                if future is None:
+                    continue
+
+                if ex is not None:
+                    future.set_exception(ex)
+                else:
+                    future.set_result(values.get(key))
+
+    def _lead(self, keys, generate, fetch):
+        '''
+        Generate the values of keys that no other process holds a lease
+        for and wait for the others
+        '''
+        if fetch is None:
+            self.count('generated', len(keys))
+            return generate(keys)
+
+        leases = self._acquire(keys)
+        mine = [key for key, lease in zip(keys, leases) if lease]
+        theirs = [key for key, lease in zip(keys, leases) if not lease]
+
+        values = {}
+
+        if mine:
+            self.count('generated', len(mine))
+
+            try:
+                values.update(generate(mine))
+            finally:
+                self._release(mine)
+
+        if theirs:
+            found = self._wait(theirs, fetch)
+            values.update(found)
+
+            rest = [key for key in theirs if key not in found]
+
+            if rest:
+                self.count('generated', len(rest))
+                values.update(generate(rest))
+
+        return values
+
+    def _acquire(self, keys):
+        '''
+        Try to take the leases of keys. Returns whether each one was
+        taken; if the cache can't be reached, they all count as taken.
+        '''
+        try:
+            pipe = self.rdb.pipeline(transaction=False)
+
+            for key in keys:
+                pipe.set(
+                    self.LEASE_PREFIX + key, str(os.getpid()),
+                    px=int(self.lease_ttl * 1000), nx=True)
+
+            results = list(pipe.execute())
+        except Exception as ex:
+            logger.warning(ex)
+            results = []
+
+        results += [True] * (len(keys) - len(results))
+
+        # a lease that's held by someone else is reported as None
+        return [result is not None for result in results]
+
+    def _release(self, keys):
+        try:
+            self.rdb.delete(*[self.LEASE_PREFIX + key for key in keys])
+        except Exception as ex:
+            # the leases will expire
+            logger.warning(ex)
+
+    def _wait(self, keys, fetch):
+        '''
+        Poll the cache for values generated by other processes while
+        their leases are held
+        '''
+        found = {}
+        pending = list(keys)
+        deadline = time.monotonic() + self.wait_timeout
+
+        while pending and time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+
+            try:
+                leases = self.rdb.mget(
+                    [self.LEASE_PREFIX + key for key in pending])
+            except Exception as ex:
+                logger.warning(ex)
+                break
+
+            for key, value in zip(pending, fetch(pending)):
+                if value is not None:
+                    found[key] = value
+
+            # values are stored before their leases are released, so the
+            # ones which weren't found after that won't show up
+            pending = [
+                key for key, lease in zip(pending, leases)
+                if key not in found and lease is not None
+            ]
+
+        self.count('remote_waits', len(found))
+
+        if pending:
+            self.count('timeouts', len(pending))
+
+        return found
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] += n
+
+    def stats(self):
+        '''
+        The number of values generated, received from a concurrent
+        generation in this process or another one, and the number of
+        waits that timed out
+        '''
+        with self._lock:
+            counters = dict(self._counters)
+
+        return {
+            counter: counters.get(counter, 0) for counter in
+            ['generated', 'local_waits', 'remote_waits', 'timeouts']
+        }
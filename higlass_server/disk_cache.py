@@ -0,0 +1,378 @@
+'''
+An on-disk stand-in for redis, for deployments without a redis server.
+
+`DiskRDB` implements the subset of the redis client used by the caches
+(get, mget, set, exists, delete, incr, pipeline) on top of a number of SQLite databases
+(shards) in a directory. Keys are spread over the shards by hash so that
+writers in different processes rarely wait for the same database. Every
+shard holds at most `max_bytes / shards` bytes of values, the least
+recently used entries are evicted first and expired entries are dropped
+when they are read or when space is needed. The access time of an entry is
+only updated on reads once it's older than `atime_interval`, so that reads
+rarely have to take the write lock. The databases use SQLite's
+write-ahead log so that any number of uWSGI workers can read while one
+writes.
+
+Like for redis, errors are logged and treated as misses.
+'''
+import hashlib
+import logging
+import os
+import os.path as op
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL,
+    atime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    nbytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO usage (id, nbytes) VALUES (0, 0);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE usage SET nbytes = nbytes + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries BEGIN
+    UPDATE usage SET nbytes = nbytes - old.size + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE usage SET nbytes = nbytes - old.size;
+END;
+'''
+
+
+class DiskPipeline:
+    '''
+    Buffers set commands and writes them with one transaction per shard
+    '''
+    def __init__(self, rdb):
+        self.rdb = rdb
+        self.commands = []
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        self.commands.append((name, value, ex, px, nx, xx))
+        return self
+
+    def execute(self):
+        return self.rdb.set_many(self.commands)
+
+
+class DiskRDB:
+    '''
+    A size capped, sharded SQLite key-value store with the interface of
+    the redis client.
+
+    Parameters
+    ----------
+    path: str
+        The directory holding the shards. It's created if it doesn't
+        exist.
+    max_bytes: int
+        The maximum total size of the stored values
+    shards: int
+        The number of SQLite databases the entries are spread over
+    timeout: float
+        How long to wait for another process holding the write lock of
+        a shard, in seconds
+    atime_interval: float
+        How old the access time of an entry has to be for a read to
+        update it, in seconds
+    '''
+    def __init__(self, path, max_bytes, shards=8, timeout=1.,
+            atime_interval=60.):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.shards = shards
+        self.timeout = timeout
+        self.atime_interval = atime_interval
+
+        os.makedirs(path, exist_ok=True)
+
+        self._local = threading.local()
+
+    def _shard(self, key):
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], 'little') % self.shards
+
+    def _connection(self, shard):
+        '''
+        The connection of this thread to a shard. Connections aren't
+        shared between threads or with forked children.
+        '''
+        local = self._local
+
+        if getattr(local, 'pid', None) != os.getpid():
+            local.pid = os.getpid()
+            local.connections = {}
+
+        conn = local.connections.get(shard)
+
+        if conn is None:
+            conn = sqlite3.connect(
+                op.join(self.path, 'shard-{}.sqlite'.format(shard)),
+                timeout=self.timeout,
+                isolation_level=None,
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            local.connections[shard] = conn
+
+        return conn
+
+    def _by_shard(self, keys):
+        shards = {}
+
+        for i, key in enumerate(keys):
+            shards.setdefault(self._shard(key), []).append((i, key))
+
+        return shards
+
+    def mget(self, keys, *args):
+        keys = list(keys)
+        values = [None] * len(keys)
+        now = time.time()
+
+        for shard, indexed_keys in self._by_shard(keys).items():
+            try:
+                conn = self._connection(shard)
+                placeholders = ','.join('?' * len(indexed_keys))
+                rows = dict(
+                    (key, (value, expires, atime))
+                    for key, value, expires, atime in conn.execute(
+                        'SELECT key, value, expires, atime FROM entries '
+                        'WHERE key IN ({})'.format(placeholders),
+                        [key for _, key in indexed_keys]
+                    )
+                )
+
+                hits = []
+
+                for i, key in indexed_keys:
+                    if key not in rows:
+                        continue
+
+                    value, expires, atime = rows[key]
+
+                    if expires is not None and expires <= now:
+                        continue
+
+                    values[i] = value
+
+                    if atime <= now - self.atime_interval:
+                        hits.append(key)
+
+                if hits:
+                    conn.execute(
+                        'UPDATE entries SET atime = ? WHERE key IN ({})'.format(
+                            ','.join('?' * len(hits))),
+                        [now] + hits
+                    )
+            except sqlite3.Error as ex:
+                logger.warning('Disk cache error: %s', ex)
+
+        return values
+
+    def get(self, name):
+        return self.mget([name])[0]
+
+    def exists(self, name):
+        try:
+            row = self._connection(self._shard(name)).execute(
+                'SELECT expires FROM entries WHERE key = ?', [name]
+            ).fetchone()
+        except sqlite3.Error as ex:
+            logger.warning('Disk cache error: %s', ex)
+            return False
+
+        return row is not None and (row[0] is None or row[0] > time.time())
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        return self.set_many([(name, value, ex, px, nx, xx)])[0]
+
+    def incr(self, name, amount=1):
+        '''
+        Increment the integer stored under name, keeping its expiry time
+        like redis. Returns the new value, or None if it couldn't be
+        stored.
+        '''
+        now = time.time()
+
+        try:
+            conn = self._connection(self._shard(name))
+            conn.execute('BEGIN IMMEDIATE')
+
+            try:
+                row = conn.execute(
+                    'SELECT value, expires FROM entries WHERE key = ?', (name,)
+                ).fetchone()
+                value = amount
+                ex = None
+
+                if row is not None and (row[1] is None or row[1] > now):
+                    value += int(row[0])
+                    ex = None if row[1] is None else row[1] - now
+
+                self._set(conn, now, name, str(value), ex)
+                self._evict(conn, now)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        except (sqlite3.Error, ValueError) as ex:
+            logger.warning('Disk cache error: %s', ex)
+            return None
+
+        return value
+
+    def set_many(self, commands):
+        '''
+        Execute a number of set commands, given as (name, value, ex, px,
+        nx, xx) tuples like the arguments of `set`
+
+        Returns
+        -------
+        results: [bool or None,...]
+            Whether every value was stored, None if it wasn't because of
+            nx or xx
+        '''
+        commands = list(commands)
+        results = [False] * len(commands)
+        now = time.time()
+
+        for shard, indexed_keys in self._by_shard(
+                [command[0] for command in commands]).items():
+            try:
+                conn = self._connection(shard)
+                conn.execute('BEGIN IMMEDIATE')
+
+                try:
+                    for i, key in indexed_keys:
+                        results[i] = self._set(conn, now, *commands[i])
+
+                    self._evict(conn, now)
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+            except sqlite3.Error as ex:
+                logger.warning('Disk cache error: %s', ex)
+
+        return results
+
+    def _set(self, conn, now, name, value, ex=None, px=None, nx=False, xx=False):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+
+        if nx or xx:
+            row = conn.execute(
+                'SELECT expires FROM entries WHERE key = ?', (name,)
+            ).fetchone()
+            exists = row is not None and (row[0] is None or row[0] > now)
+
+            if (nx and exists) or (xx and not exists):
+                # like redis
+                return None
+
+        if ex is not None:
+            expires = now + ex
+        elif px is not None:
+            expires = now + px / 1000
+        else:
+            expires = None
+
+        conn.execute(
+            'INSERT INTO entries (key, value, size, expires, atime) '
+            'VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET '
+            'value = excluded.value, size = excluded.size, '
+            'expires = excluded.expires, atime = excluded.atime',
+            (name, value, len(value), expires, now)
+        )
+
+        return True
+
+    def _evict(self, conn, now):
+        '''
+        Drop expired entries and then the least recently used ones until
+        the shard fits in its share of max_bytes
+        '''
+        max_bytes = self.max_bytes / self.shards
+
+        if self._usage(conn) <= max_bytes:
+            return
+
+        conn.execute(
+            'DELETE FROM entries WHERE expires IS NOT NULL AND expires <= ?',
+            (now,))
+
+        excess = self._usage(conn) - max_bytes
+        to_evict = []
+
+        for key, size in conn.execute(
+                'SELECT key, size FROM entries ORDER BY atime'):
+            if excess <= 0:
+                break
+
+            to_evict.append((key,))
+            excess -= size
+
+        conn.executemany('DELETE FROM entries WHERE key = ?', to_evict)
+
+    def _usage(self, conn):
+        return conn.execute('SELECT nbytes FROM usage').fetchone()[0]
+
+    def delete(self, *names):
+        deleted = 0
+
+        for shard, indexed_keys in self._by_shard(names).items():
+            try:
+                conn = self._connection(shard)
+                deleted += conn.execute(
+                    'DELETE FROM entries WHERE key IN ({})'.format(
+                        ','.join('?' * len(indexed_keys))),
+                    [key for _, key in indexed_keys]
+                ).rowcount
+            except sqlite3.Error as ex:
+                logger.warning('Disk cache error: %s', ex)
+
+        return deleted
+
+    def pipeline(self, transaction=True):
+        return DiskPipeline(self)
+
+    def publish(self, channel, message):
+        # there are no subscribers, every worker reads the same files
+        return 0
+
+    def health(self):
+        '''
+        The total size and the number of entries stored in the shards
+        '''
+        nbytes = 0
+        entries = 0
+
+        try:
+            for shard in range(self.shards):
+                conn = self._connection(shard)
+                nbytes += self._usage(conn)
+                entries += conn.execute(
+                    'SELECT COUNT(*) FROM entries').fetchone()[0]
+        except sqlite3.Error as ex:
+            return {'state': 'disk', 'error': str(ex)}
+
+        return {
+            'state': 'disk',
+            'entries': entries,
+            'bytes': nbytes,
+            'max_bytes': self.max_bytes,
+        }
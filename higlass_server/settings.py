@@ -185,6 +185,37 @@ else:
     REDIS_HOST = None
     REDIS_PORT = None
 
+# Redis commands give up after REDIS_SOCKET_TIMEOUT seconds (connecting after
+# REDIS_CONNECT_TIMEOUT) and count as cache misses. After
+# REDIS_FAILURE_THRESHOLD consecutive failures redis is bypassed until it
+# answers one of the pings sent every REDIS_RETRY_INTERVAL seconds. Commands
+# waiting longer than REDIS_POOL_TIMEOUT seconds for one of the
+# REDIS_MAX_CONNECTIONS connections are cache misses too, but don't count as
+# failures
+REDIS_SOCKET_TIMEOUT = float(get_setting('REDIS_SOCKET_TIMEOUT', 0.5))
+REDIS_CONNECT_TIMEOUT = float(get_setting('REDIS_CONNECT_TIMEOUT', 0.5))
+REDIS_MAX_CONNECTIONS = int(get_setting('REDIS_MAX_CONNECTIONS', 50))
+REDIS_POOL_TIMEOUT = float(get_setting('REDIS_POOL_TIMEOUT', 0.5))
+REDIS_FAILURE_THRESHOLD = int(get_setting('REDIS_FAILURE_THRESHOLD', 3))
+REDIS_RETRY_INTERVAL = float(get_setting('REDIS_RETRY_INTERVAL', 5))
+
+# Without redis, tiles and snippets can be cached on disk instead in
+# DISK_CACHE_SHARDS SQLite databases in DISK_CACHE_DIR (empty to disable),
+# evicting the least recently used entries beyond DISK_CACHE_MAX_BYTES. Reads
+# update the access time of an entry at most every DISK_CACHE_ATIME_INTERVAL
+# seconds
+DISK_CACHE_DIR = get_setting('DISK_CACHE_DIR', '')
+DISK_CACHE_MAX_BYTES = int(get_setting('DISK_CACHE_MAX_BYTES', 1024 ** 3))
+DISK_CACHE_SHARDS = int(get_setting('DISK_CACHE_SHARDS', 8))
+DISK_CACHE_ATIME_INTERVAL = float(get_setting('DISK_CACHE_ATIME_INTERVAL', 60))
+
+# Data files read at least CACHE_DIR_MIN_ACCESSES times (by all workers if
+# there's a redis server or disk cache) are copied to HIGLASS_CACHE_DIR in the
+# background, deleting the least recently read copies beyond
+# CACHE_DIR_MAX_BYTES (0 for no limit)
+CACHE_DIR_MAX_BYTES = int(get_setting('CACHE_DIR_MAX_BYTES', 10 * 1024 ** 3))
+CACHE_DIR_MIN_ACCESSES = int(get_setting('CACHE_DIR_MIN_ACCESSES', 3))
+
 # DEFAULT_FILE_STORAGE = 'tilesets.storage.HashedFilenameFileSystemStorage'
 
 # Application definition
@@ -312,6 +343,124 @@ SNIPPET_IMG_MAX_OUT_DIM = get_setting('SNIPPET_IMG_MAX_OUT_DIM', 1024)
 SNIPPET_OSM_MAX_DATA_DIM = get_setting('SNIPPET_OSM_MAX_DATA_DIM', 2048)
 SNIPPET_IMT_MAX_DATA_DIM = get_setting('SNIPPET_IMT_MAX_DATA_DIM', 2048)
 
+# How the tiles of the different tilesets in a single request are generated:
+# 'serial', 'thread' (for readers that release the GIL, e.g. pybbi, h5py) or
+# 'process' (for CPU-heavy readers, e.g. cooler, multivec)
+TILE_GENERATION_EXECUTOR = get_setting('TILE_GENERATION_EXECUTOR', 'serial')
+TILE_GENERATION_WORKERS = int(get_setting('TILE_GENERATION_WORKERS', 4))
+
+# Size in bytes of the in-process tile cache kept in front of redis by every
+# worker (0 disables it) and the redis pub/sub channel used by the workers to
+# invalidate each other's entries (empty to disable)
+TILE_CACHE_LOCAL_MAX_BYTES = int(get_setting('TILE_CACHE_LOCAL_MAX_BYTES', 0))
+TILE_CACHE_INVALIDATION_CHANNEL = get_setting(
+    'TILE_CACHE_INVALIDATION_CHANNEL', '') or None
+
+# Which generated tiles are cached in redis and for how long. Tiles larger
+# than TILE_CACHE_MAX_ENTRY_BYTES (0 for no limit) or that took less than
+# TILE_CACHE_MIN_COST seconds per MB to generate aren't cached. Tiles expire
+# after TILE_CACHE_TTLS['<filetype>:<zoom>'], TILE_CACHE_TTLS['<filetype>']
+# or TILE_CACHE_TTL seconds (0 for never). With redis' volatile-ttl eviction
+# policy, short TTLs can be used to mark the tiles to evict first
+TILE_CACHE_TTL = int(get_setting('TILE_CACHE_TTL', 0))
+TILE_CACHE_TTLS = get_setting('TILE_CACHE_TTLS', {})
+if isinstance(TILE_CACHE_TTLS, str):
+    TILE_CACHE_TTLS = json.loads(TILE_CACHE_TTLS)
+TILE_CACHE_MIN_COST = float(get_setting('TILE_CACHE_MIN_COST', 0))
+TILE_CACHE_MAX_ENTRY_BYTES = int(get_setting('TILE_CACHE_MAX_ENTRY_BYTES', 0))
+
+# Tiles aggregated with tileset options (e.g. multivec aggGroups) are only
+# cached if they took at least TILE_CACHE_DERIVED_MIN_COST seconds per MB
+# to generate. With MULTIVEC_BASE_TILE_CACHE, the raw multivec tiles they
+# are computed from are cached (for MULTIVEC_BASE_TILE_TTL seconds, 0 for
+# never, and in a local tier of MULTIVEC_BASE_TILE_LOCAL_MAX_BYTES) so
+# that all the aggregations of a tile share one read of the file. Raw tiles
+# larger than MULTIVEC_BASE_TILE_MAX_BYTES (0 for no limit) aren't cached
+TILE_CACHE_DERIVED_MIN_COST = float(
+    get_setting('TILE_CACHE_DERIVED_MIN_COST', 0.02))
+MULTIVEC_BASE_TILE_CACHE = get_setting('MULTIVEC_BASE_TILE_CACHE', True)
+MULTIVEC_BASE_TILE_TTL = int(get_setting('MULTIVEC_BASE_TILE_TTL', 3600))
+MULTIVEC_BASE_TILE_LOCAL_MAX_BYTES = int(
+    get_setting('MULTIVEC_BASE_TILE_LOCAL_MAX_BYTES', 64 * 1024 ** 2))
+MULTIVEC_BASE_TILE_MAX_BYTES = int(
+    get_setting('MULTIVEC_BASE_TILE_MAX_BYTES', 1024 ** 2))
+
+# Tiles are cached as their serialized JSON or binary fragments, compressed
+# in redis if TILE_CACHE_COMPRESSION is 'zlib' (or uncompressed if it's empty)
+TILE_CACHE_COMPRESSION = get_setting('TILE_CACHE_COMPRESSION', '')
+TILE_CACHE_COMPRESSION_LEVEL = int(
+    get_setting('TILE_CACHE_COMPRESSION_LEVEL', 1))
+
+# Concurrent requests for the same tiles or snippets generate them once. The
+# worker generating them holds a lease in redis for at most
+# GENERATION_LEASE_TTL seconds and the other workers wait up to
+# GENERATION_WAIT_TIMEOUT seconds for the result before generating it
+# themselves
+GENERATION_LEASE_TTL = float(get_setting('GENERATION_LEASE_TTL', 10))
+GENERATION_WAIT_TIMEOUT = float(get_setting('GENERATION_WAIT_TIMEOUT', 5))
+
+# How dense numeric tiles are sent: 'auto' (float16 when the values fit and
+# there are no NaNs, float32 otherwise), 'float16-nan' (like 'auto' but NaNs
+# are kept in float16 tiles) or 'float32'
+TILE_DENSE_ENCODING = get_setting('TILE_DENSE_ENCODING', 'auto')
+
+# The requested 2D tiles of a zoom level are read with one range query per
+# rectangle covering them. A rectangle is split while more than
+# TILE_RECTANGLE_MAX_WASTE of its tiles weren't requested
+TILE_RECTANGLE_MAX_WASTE = float(get_setting('TILE_RECTANGLE_MAX_WASTE', 0.25))
+
+# Data files are kept open between requests by every worker: at most
+# FILE_HANDLE_POOL_MAX_OPEN idle files, each closed after
+# FILE_HANDLE_POOL_IDLE_TIMEOUT seconds without use. The state read from them
+# (e.g. the bin indexes and weights of coolers) takes up at most
+# FILE_HANDLE_POOL_MAX_STATE_BYTES (0 for no limit). HDF5 files are opened
+# with a chunk cache of HDF5_RDCC_NBYTES bytes and HDF5_RDCC_NSLOTS slots
+FILE_HANDLE_POOL_MAX_OPEN = int(get_setting('FILE_HANDLE_POOL_MAX_OPEN', 64))
+FILE_HANDLE_POOL_IDLE_TIMEOUT = float(
+    get_setting('FILE_HANDLE_POOL_IDLE_TIMEOUT', 300))
+FILE_HANDLE_POOL_MAX_STATE_BYTES = int(
+    get_setting('FILE_HANDLE_POOL_MAX_STATE_BYTES', 256 * 1024 ** 2))
+HDF5_RDCC_NBYTES = int(get_setting('HDF5_RDCC_NBYTES', 4 * 1024 ** 2))
+HDF5_RDCC_NSLOTS = int(get_setting('HDF5_RDCC_NSLOTS', 521))
+HDF5_RDCC_W0 = float(get_setting('HDF5_RDCC_W0', 0.75))
+
+# Read HDF5 based tilesets registered as http(s) urls with range requests
+# instead of through the httpfs mount. Blocks of REMOTE_BLOCK_SIZE bytes are
+# cached in every worker (up to REMOTE_CACHE_MAX_BYTES) and, if
+# REMOTE_CACHE_DIR is set, on disk (up to REMOTE_CACHE_DIR_MAX_BYTES).
+# REMOTE_READ_AHEAD maps file extensions to [head bytes, blocks] to
+# override the read ahead policies in tilesets/range_reader.py
+REMOTE_RANGE_READER = get_setting('REMOTE_RANGE_READER', False)
+REMOTE_BLOCK_SIZE = int(get_setting('REMOTE_BLOCK_SIZE', 256 * 1024))
+REMOTE_CACHE_MAX_BYTES = int(
+    get_setting('REMOTE_CACHE_MAX_BYTES', 256 * 1024 ** 2))
+REMOTE_CACHE_DIR = get_setting('REMOTE_CACHE_DIR', '')
+REMOTE_CACHE_DIR_MAX_BYTES = int(
+    get_setting('REMOTE_CACHE_DIR_MAX_BYTES', 4 * 1024 ** 3))
+REMOTE_MAX_CONNECTIONS = int(get_setting('REMOTE_MAX_CONNECTIONS', 16))
+REMOTE_PREFETCH_WORKERS = int(get_setting('REMOTE_PREFETCH_WORKERS', 4))
+REMOTE_TIMEOUT = float(get_setting('REMOTE_TIMEOUT', 10))
+REMOTE_READ_AHEAD = get_setting('REMOTE_READ_AHEAD', {})
+if isinstance(REMOTE_READ_AHEAD, str):
+    REMOTE_READ_AHEAD = json.loads(REMOTE_READ_AHEAD)
+
+# How long (in seconds) a worker keeps using the metadata of a tileset
+# before reloading it from the database. Changes made through other workers
+# are picked up after TILESET_RESOLVER_CHECK_INTERVAL seconds if there's a
+# redis server or disk cache, and immediately in the same worker
+TILESET_RESOLVER_TTL = float(get_setting('TILESET_RESOLVER_TTL', 60))
+TILESET_RESOLVER_CHECK_INTERVAL = float(
+    get_setting('TILESET_RESOLVER_CHECK_INTERVAL', 1))
+
+# Recompute the tileset info stored in the database when the modification
+# time of a (local) data file changes
+TILESET_INFO_REVALIDATE = get_setting('TILESET_INFO_REVALIDATE', True)
+
+# Tile stores built with `manage.py build_tile_store` are kept in
+# TILE_STORE_DIR (empty to disable them)
+TILE_STORE_DIR = get_setting(
+    'TILE_STORE_DIR', os.path.join(MEDIA_ROOT, 'tile_stores'))
+
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.10/howto/static-files/
@@ -1,9 +1,429 @@
 import unittest
 import slugid
 import subprocess
+import tempfile
+import threading
+import time
 
+import higlass_server.cache as hc
+import higlass_server.disk_cache as hdc
+import higlass_server.utils as hu
 import tilesets.models as tm
 
+from unittest import mock
+from redis.exceptions import ConnectionError, TimeoutError
+
+
+class CountingRDB(hu.EmptyRDB):
+    '''
+    A dictionary backed stand-in for redis which counts round trips
+    '''
+    def __init__(self):
+        self.data = {}
+        self.expiries = {}
+        self.round_trips = 0
+
+    def get(self, name):
+        self.round_trips += 1
+        return self.data.get(name)
+
+    def mget(self, keys, *args):
+        self.round_trips += 1
+        return [self.data.get(k) for k in keys]
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        self.round_trips += 1
+        self.data[name] = value
+        self.expiries[name] = ex
+
+    def pipeline(self, transaction=True):
+        rdb = self
+
+        class Pipeline(hu.EmptyPipeline):
+            def __init__(self):
+                self.items = []
+
+            def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+                self.items.append((name, value, ex))
+                return self
+
+            def execute(self):
+                rdb.round_trips += 1
+                for name, value, ex in self.items:
+                    rdb.data[name] = value
+                    rdb.expiries[name] = ex
+                return [True] * len(self.items)
+
+        return Pipeline()
+
+
+class BatchedCacheTest(unittest.TestCase):
+    def test_round_trips(self):
+        rdb = CountingRDB()
+        cache = hc.BatchedCache(rdb)
+
+        cache.set_many([('k{}'.format(i), b'v') for i in range(200)], 60)
+        values = cache.get_many(['k0', 'k199', 'missing'])
+
+        self.assertEqual(values, [b'v', b'v', None])
+        self.assertEqual(rdb.round_trips, 2)
+
+    def test_empty_rdb(self):
+        cache = hc.BatchedCache(hu.EmptyRDB())
+        cache.set_many([('a', b'1')])
+
+        self.assertEqual(cache.get_many(['a', 'b']), [None, None])
+
+class LRUCacheTest(unittest.TestCase):
+    def test_byte_bound(self):
+        cache = hc.LRUCache(100)
+
+        cache.set('a', 1, 40)
+        cache.set('b', 2, 40)
+        cache.get('a')
+        cache.set('c', 3, 40)
+
+        # b was the least recently used entry
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.nbytes, 80)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_invalidate_prefix(self):
+        cache = hc.LRUCache(100)
+
+        cache.set('a.0.0', 1, 1)
+        cache.set('b.0.0', 2, 1)
+        cache.invalidate_prefix('a.')
+
+        self.assertEqual(cache.get('a.0.0'), None)
+        self.assertEqual(cache.get('b.0.0'), 2)
+
+    def test_tiered(self):
+        rdb = CountingRDB()
+        cache = hc.TieredCache(rdb, 1000, lambda x: x.decode('utf-8'),
+            lambda x: x.encode('utf-8'))
+
+        cache.set_many([('a', 'x'), ('b', 'y')])
+        self.assertEqual(rdb.data['a'], b'x')
+        self.assertEqual(cache.get_many(['a', 'b']), ['x', 'y'])
+        self.assertEqual(rdb.round_trips, 1)
+
+        # only the entries missing locally hit the shared cache
+        rdb.data['c'] = b'z'
+        self.assertEqual(cache.get_many(['a', 'c', 'd']), ['x', 'z', None])
+        self.assertEqual(rdb.round_trips, 2)
+
+    def test_channel_without_pubsub(self):
+        cache = hc.TieredCache(hu.EmptyRDB(), 1000, lambda x: x,
+            lambda x: x, channel='invalidations')
+
+        # the listener isn't retried with every lookup
+        with mock.patch.object(hc.logger, 'warning') as warning:
+            cache.get_many(['a'])
+            cache.get_many(['a'])
+            cache.invalidate_prefix('a')
+
+        self.assertEqual(warning.call_count, 0)
+        self.assertEqual(cache.channel, None)
+
+class TileCachePolicyTest(unittest.TestCase):
+    def test_ttl(self):
+        policy = hc.TileCachePolicy(60, {'cooler': 600, 'cooler:0': 0})
+
+        self.assertEqual(policy.ttl('beddb', 3), 60)
+        self.assertEqual(policy.ttl('cooler', 3), 600)
+        self.assertEqual(policy.ttl('cooler', 0), None)
+
+    def test_admission(self):
+        policy = hc.TileCachePolicy(min_cost=1, max_entry_bytes=1024 ** 2)
+
+        # 1 second per MB at least
+        self.assertTrue(policy.admit('cooler', 0.5, 1024 ** 2 // 2))
+        self.assertFalse(policy.admit('beddb', 0.001, 1024 ** 2 // 2))
+        self.assertFalse(policy.admit('cooler', 10, 1024 ** 2 + 1))
+
+        policy.count('cooler', 'hits', 3)
+        policy.count('cooler', 'misses')
+        stats = policy.stats()
+
+        self.assertEqual(stats['cooler']['hit_ratio'], 0.75)
+        self.assertEqual(stats['cooler']['admitted'], 1)
+        self.assertEqual(stats['cooler']['rejected'], 1)
+        self.assertEqual(stats['beddb']['rejected'], 1)
+
+    def test_put_many(self):
+        rdb = CountingRDB()
+        cache = hc.TieredCache(rdb, 1000, lambda x: x.decode('utf-8'),
+            lambda x: x.encode('utf-8'))
+        policy = hc.TileCachePolicy(0, {'cooler': 600}, min_cost=1)
+
+        cache.put_many([
+            ('a', 'x', 'cooler', 2, 1),
+            ('b', 'y', 'beddb', 2, 1),
+            ('c', 'z', 'beddb', 2, 0),
+        ], policy)
+
+        self.assertEqual(rdb.expiries, {'a': 600, 'b': None})
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), ['x', 'y', None])
+        self.assertEqual(rdb.round_trips, 2)
+
+    def test_derived_admission(self):
+        rdb = CountingRDB()
+        cache = hc.TieredCache(rdb, 100000, lambda x: x.decode('utf-8'),
+            lambda x: x.encode('utf-8'))
+        policy = hc.TileCachePolicy(min_cost=0, derived_min_cost=1)
+
+        # derived tiles have to be expensive to be cached
+        cache.put_many([
+            ('a', 'x' * 10000, 'multivec', 2, 0.001),
+            ('b', 'y' * 10000, 'multivec', 2, 0.001, True),
+            ('c', 'z' * 10000, 'multivec', 2, 1, True),
+        ], policy)
+
+        self.assertEqual(sorted(rdb.data), ['a', 'c'])
+        self.assertEqual(policy.stats()['multivec']['rejected'], 1)
+
+
+class FlakyRDB(CountingRDB):
+    '''
+    A stand-in for redis which can be made to time out and counts the
+    commands that reached it
+    '''
+    def __init__(self):
+        super().__init__()
+        self.down = False
+        self.calls = 0
+
+    def check(self):
+        self.calls += 1
+        if self.down:
+            raise TimeoutError('Timeout reading from socket')
+
+    def mget(self, keys, *args):
+        self.check()
+        return super().mget(keys, *args)
+
+    def ping(self):
+        self.check()
+        return True
+
+    def pipeline(self, transaction=True):
+        self.check()
+        return super().pipeline(transaction)
+
+
+class ResilientRDBTest(unittest.TestCase):
+    def test_circuit_breaker(self):
+        client = FlakyRDB()
+        rdb = hu.ResilientRDB(client, failure_threshold=2, retry_interval=0.01)
+        cache = hc.BatchedCache(rdb)
+
+        cache.set_many([('a', b'1')])
+        self.assertEqual(cache.get_many(['a']), [b'1'])
+        self.assertEqual(rdb.health()['state'], 'closed')
+
+        client.down = True
+        self.assertEqual(cache.get_many(['a']), [None])
+        cache.set_many([('a', b'2')])
+        self.assertEqual(rdb.health()['state'], 'open')
+
+        # redis is bypassed while the breaker is open
+        calls = client.calls
+        self.assertEqual(cache.get_many(['a', 'b']), [None, None])
+        self.assertEqual(client.calls, calls)
+
+        with self.assertRaises(ConnectionError):
+            rdb.pubsub()
+
+        client.down = False
+
+        for _ in range(100):
+            if rdb.health()['state'] == 'closed':
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(rdb.health()['state'], 'closed')
+        self.assertEqual(rdb.health()['times_opened'], 1)
+        self.assertEqual(cache.get_many(['a']), [b'1'])
+
+    def test_pool_exhausted(self):
+        pool = hu.PoolQueue(1)
+
+        with self.assertRaises(hu.PoolExhaustedError):
+            pool.get(timeout=0.01)
+
+        def command(client):
+            raise hu.PoolExhaustedError('No redis connection available')
+
+        rdb = hu.ResilientRDB(FlakyRDB(), failure_threshold=2)
+
+        # busy connections don't open the circuit breaker
+        for _ in range(3):
+            self.assertEqual(rdb.call(command, None), None)
+
+        self.assertEqual(rdb.health()['state'], 'closed')
+        self.assertEqual(rdb.health()['consecutive_failures'], 0)
+        self.assertEqual(rdb.health()['pool_exhausted'], 3)
+
+    def test_no_redis(self):
+        self.assertEqual(hu.getRdb().health(), {'state': 'disabled'})
+
+
+class DiskRDBTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_get_set(self):
+        rdb = hdc.DiskRDB(self.tmpdir.name, 10000, shards=4)
+        cache = hc.BatchedCache(rdb)
+
+        cache.set_many([('k{}'.format(i), b'v') for i in range(20)])
+        rdb.set('s', 'text')
+
+        self.assertEqual(cache.get_many(['k0', 'k19', 'x']), [b'v', b'v', None])
+        self.assertEqual(rdb.get('s'), b'text')
+        self.assertTrue(rdb.exists('k3'))
+
+        self.assertFalse(rdb.set('s', b'other', nx=True))
+        self.assertFalse(rdb.set('x', b'other', xx=True))
+        self.assertEqual(rdb.get('s'), b'text')
+
+        # entries are shared with other workers and survive restarts
+        rdb = hdc.DiskRDB(self.tmpdir.name, 10000, shards=4)
+        self.assertEqual(rdb.get('k7'), b'v')
+        self.assertEqual(rdb.health()['entries'], 21)
+        self.assertEqual(rdb.health()['bytes'], 24)
+
+    def test_expiry(self):
+        rdb = hdc.DiskRDB(self.tmpdir.name, 10000, shards=1)
+
+        rdb.set('a', b'1', px=1)
+        rdb.set('b', b'1', ex=60)
+        time.sleep(0.01)
+
+        self.assertEqual(rdb.mget(['a', 'b']), [None, b'1'])
+
+    def test_eviction(self):
+        rdb = hdc.DiskRDB(self.tmpdir.name, 300, shards=1, atime_interval=0)
+
+        for i in range(3):
+            rdb.set(str(i), b'x' * 100)
+
+        rdb.get('0')
+        rdb.set('3', b'x' * 100)
+
+        # 1 was the least recently used entry
+        self.assertEqual(rdb.mget(['0', '1', '2', '3']),
+            [b'x' * 100, None, b'x' * 100, b'x' * 100])
+        self.assertEqual(rdb.health()['bytes'], 300)
+
+        # replacing an entry doesn't count it twice
+        rdb.set('3', b'y' * 50)
+        self.assertEqual(rdb.health()['bytes'], 250)
+
+    def test_incr(self):
+        rdb = hdc.DiskRDB(self.tmpdir.name, 10000, shards=1)
+
+        self.assertEqual(rdb.incr('n'), 1)
+        self.assertEqual(rdb.incr('n', 2), 3)
+        self.assertEqual(rdb.get('n'), b'3')
+
+        rdb.set('e', b'1', px=1)
+        time.sleep(0.01)
+        self.assertEqual(rdb.incr('e'), 1)
+
+        rdb.set('s', b'text')
+        self.assertIsNone(rdb.incr('s'))
+        self.assertIsNone(hu.EmptyRDB().incr('n'))
+
+    def test_reads_without_writes(self):
+        rdb = hdc.DiskRDB(self.tmpdir.name, 10000, shards=1)
+        rdb.set('a', b'1')
+        conn = rdb._connection(0)
+        changes = conn.total_changes
+
+        self.assertEqual(rdb.mget(['a', 'b']), [b'1', None])
+        self.assertEqual(conn.total_changes, changes)
+
+        rdb.atime_interval = 0
+        self.assertEqual(rdb.get('a'), b'1')
+        self.assertEqual(conn.total_changes, changes + 1)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.rdb = hdc.DiskRDB(self.tmpdir.name, 10000, shards=2)
+        self.generated = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def generate(self, keys):
+        self.generated += keys
+        time.sleep(0.1)
+
+        for key in keys:
+            self.rdb.set(key, key.upper())
+
+        return dict((key, key.upper()) for key in keys)
+
+    def test_threads(self):
+        flight = hc.SingleFlight(self.rdb)
+        results = []
+
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                flight.run(['a', 'b'], self.generate, self.rdb.mget)))
+            for i in range(4)
+        ]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(self.generated), ['a', 'b'])
+        self.assertEqual(results, [{'a': 'A', 'b': 'B'}] * 4)
+        self.assertEqual(flight.stats()['local_waits'], 6)
+
+    def test_processes(self):
+        # another worker holds the lease of 'a' and caches its value
+        other = hc.SingleFlight(self.rdb)
+        flight = hc.SingleFlight(self.rdb, wait_timeout=2)
+
+        self.assertEqual(other._acquire(['a']), [True])
+
+        def finish():
+            time.sleep(0.1)
+            self.rdb.set('a', b'from other')
+            other._release(['a'])
+
+        threading.Thread(target=finish).start()
+
+        results = flight.run(['a', 'b'], self.generate, self.rdb.mget)
+
+        self.assertEqual(results, {'a': b'from other', 'b': 'B'})
+        self.assertEqual(self.generated, ['b'])
+        self.assertEqual(self.rdb.get(hc.SingleFlight.LEASE_PREFIX + 'b'), None)
+
+    def test_timeout(self):
+        flight = hc.SingleFlight(self.rdb, wait_timeout=0.1)
+
+        # a lease that isn't released
+        self.rdb.set(hc.SingleFlight.LEASE_PREFIX + 'a', b'1', ex=60)
+
+        results = flight.run(['a'], self.generate, self.rdb.mget)
+
+        self.assertEqual(results, {'a': 'A'})
+        self.assertEqual(flight.stats()['timeouts'], 1)
+
+
 class CommandlineTest(unittest.TestCase):
     def setUp(self):
         # TODO: There is probably a better way to clear data from previous test runs. Is it even necessary?
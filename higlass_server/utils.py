@@ -1,7 +1,27 @@
+import logging
+import os
+import queue
 import redis
+import threading
+import time
+
+import higlass_server.disk_cache as hdc
 import higlass_server.settings as hss
 
-from redis.exceptions import ConnectionError
+from redis.exceptions import ConnectionError, RedisError, TimeoutError
+
+logger = logging.getLogger(__name__)
+
+
+class EmptyPipeline:
+    def __init__(self):
+        pass
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        return self
+
+    def execute(self):
+        return []
 
 
 class EmptyRDB:
@@ -14,22 +34,326 @@ class EmptyRDB:
     def get(self, name):
         return None
 
+    def mget(self, keys, *args):
+        return [None] * len(keys)
+
     def set(self, name, value, ex=None, px=None, nx=False, xx=False):
         pass
 
+    def delete(self, *names):
+        return 0
 
-def getRdb():
-    if hss.REDIS_HOST is not None:
+    def incr(self, name, amount=1):
+        # there is nothing to share the counter with
+        return None
+
+    def pipeline(self, transaction=True):
+        return EmptyPipeline()
+
+    def health(self):
+        return {'state': 'disabled'}
+
+
+class CircuitBreaker:
+    '''
+    Counts consecutive failures of calls to a service and opens (i.e.
+    stops letting calls through) once there were `failure_threshold` of
+    them in a row. It's closed again by `success`.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+
+    def __init__(self, failure_threshold):
+        self.failure_threshold = failure_threshold
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.last_error = None
+        self.last_failure = None
+
+        self._lock = threading.Lock()
+
+    def allow(self):
+        return self.state == self.CLOSED
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def failure(self, error):
+        '''
+        Record a failed call. Returns True if this opened the breaker.
+        '''
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)
+            self.last_failure = time.time()
+
+            if self.state == self.CLOSED and self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened += 1
+                return True
+
+        return False
+
+
+class PoolExhaustedError(RedisError):
+    '''
+    No connection of the pool became free within REDIS_POOL_TIMEOUT
+    seconds. Redis itself is fine, so this isn't a failure for the
+    circuit breaker.
+    '''
+
+
+class PoolQueue(queue.LifoQueue):
+    '''
+    The queue of free connections of the redis connection pool, which
+    raises `PoolExhaustedError` instead of the ConnectionError raised by
+    the pool when waiting for a connection times out
+    '''
+    def get(self, block=True, timeout=None):
         try:
-            rdb = redis.Redis(
-                host=hss.REDIS_HOST,
-                port=hss.REDIS_PORT)
+            return super().get(block, timeout)
+        except queue.Empty:
+            raise PoolExhaustedError('No redis connection available')
+
+
+class ResilientPipeline:
+    '''
+    Buffers the commands of a pipeline and sends them when it's executed,
+    through `ResilientRDB` so that failures are handled like for single
+    commands
+    '''
+    def __init__(self, rdb, transaction):
+        self.rdb = rdb
+        self.transaction = transaction
+        self.commands = []
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        self.commands.append(('set', (name, value), {
+            'ex': ex, 'px': px, 'nx': nx, 'xx': xx
+        }))
+        return self
+
+    def execute(self):
+        if len(self.commands) == 0:
+            return []
+
+        def execute(client):
+            pipe = client.pipeline(transaction=self.transaction)
+
+            for name, args, kwargs in self.commands:
+                getattr(pipe, name)(*args, **kwargs)
+
+            return pipe.execute()
+
+        return self.rdb.call(execute, [])
+
+
+class ResilientRDB:
+    '''
+    A redis client for caches, which must never take a request down.
+
+    Commands don't raise: when redis fails or times out (see
+    REDIS_SOCKET_TIMEOUT) they return what an empty cache would. After
+    REDIS_FAILURE_THRESHOLD consecutive failures the circuit breaker
+    opens and commands return immediately without contacting redis. A
+    background thread then pings redis every REDIS_RETRY_INTERVAL
+    seconds and closes the breaker once it answers again. Connections
+    are only made when they're needed, so a worker started while redis
+    is down will start using it as soon as it comes back.
 
-            # Test server connection
-            rdb.ping()
+    Parameters
+    ----------
+    client: redis.Redis
+        The client used for commands, typically with socket timeouts
+    pubsub_client: redis.Redis or None
+        The client used for subscriptions, without a read timeout since
+        subscribers wait for messages indefinitely. Defaults to client
+    failure_threshold: int
+        The number of consecutive failures opening the circuit breaker
+    retry_interval: float
+        Seconds between reconnection attempts while it's open
+    '''
+    def __init__(self, client, pubsub_client=None, failure_threshold=5,
+                 retry_interval=5.):
+        self.client = client
+        self.pubsub_client = pubsub_client or client
+        self.retry_interval = retry_interval
+        self.breaker = CircuitBreaker(failure_threshold)
+        self.pool_exhausted = 0
 
-            return rdb
-        except ConnectionError:
-            return EmptyRDB()
-    else:
+        self._reconnecting = False
+        self._reconnect_lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def call(self, command, default):
+        '''
+        Run command(client) unless the circuit breaker is open
+
+        Parameters
+        ----------
+        command: function
+            Gets passed the redis client
+        default: object
+            Returned if the breaker is open or the command fails
+        '''
+        if not self.breaker.allow():
+            self._ensure_reconnecting()
+            return default
+
+        try:
+            result = command(self.client)
+        except PoolExhaustedError as ex:
+            # all connections are busy with other requests
+            logger.info(ex)
+            self.pool_exhausted += 1
+            return default
+        except (ConnectionError, TimeoutError, OSError) as ex:
+            logger.warning('Redis unavailable: %s', ex)
+
+            if self.breaker.failure(ex):
+                logger.warning('Bypassing redis until it is reachable again')
+                self._ensure_reconnecting()
+
+            return default
+        except RedisError as ex:
+            # redis is there but didn't like the command
+            logger.warning(ex)
+            return default
+
+        self.breaker.success()
+        return result
+
+    def get(self, name):
+        return self.call(lambda c: c.get(name), None)
+
+    def mget(self, keys, *args):
+        return self.call(lambda c: c.mget(keys, *args), [None] * len(keys))
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        return self.call(
+            lambda c: c.set(name, value, ex=ex, px=px, nx=nx, xx=xx), False)
+
+    def exists(self, name):
+        return self.call(lambda c: c.exists(name), False)
+
+    def delete(self, *names):
+        return self.call(lambda c: c.delete(*names), 0)
+
+    def incr(self, name, amount=1):
+        return self.call(lambda c: c.incr(name, amount), None)
+
+    def publish(self, channel, message):
+        return self.call(lambda c: c.publish(channel, message), 0)
+
+    def pipeline(self, transaction=True):
+        return ResilientPipeline(self, transaction)
+
+    def pubsub(self, **kwargs):
+        '''
+        Get a PubSub object. Raises a ConnectionError while the circuit
+        breaker is open.
+        '''
+        if not self.breaker.allow():
+            self._ensure_reconnecting()
+            raise ConnectionError('Redis is unavailable')
+
+        return self.pubsub_client.pubsub(**kwargs)
+
+    def health(self):
+        '''
+        The state of the connection to redis
+        '''
+        return {
+            'state': self.breaker.state,
+            'consecutive_failures': self.breaker.failures,
+            'times_opened': self.breaker.opened,
+            'last_error': self.breaker.last_error,
+            'last_failure': self.breaker.last_failure,
+            'reconnecting': self._reconnecting,
+            'pool_exhausted': self.pool_exhausted,
+        }
+
+    def _ensure_reconnecting(self):
+        with self._reconnect_lock:
+            if self._pid != os.getpid():
+                # the reconnecting thread belonged to the parent process
+                self._pid = os.getpid()
+                self._reconnecting = False
+
+            if self._reconnecting:
+                return
+
+            self._reconnecting = True
+
+        thread = threading.Thread(target=self._reconnect, daemon=True)
+        thread.start()
+
+    def _reconnect(self):
+        while True:
+            time.sleep(self.retry_interval)
+
+            try:
+                self.client.ping()
+            except Exception as ex:
+                self.breaker.failure(ex)
+                continue
+
+            logger.info('Redis is reachable again')
+            self.breaker.success()
+
+            with self._reconnect_lock:
+                self._reconnecting = False
+
+            return
+
+
+_rdb = None
+_rdb_lock = threading.Lock()
+
+
+def getRdb():
+    '''
+    Get the redis client shared by the caches of this process. Without a
+    redis server, a `DiskRDB` if a disk cache is configured and an
+    `EmptyRDB` otherwise.
+    '''
+    global _rdb
+
+    if hss.REDIS_HOST is None and not hss.DISK_CACHE_DIR:
         return EmptyRDB()
+
+    with _rdb_lock:
+        if _rdb is None and hss.REDIS_HOST is None:
+            _rdb = hdc.DiskRDB(
+                hss.DISK_CACHE_DIR,
+                hss.DISK_CACHE_MAX_BYTES,
+                shards=hss.DISK_CACHE_SHARDS,
+                atime_interval=hss.DISK_CACHE_ATIME_INTERVAL,
+            )
+        elif _rdb is None:
+            client = redis.Redis(connection_pool=redis.BlockingConnectionPool(
+                host=hss.REDIS_HOST,
+                port=hss.REDIS_PORT,
+                max_connections=hss.REDIS_MAX_CONNECTIONS,
+                timeout=hss.REDIS_POOL_TIMEOUT,
+                queue_class=PoolQueue,
+                socket_timeout=hss.REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=hss.REDIS_CONNECT_TIMEOUT,
+            ))
+            pubsub_client = redis.Redis(
+                host=hss.REDIS_HOST,
+                port=hss.REDIS_PORT,
+                socket_connect_timeout=hss.REDIS_CONNECT_TIMEOUT,
+            )
+
+            _rdb = ResilientRDB(
+                client,
+                pubsub_client,
+                failure_threshold=hss.REDIS_FAILURE_THRESHOLD,
+                retry_interval=hss.REDIS_RETRY_INTERVAL,
+            )
+
+        return _rdb
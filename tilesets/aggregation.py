@@ -0,0 +1,186 @@
+'''
+Aggregation of the rows of multivec tiles into groups (the aggGroups and
+aggFunc tileset options).
+
+The groups are compiled once into a plan: a sparse (groups x rows)
+matrix with a 1 for every row of every group, and the row indices of all
+groups concatenated with the offset at which every group starts. A tile
+is then aggregated over all groups at once, with a product of the
+matrix and the tile for sums, means and variances, and with one
+reduction over the rows of every group padded to the size of the largest
+group for minima and maxima, instead of one copy and one reduction per
+group. Plans are kept in a per-worker cache keyed by the
+options hash of the tileset options, so they're shared by all tiles and
+requests with the same options.
+'''
+import collections as col
+import json
+
+import numpy as np
+import scipy.sparse as ss
+
+import higlass_server.cache as hc
+
+# the reductions computed for all groups at once, the others go through
+# `AGG_FUNCS` group by group
+VECTORIZED_FUNCS = {'sum', 'mean', 'std', 'var', 'max', 'min'}
+
+AGG_FUNCS = {
+    'sum': lambda x: np.sum(x, axis=0),
+    'mean': lambda x: np.mean(x, axis=0),
+    'median': lambda x: np.median(x, axis=0),
+    'std': lambda x: np.std(x, axis=0),
+    'var': lambda x: np.var(x, axis=0),
+    'max': lambda x: np.amax(x, axis=0),
+    'min': lambda x: np.amin(x, axis=0),
+}
+
+PLAN_CACHE_MAX_BYTES = 16 * 1024 ** 2
+
+# minima and maxima are computed group by group when padding the groups
+# would make them this many times larger (which is faster than reduceat)
+MAX_PADDING = 4
+
+AggPlan = col.namedtuple(
+    'AggPlan', ['groups', 'rows', 'starts', 'counts', 'matrix', 'padded'])
+
+plans = hc.LRUCache(PLAN_CACHE_MAX_BYTES)
+
+
+def compile_groups(agg_groups):
+    '''
+    Compile aggGroups into an aggregation plan
+
+    Parameters
+    ----------
+    agg_groups: [[int,...] or int,...]
+        The rows of every group (a single row can be given as an int)
+
+    Returns
+    -------
+    plan: AggPlan
+        The groups as lists, the rows of all groups concatenated, the
+        index of the first row of every group in them, the number of
+        rows in every group, the matrix summing the rows of every
+        group and the rows of every group padded to the same number
+        (the latter two are None if they aren't used)
+    '''
+    groups = [g if isinstance(g, list) else [g] for g in agg_groups]
+    counts = np.array([len(g) for g in groups], dtype=np.intp)
+    starts = np.zeros(len(groups), dtype=np.intp)
+    np.cumsum(counts[:-1], out=starts[1:])
+
+    rows = np.fromiter(
+        (row for g in groups for row in g), dtype=np.intp, count=counts.sum())
+
+    matrix = None
+    padded = None
+
+    # empty groups and rows counted from the end go group by group
+    if len(groups) and counts.all() and rows.min() >= 0:
+        matrix = ss.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32),
+                (np.repeat(np.arange(len(groups)), counts), rows)),
+            shape=(len(groups), rows.max() + 1))
+
+        if len(groups) * counts.max() <= MAX_PADDING * len(rows):
+            # repeating the first row of a group doesn't change its
+            # minimum or maximum
+            padded = np.repeat(rows[starts], counts.max()).reshape(
+                len(groups), -1)
+            padded[np.arange(counts.max()) < counts[:, np.newaxis]] = rows
+
+    return AggPlan(groups, rows, starts, counts, matrix, padded)
+
+
+def plan_nbytes(plan):
+    nbytes = plan.rows.nbytes + plan.starts.nbytes + plan.counts.nbytes
+
+    if plan.padded is not None:
+        nbytes += plan.padded.nbytes
+
+    if plan.matrix is not None:
+        nbytes += (plan.matrix.data.nbytes + plan.matrix.indices.nbytes
+            + plan.matrix.indptr.nbytes)
+
+    return nbytes
+
+
+def get_plan(tileset_options):
+    '''
+    The (cached) aggregation plan of the aggGroups in tileset options
+    '''
+    key = tileset_options.get('options_hash')
+
+    if key is None:
+        key = json.dumps(tileset_options['aggGroups'])
+
+    plan = plans.get(key)
+
+    if plan is None:
+        plan = compile_groups(tileset_options['aggGroups'])
+        plans.set(key, plan, plan_nbytes(plan))
+
+    return plan
+
+
+def aggregate(dense, plan, agg_func_name):
+    '''
+    Aggregate the rows of a tile into groups
+
+    Parameters
+    ----------
+    dense: np.array
+        The data of the tile (rows x tile_size)
+    plan: AggPlan
+        The groups (see `compile_groups`)
+    agg_func_name: str
+        One of the keys of `AGG_FUNCS`
+
+    Returns
+    -------
+    dense: np.array
+        The aggregated data (groups x tile_size), the same as applying the
+        function to the rows of every group
+    '''
+    agg_func = AGG_FUNCS[agg_func_name]
+    matrix = plan.matrix
+
+    if (agg_func_name not in VECTORIZED_FUNCS or matrix is None
+            or not np.issubdtype(dense.dtype, np.floating)
+            or (agg_func_name in ('max', 'min') and plan.padded is None)):
+        return np.array([agg_func(dense[g]) for g in plan.groups])
+
+    if matrix.shape[1] > len(dense):
+        raise IndexError('Aggregation group row {} is out of bounds for a '
+            'tile with {} rows'.format(matrix.shape[1] - 1, len(dense)))
+
+    if agg_func_name == 'max':
+        return np.amax(dense[plan.padded], axis=1)
+    if agg_func_name == 'min':
+        return np.amin(dense[plan.padded], axis=1)
+
+    rows = dense[:matrix.shape[1]]
+    counts = plan.counts[:, np.newaxis]
+
+    # the matrix is float32, so half precision data is summed in single
+    # precision and cast back like the group by group results
+    sums = matrix @ rows
+
+    if agg_func_name == 'sum':
+        return sums.astype(dense.dtype, copy=False)
+
+    means = sums / counts.astype(sums.dtype)
+
+    if agg_func_name == 'mean':
+        return means.astype(dense.dtype, copy=False)
+
+    # E[x^2] - E[x]^2 in double precision, where it doesn't lose much
+    rows = rows.astype(np.float64)
+    means = (matrix @ rows) / counts
+    variances = np.maximum((matrix @ (rows * rows)) / counts - means * means, 0)
+
+    if agg_func_name == 'std':
+        variances = np.sqrt(variances)
+
+    return variances.astype(dense.dtype)
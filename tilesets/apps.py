@@ -1,7 +1,27 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class TilesetsConfig(AppConfig):
     name = 'tilesets'
+
+    def ready(self):
+        import tilesets.chromsizes as tcs
+        import tilesets.generate_tiles as tgt
+        import tilesets.models as tm
+        import tilesets.resolver as tsr
+
+        post_save.connect(tsr.tileset_changed, sender=tm.Tileset,
+            dispatch_uid='tileset_resolver_save')
+        post_delete.connect(tsr.tileset_changed, sender=tm.Tileset,
+            dispatch_uid='tileset_resolver_delete')
+        post_save.connect(tgt.tileset_saved, sender=tm.Tileset,
+            dispatch_uid='tileset_info_save')
+        post_delete.connect(tgt.tileset_saved, sender=tm.Tileset,
+            dispatch_uid='tileset_info_delete')
+        post_save.connect(tcs.tileset_changed, sender=tm.Tileset,
+            dispatch_uid='chromsizes_save')
+        post_delete.connect(tcs.tileset_changed, sender=tm.Tileset,
+            dispatch_uid='chromsizes_delete')
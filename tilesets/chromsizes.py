@@ -1,8 +1,18 @@
+import clodius.tiles.bigbed as hgbb
+import clodius.tiles.bigwig as hgbi
+import clodius.tiles.fasta as hgfa
 import csv
 import h5py
+import json
 import logging
 import numpy as np
 import pandas as pd
+import threading
+import time
+
+import higlass_server.settings as hss
+import tilesets.models as tm
+import tilesets.resolver as tsr
 
 from fragments.utils import get_cooler
 
@@ -107,3 +117,179 @@ def get_tsv_chromsizes(filename):
 
         raise Exception(err_msg)
 
+
+class ChromSizes(object):
+    '''
+    The parsed chromosome sizes of a tileset along with the payloads of
+    the chrom-sizes endpoint.
+
+    Attributes
+    ----------
+    names: np.array
+        The chromosome names
+    sizes: np.array
+        The chromosome sizes (int64)
+    offsets: np.array
+        The position of the start of every chromosome in the
+        concatenated genome (int64)
+    chromsizes: [[name:string, size:int], ...]
+        The chromosome names and sizes as passed to the tile readers
+    tsv: bytes
+        The sizes as tab separated values
+    json: bytes
+        The sizes as a JSON object ({name: {size: size}})
+    cum_json: bytes
+        The sizes and offsets as a JSON object
+        ({name: {size: size, offset: offset}})
+    '''
+    def __init__(self, rows):
+        rows = [(row[0], row[1]) for row in rows]
+
+        self.names = np.array([str(name) for name, size in rows], dtype=object)
+        self.sizes = np.array([int(size) for name, size in rows], dtype=np.int64)
+        self.offsets = np.cumsum(self.sizes) - self.sizes
+
+        self.chromsizes = [
+            [name, int(size)] for name, size in zip(self.names, self.sizes)
+        ]
+
+        self.tsv = ''.join(
+            '{}\t{}\n'.format(name, size) for name, size in rows
+        ).encode('utf-8')
+        self.json = json.dumps({
+            name: {'size': int(size)} for name, size in zip(self.names, self.sizes)
+        }).encode('utf-8')
+        self.cum_json = json.dumps({
+            name: {'size': int(size), 'offset': int(offset)}
+            for name, size, offset in zip(self.names, self.sizes, self.offsets)
+        }).encode('utf-8')
+
+
+def read_chromsizes(tileset):
+    '''
+    Read the chromosome sizes of a tileset from its data file.
+
+    Parameters
+    ----------
+    tileset: tilesets.models.Tileset or tilesets.resolver.TilesetRecord
+        A chromsizes-tsv, bigwig, bigbed, fasta, cooler or multivec
+        tileset
+
+    Returns
+    -------
+    chromsizes: ChromSizes
+        The parsed chromosome sizes (empty for other filetypes)
+    '''
+    path = tileset.datafile.path
+
+    if tileset.filetype == 'bigwig':
+        rows = hgbi.chromsizes(path)
+    elif tileset.filetype == 'fasta':
+        rows = hgfa.chromsizes(path)
+    elif tileset.filetype == 'bigbed':
+        rows = hgbb.chromsizes(path)
+    elif tileset.filetype == 'cooler':
+        rows = get_cooler_chromsizes(path)
+    elif tileset.filetype == 'chromsizes-tsv':
+        rows = get_tsv_chromsizes(path)
+    elif tileset.filetype == 'multivec':
+        rows = get_multivec_chromsizes(path)
+    else:
+        rows = []
+
+    return ChromSizes(rows)
+
+
+class ChromSizesRegistry(object):
+    '''
+    The parsed chromosome sizes of tilesets, keyed by tileset uuid and by
+    coordSystem (for the tile readers, which look up the chromsizes
+    tileset of a coordSystem).
+
+    Entries are dropped when a tileset they depend on is saved or deleted
+    in this process (see `tilesets.apps`) and expire after
+    TILESET_RESOLVER_TTL seconds.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_uuid = {}
+        self._uuid_by_coord_system = {}
+
+    def _fresh(self, entry):
+        return entry is not None and entry[1] > time.monotonic()
+
+    def for_tileset(self, tileset):
+        '''
+        Get the chromosome sizes of a tileset (see `read_chromsizes`)
+        '''
+        entry = self._by_uuid.get(tileset.uuid)
+
+        if not self._fresh(entry):
+            entry = (read_chromsizes(tileset),
+                time.monotonic() + hss.TILESET_RESOLVER_TTL)
+
+            with self._lock:
+                self._by_uuid[tileset.uuid] = entry
+
+        return entry[0]
+
+    def for_coord_system(self, coord_system):
+        '''
+        Get the chromosome sizes of the chromsizes tileset of a
+        coordSystem.
+
+        Returns
+        -------
+        chromsizes: ChromSizes or None
+            None if there isn't exactly one chromsizes tileset with
+            this coordSystem
+        '''
+        if coord_system is None:
+            return None
+
+        entry = self._uuid_by_coord_system.get(coord_system)
+
+        if not self._fresh(entry):
+            uuids = list(tm.Tileset.objects.filter(
+                coordSystem=coord_system, datatype='chromsizes'
+            ).values_list('uuid', flat=True)[:2])
+
+            entry = (uuids[0] if len(uuids) == 1 else None,
+                time.monotonic() + hss.TILESET_RESOLVER_TTL)
+
+            with self._lock:
+                self._uuid_by_coord_system[coord_system] = entry
+
+        if entry[0] is None:
+            return None
+
+        tileset = tsr.get(entry[0])
+
+        if tileset is None:
+            return None
+
+        return self.for_tileset(tileset)
+
+    def invalidate(self, uuid=None):
+        '''
+        Drop the chromosome sizes of a tileset, and all coordSystem
+        lookups, or everything if no uuid is given
+        '''
+        with self._lock:
+            if uuid is None:
+                self._by_uuid.clear()
+            else:
+                self._by_uuid.pop(uuid, None)
+
+            self._uuid_by_coord_system.clear()
+
+
+registry = ChromSizesRegistry()
+
+
+def tileset_changed(sender, instance, **kwargs):
+    '''
+    Receiver for the post_save and post_delete signals of Tileset
+    '''
+    if instance.datatype == 'chromsizes' or instance.uuid in registry._by_uuid:
+        registry.invalidate(instance.uuid)
@@ -0,0 +1,381 @@
+'''
+Warm state of the coolers in cooler files.
+
+Opening a `cooler.Cooler` and querying it reads the chromosome table, the
+bin table and the whole `indexes/bin1_offset` array from the file every
+time, and balancing joins the pixels with the whole bin table. The state
+of a cooler (one resolution of a multi-resolution file) is read once per
+pooled handle instead:
+
+    with fh.borrow(path) as f:
+        state = tco.get_state(path, 'resolutions/1000')
+        bin1, bin2, counts = tco.fetch_pixels(state, i0, i1, j0, j1)
+
+It holds the chromosome offsets and lengths, the balancing weights as a
+contiguous array and the bin1 index of the pixel table, so that pixel
+queries read only the pixels they return and balancing is an indexing
+operation. The state is dropped together with the handle it was read
+from, or before if the states of the pool take up too much memory (see
+`fh.state`).
+'''
+import collections as col
+
+import cooler
+import numpy as np
+
+import tilesets.file_handles as fh
+
+BINS_PER_TILE = 256
+
+# the most pixels read at once for the windows of `fetch_pixels_many`
+MAX_SPAN_PIXELS = 2 ** 24
+
+# transforms with divisive weights, tiles with these are still read by
+# clodius
+DIVISIVE_TRANSFORMS = ('KR', 'VC', 'VC_SQRT')
+
+CoolerState = col.namedtuple('CoolerState', [
+    'cooler', 'root', 'resolution', 'chromnames', 'chromsizes',
+    'chrom_offsets', 'chrom_cum_lengths', 'nbins', 'weights',
+    'bin1_offset', 'pixels'])
+
+
+def load(group, root='/'):
+    '''
+    Read the state of the cooler in an HDF5 group
+
+    Parameters
+    ----------
+    group: h5py.Group
+        The group of the cooler (e.g. `f['resolutions/1000']`)
+    root: str
+        The path of the group in its file
+
+    Returns
+    -------
+    state: CoolerState
+        The Cooler, its bin size (None for variable bins), chromosome
+        names and sizes, the index of the first bin of every chromosome,
+        the cumulative chromosome lengths, the number of bins, the
+        balancing weights (None if there are none), the index of the
+        first pixel of every bin1 and the pixel table
+    '''
+    c = cooler.Cooler(group)
+    chromsizes = c.chromsizes
+    weights = None
+
+    if 'weight' in group['bins']:
+        weights = np.ascontiguousarray(group['bins/weight'][:])
+
+    return CoolerState(
+        cooler=c,
+        root=root,
+        resolution=c.binsize,
+        chromnames=list(chromsizes.index),
+        chromsizes=chromsizes,
+        chrom_offsets=group['indexes/chrom_offset'][:].astype(np.int64),
+        chrom_cum_lengths=np.r_[0, np.cumsum(chromsizes.values, dtype=np.int64)],
+        nbins=int(c.info['nbins']),
+        weights=weights,
+        bin1_offset=group['indexes/bin1_offset'][:].astype(np.int64),
+        pixels=group['pixels'],
+    )
+
+
+def nbytes(state):
+    '''
+    The size of the arrays held by a state
+    '''
+    arrays = [state.chrom_offsets, state.chrom_cum_lengths, state.weights,
+        state.bin1_offset]
+
+    return sum(a.nbytes for a in arrays if a is not None)
+
+
+def get_state(path, root, kind='h5', opener=None, closer=None):
+    '''
+    The (cached) state of the cooler at `root` in the pooled handle of
+    a file. The handle should be borrowed while the pixels are read.
+    '''
+    root = '/' + root.strip('/')
+
+    return fh.state(
+        path, 'cooler:{}'.format(root),
+        lambda f: load(f[root], root), kind, opener, closer, nbytes)
+
+
+def bin_at(state, abs_pos):
+    '''
+    The id of the bin containing a genome position, `nbins` past the
+    end of the genome (see `clodius.tiles.cooler.abs_coord_2_bin`)
+    '''
+    chrom_id = np.searchsorted(state.chrom_cum_lengths, abs_pos, 'right') - 1
+
+    if chrom_id >= len(state.chromnames):
+        return state.nbins
+
+    rel_pos = abs_pos - state.chrom_cum_lengths[chrom_id]
+
+    return int(state.chrom_offsets[chrom_id] + rel_pos // state.resolution)
+
+
+def genome_starts(state, bins):
+    '''
+    The genome positions of the starts of bins
+    '''
+    chrom_ids = np.searchsorted(state.chrom_offsets[:-1], bins, 'right') - 1
+
+    return (state.chrom_cum_lengths[chrom_ids]
+        + (bins - state.chrom_offsets[chrom_ids]) * state.resolution)
+
+
+def fetch_pixels(state, i0, i1, j0, j1, field='count'):
+    '''
+    The stored pixels with a bin1 in [i0, i1) and a bin2 in [j0, j1), in
+    the order of the pixel table. Same as
+    `c.matrix(as_pixels=True, balance=False)[i0:i1, j0:j1]`.
+
+    Returns
+    -------
+    pixels: (np.array, np.array, np.array)
+        The bin1 ids, bin2 ids and values of the pixels
+    '''
+    i1 = min(i1, state.nbins)
+
+    if i0 >= i1 or j0 >= j1:
+        dtype = state.pixels[field].dtype
+        return (np.zeros(0, np.int64), np.zeros(0, np.int64),
+            np.zeros(0, dtype))
+
+    offsets = state.bin1_offset[i0:i1 + 1]
+    lo, hi = offsets[0], offsets[-1]
+
+    bin1 = np.repeat(np.arange(i0, i1, dtype=np.int64), np.diff(offsets))
+    bin2 = state.pixels['bin2_id'][lo:hi].astype(np.int64)
+    values = state.pixels[field][lo:hi]
+
+    in_range = (bin2 >= j0) & (bin2 < j1)
+
+    return bin1[in_range], bin2[in_range], values[in_range]
+
+
+def fetch_pixels_many(state, windows, field='count',
+        max_span_pixels=MAX_SPAN_PIXELS):
+    '''
+    The stored pixels of many windows, each the same as
+    `fetch_pixels(state, *window)`.
+
+    The windows are sorted by their first row and the windows whose rows
+    overlap or touch are merged into spans of at most `max_span_pixels`
+    pixels (unless a single window has more). The pixels of every span
+    are read once and the pixels of all of its windows are picked out of
+    them with one search over the (row, column) keys of the span.
+
+    Parameters
+    ----------
+    state: CoolerState
+        The cooler
+    windows: [(i0, i1, j0, j1),...]
+        The bin1 range [i0, i1) and bin2 range [j0, j1) of every window
+        (without negative bins)
+
+    Returns
+    -------
+    pixels: [(np.array, np.array, np.array),...]
+        The bin1 ids, bin2 ids and values of the pixels of every window
+    '''
+    nbins = state.nbins
+    windows = np.array(windows, dtype=np.int64).reshape(-1, 4)
+    i0, j0 = windows[:, 0], np.minimum(windows[:, 2], nbins)
+    i1, j1 = np.minimum(windows[:, 1], nbins), np.minimum(windows[:, 3], nbins)
+
+    empty = (np.zeros(0, np.int64), np.zeros(0, np.int64),
+        np.zeros(0, state.pixels[field].dtype))
+    pixels = [empty] * len(windows)
+
+    spans = []
+
+    for k in np.argsort(i0, kind='stable'):
+        if i0[k] >= i1[k] or j0[k] >= j1[k]:
+            continue
+
+        if spans and i0[k] <= spans[-1][1]:
+            lo, hi, span_windows = spans[-1]
+            hi = max(hi, i1[k])
+
+            if (state.bin1_offset[hi] - state.bin1_offset[lo]
+                    <= max_span_pixels):
+                spans[-1] = (lo, hi, span_windows + [k])
+                continue
+
+        spans.append((i0[k], i1[k], [k]))
+
+    for lo, hi, span_windows in spans:
+        offsets = state.bin1_offset[lo:hi + 1]
+        p0, p1 = offsets[0], offsets[-1]
+
+        bin2 = state.pixels['bin2_id'][p0:p1].astype(np.int64)
+        values = state.pixels[field][p0:p1]
+
+        # the pixels are sorted by row and then by column
+        keys = np.repeat(np.arange(hi - lo, dtype=np.int64) * nbins,
+            np.diff(offsets)) + bin2
+
+        # every row of every window
+        span_windows = np.array(span_windows)
+        num_rows = i1[span_windows] - i0[span_windows]
+        row_windows = np.repeat(span_windows, num_rows)
+        rows = (np.arange(num_rows.sum())
+            - np.repeat(np.cumsum(num_rows) - num_rows, num_rows)
+            + i0[row_windows])
+
+        # the pixels of the columns of its window in every row
+        row_keys = (rows - lo) * nbins
+        starts = np.searchsorted(keys, row_keys + j0[row_windows])
+        counts = np.searchsorted(keys, row_keys + j1[row_windows]) - starts
+
+        indices = (np.arange(counts.sum())
+            + np.repeat(starts - (np.cumsum(counts) - counts), counts))
+        window_bin1 = np.repeat(rows, counts)
+
+        bounds = np.cumsum(np.add.reduceat(
+            counts, np.cumsum(num_rows) - num_rows))[:-1]
+
+        for k, bin1_k, indices_k in zip(span_windows,
+                np.split(window_bin1, bounds), np.split(indices, bounds)):
+            pixels[k] = (bin1_k, bin2[indices_k], values[indices_k])
+
+    return pixels
+
+
+def can_make_tiles(state, transform_type):
+    '''
+    Whether `make_tiles` can read tiles with this transform from a cooler
+    (the others are read by `clodius.tiles.cooler.make_tiles`)
+    '''
+    return (state.resolution is not None
+        and transform_type not in DIVISIVE_TRANSFORMS
+        and not (transform_type == 'weight' and state.weights is None))
+
+
+def make_tiles(state, x_pos, y_pos, transform_type='default', x_width=1,
+        y_width=1):
+    '''
+    Generate the tiles of a rectangle of a cooler. Same as
+    `clodius.tiles.cooler.make_tiles` for the transforms accepted by
+    `can_make_tiles`.
+
+    Parameters
+    ----------
+    state: CoolerState
+        The cooler of the zoom level of the tiles
+    x_pos, y_pos: int
+        The position of the first tile
+    transform_type: str
+        'default' and 'weight' balance the counts if there are weights
+    x_width, y_width: int
+        The number of tiles along each dimension
+
+    Returns
+    -------
+    data_by_tilepos: {(x_pos, y_pos): np.array}
+        The data of every tile
+    '''
+    resolution = state.resolution
+    tile_size = resolution * BINS_PER_TILE
+
+    start1 = x_pos * tile_size
+    end1 = (x_pos + x_width) * tile_size
+    start2 = y_pos * tile_size
+    end2 = (y_pos + y_width) * tile_size
+
+    balanced = (transform_type in ('default', 'weight')
+        and state.weights is not None)
+
+    i0, i1 = bin_at(state, start1), bin_at(state, end1 - 1)
+    j0, j1 = bin_at(state, start2), bin_at(state, end2 - 1)
+
+    if i0 >= state.nbins or j0 >= state.nbins:
+        # past the end of the genome, only the bins past the end are NaN
+        bin1 = bin2 = np.zeros(0, np.int64)
+        values = np.zeros(0)
+        nan_bins1 = nan_bins2 = np.zeros(0, np.int64)
+        mark_nans = True
+    else:
+        i1 = min(i1, state.nbins - 1)
+        j1 = min(j1, state.nbins - 1)
+
+        bin1, bin2, values = fetch_pixels(state, i0, i1 + 1, j0, j1 + 1)
+        mark_nans = balanced
+
+        if balanced:
+            weights = state.weights
+            values = values * weights[bin1] * weights[bin2]
+
+            bins1 = np.arange(i0, i1 + 1)
+            bins2 = np.arange(j0, j1 + 1)
+            nan_bins1 = bins1[np.isnan(weights[bins1])]
+            nan_bins2 = bins2[np.isnan(weights[bins2])]
+
+    values = np.nan_to_num(values)
+
+    # the tile and the row and column in it of every pixel
+    cols = (genome_starts(state, bin1) - start1) // resolution
+    rows = (genome_starts(state, bin2) - start2) // resolution
+    tile_x, cols = np.divmod(cols, BINS_PER_TILE)
+    tile_y, rows = np.divmod(rows, BINS_PER_TILE)
+
+    in_tiles = (
+        (tile_x >= 0) & (tile_x < x_width) & (tile_y >= 0) & (tile_y < y_width))
+    tile_x, tile_y = tile_x[in_tiles], tile_y[in_tiles]
+    rows, cols, values = rows[in_tiles], cols[in_tiles], values[in_tiles]
+
+    # a stable sort keeps the order of the pixels in every tile, which
+    # decides which one is kept where pixels fall on the same cell
+    keys = tile_x * y_width + tile_y
+    order = np.argsort(keys, kind='stable')
+    bounds = np.searchsorted(
+        keys[order], np.arange(x_width * y_width + 1), 'left')
+
+    if mark_nans:
+        total_length = int(state.chrom_cum_lengths[-1])
+        nan_cols = (genome_starts(state, nan_bins1) - start1) // resolution
+        nan_rows = (genome_starts(state, nan_bins2) - start2) // resolution
+
+    data_by_tilepos = {}
+
+    for x_offset in range(x_width):
+        for y_offset in range(y_width):
+            key = x_offset * y_width + y_offset
+            in_tile = order[bounds[key]:bounds[key + 1]]
+
+            out = np.zeros((BINS_PER_TILE, BINS_PER_TILE), dtype=np.float32)
+            out[rows[in_tile], cols[in_tile]] = values[in_tile]
+
+            if mark_nans:
+                tile_start1 = start1 + x_offset * tile_size
+                tile_start2 = start2 + y_offset * tile_size
+
+                for nan_bins, axis, offset, tile_start in (
+                        (nan_cols, 1, x_offset, tile_start1),
+                        (nan_rows, 0, y_offset, tile_start2)):
+                    nan_bins = nan_bins - offset * BINS_PER_TILE
+                    nan_bins = nan_bins[
+                        (nan_bins >= 0) & (nan_bins < BINS_PER_TILE)]
+
+                    # the bins past the end of the genome
+                    past_end = (np.arange(total_length,
+                        tile_start + tile_size, resolution) - tile_start
+                        ) // resolution
+                    past_end = past_end[past_end >= 0]
+
+                    if axis == 1:
+                        out[:, nan_bins] = np.nan
+                        out[:, past_end] = np.nan
+                    else:
+                        out[nan_bins, :] = np.nan
+                        out[past_end, :] = np.nan
+
+            data_by_tilepos[(x_pos + x_offset, y_pos + y_offset)] = out.ravel()
+
+    return data_by_tilepos
@@ -0,0 +1,294 @@
+'''
+A per-worker pool of open data file handles.
+
+Tile and snippet readers borrow handles from the pool instead of opening
+the data files for every tile or request:
+
+    with fh.borrow(path) as f:
+        data = hdft.get_data(f, z, x)
+
+Handles are keyed by kind (how the file is opened) and path. At most
+FILE_HANDLE_POOL_MAX_OPEN handles are kept open, the least recently used
+idle ones are closed first and handles that haven't been used for
+FILE_HANDLE_POOL_IDLE_TIMEOUT seconds are closed as well. Handles that
+are borrowed are never closed. States derived from the handles whose size
+is known (see `HandlePool.state`) are dropped, least recently used first,
+when they take up more than FILE_HANDLE_POOL_MAX_STATE_BYTES. The pool is
+emptied in forked children (e.g. uWSGI workers) so that they don't share
+handles with the parent.
+'''
+import collections as col
+import contextlib
+import h5py
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import higlass_server.settings as hss
+import tilesets.range_reader as trr
+
+logger = logging.getLogger(__name__)
+
+
+def open_h5(path):
+    # remote files are read with range requests if enabled
+    source = trr.open_remote(path) or path
+
+    return h5py.File(
+        source, 'r',
+        rdcc_nbytes=hss.HDF5_RDCC_NBYTES,
+        rdcc_nslots=hss.HDF5_RDCC_NSLOTS,
+        rdcc_w0=hss.HDF5_RDCC_W0,
+    )
+
+
+def open_sqlite(path):
+    # connections are shared by the threads of a worker, sqlite serializes
+    # access to them
+    return sqlite3.connect(
+        'file:{}?mode=ro'.format(path), uri=True, check_same_thread=False)
+
+
+def close_handle(handle):
+    close = getattr(handle, 'close', None)
+
+    if close is not None:
+        close()
+
+
+OPENERS = {
+    'h5': (open_h5, close_handle),
+    'sqlite': (open_sqlite, close_handle),
+}
+
+
+class _Entry(object):
+    __slots__ = ('handle', 'close', 'borrowed', 'last_used', 'state')
+
+    def __init__(self, handle, close):
+        self.handle = handle
+        self.close = close
+        self.borrowed = 0
+        self.last_used = time.monotonic()
+        # objects derived from the handle, e.g. tileset info
+        self.state = {}
+
+
+class HandlePool(object):
+    '''
+    Open file handles keyed by (kind, path).
+
+    Parameters
+    ----------
+    max_open: int
+        The maximum number of idle handles kept open
+    idle_timeout: float
+        Close handles that haven't been used for this many seconds
+    max_state_bytes: int
+        The maximum total size of the sized states of the handles (0 for
+        no limit)
+    '''
+    def __init__(self, max_open, idle_timeout, max_state_bytes=0):
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.max_state_bytes = max_state_bytes
+        self.state_nbytes = 0
+
+        self._lock = threading.RLock()
+        self._entries = col.OrderedDict()
+        self._sized_states = col.OrderedDict()
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._after_fork()
+
+    def _after_fork(self):
+        # the handles belong to the parent process, forget them
+        # without closing them
+        self._lock = threading.RLock()
+        self._entries = col.OrderedDict()
+        self._sized_states = col.OrderedDict()
+        self.state_nbytes = 0
+        self._pid = os.getpid()
+
+    def _close(self, key, entry):
+        for name in entry.state:
+            self._forget_state(key + (name,))
+
+        try:
+            entry.close(entry.handle)
+        except Exception as e:
+            logger.warning('Error closing %s: %s', key[1], e)
+
+    def _evict(self):
+        '''
+        Close the idle handles that timed out and then the least recently
+        used ones until at most max_open handles are open. Must be called
+        with the lock held.
+        '''
+        now = time.monotonic()
+        to_close = [
+            key for key, entry in self._entries.items()
+            if entry.borrowed == 0 and now - entry.last_used > self.idle_timeout
+        ]
+
+        excess = len(self._entries) - len(to_close) - self.max_open
+
+        for key, entry in self._entries.items():
+            if excess <= 0:
+                break
+            if entry.borrowed == 0 and key not in to_close:
+                to_close.append(key)
+                excess -= 1
+
+        for key in to_close:
+            self._close(key, self._entries.pop(key))
+
+    def _acquire(self, path, kind, opener, closer):
+        key = (kind, path)
+
+        with self._lock:
+            self._check_pid()
+
+            entry = self._entries.get(key)
+
+            if entry is None:
+                if opener is None:
+                    opener, closer = OPENERS[kind]
+                entry = _Entry(opener(path), closer or close_handle)
+                self._entries[key] = entry
+            else:
+                self._entries.move_to_end(key)
+
+            entry.borrowed += 1
+
+        return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry.borrowed -= 1
+            entry.last_used = time.monotonic()
+
+            self._evict()
+
+    @contextlib.contextmanager
+    def borrow(self, path, kind='h5', opener=None, closer=None):
+        '''
+        Borrow an open handle for a file.
+
+        Parameters
+        ----------
+        path: str
+            The path of the file
+        kind: str
+            How the file is opened, one of OPENERS unless an opener is
+            passed
+        opener: function or None
+            A function opening the file given its path, for kinds which
+            aren't in OPENERS
+        closer: function or None
+            A function closing the handle returned by opener
+
+        Returns
+        -------
+        handle: object
+            The open handle. It must not be closed by the borrower
+        '''
+        entry = self._acquire(path, kind, opener, closer)
+
+        try:
+            yield entry.handle
+        finally:
+            self._release(entry)
+
+    def state(self, path, name, compute, kind='h5', opener=None, closer=None,
+            nbytes=None):
+        '''
+        Get an object derived from an open handle (e.g. the tileset info
+        of a file), computing it with `compute(handle)` if it isn't known
+        yet. It's dropped together with the handle.
+
+        If `nbytes(state)` returns the size of the object, it counts
+        towards `max_state_bytes` and may be dropped before the handle.
+        '''
+        entry = self._acquire(path, kind, opener, closer)
+        state_key = (kind, path, name)
+
+        try:
+            if name in entry.state:
+                with self._lock:
+                    if state_key in self._sized_states:
+                        self._sized_states.move_to_end(state_key)
+
+                return entry.state[name]
+
+            value = compute(entry.handle)
+            entry.state[name] = value
+
+            if nbytes is not None:
+                with self._lock:
+                    self._forget_state(state_key)
+                    self._sized_states[state_key] = (entry, nbytes(value))
+                    self.state_nbytes += self._sized_states[state_key][1]
+                    self._evict_states()
+
+            return value
+        finally:
+            self._release(entry)
+
+    def _forget_state(self, state_key):
+        '''
+        Stop counting the size of a state. Must be called with the lock
+        held.
+        '''
+        sized = self._sized_states.pop(state_key, None)
+
+        if sized is not None:
+            self.state_nbytes -= sized[1]
+
+    def _evict_states(self):
+        '''
+        Drop the least recently used sized states, but the last one, until
+        they fit into max_state_bytes. Must be called with the lock held.
+        '''
+        while (
+            self.max_state_bytes > 0 and
+            self.state_nbytes > self.max_state_bytes and
+            len(self._sized_states) > 1
+        ):
+            state_key, (entry, nbytes) = self._sized_states.popitem(last=False)
+            entry.state.pop(state_key[2], None)
+            self.state_nbytes -= nbytes
+
+    def close(self, path=None):
+        '''
+        Close the idle handles for a path (e.g. when its tileset is
+        deleted) or all idle handles if no path is given
+        '''
+        with self._lock:
+            self._check_pid()
+
+            for key in list(self._entries.keys()):
+                if path is not None and key[1] != path:
+                    continue
+                if self._entries[key].borrowed == 0:
+                    self._close(key, self._entries.pop(key))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+pool = HandlePool(
+    hss.FILE_HANDLE_POOL_MAX_OPEN,
+    hss.FILE_HANDLE_POOL_IDLE_TIMEOUT,
+    hss.FILE_HANDLE_POOL_MAX_STATE_BYTES
+)
+
+borrow = pool.borrow
+state = pool.state
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=pool._after_fork)
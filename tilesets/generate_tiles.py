@@ -1,5 +1,6 @@
-import base64
 #import tilesets.bigwig_tiles as bwt
+import base64
+import clodius.array as cta
 import clodius.db_tiles as cdt
 import clodius.hdf_tiles as hdft
 import collections as col
@@ -8,27 +9,50 @@ import clodius.tiles.bam as ctb
 import clodius.tiles.beddb as hgbe
 import clodius.tiles.bigwig as hgbi
 import clodius.tiles.fasta as hgfa
+import clodius.tiles.format as hgfo
 import clodius.tiles.bigbed as hgbb
 import clodius.tiles.cooler as hgco
 import clodius.tiles.geo as hggo
 import clodius.tiles.imtiles as hgim
+import clodius.tiles.time_interval as ctti
 
-import h5py
+import concurrent.futures as cf
+import django.db as db
+import django.db.models as dbm
 import itertools as it
+import json
+import logging
+import math
 import numpy as np
 import os
 import os.path as op
-import shutil
 import time
-import tempfile
+import urllib.request
+import tilesets.aggregation as tagg
 import tilesets.models as tm
 import tilesets.chromsizes  as tcs
+import tilesets.cooler_state as tco
+import tilesets.file_handles as fh
+import tilesets.mirror as tmi
+import tilesets.resolver as tsr
+import tilesets.tile_encoding as tte
+import tilesets.tile_store as tts
 
 import higlass.tilesets as hgti
 
 import clodius.tiles.multivec as ctmu
 
+import higlass_server.cache as hc
 import higlass_server.settings as hss
+import higlass_server.utils as hu
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    # python < 3.8, tiles are pickled back from the worker processes
+    shared_memory = None
+
+logger = logging.getLogger(__name__)
 
 def get_tileset_datatype(tileset):
     '''
@@ -60,33 +84,28 @@ def get_cached_datapath(path):
     Returns
     -------
     filename: str
-        Either the cached filename if we're caching or the original
-        filename
+        The path of the copy in the cache directory if there is a complete
+        one and the original filename otherwise. The file is copied in the
+        background if it's accessed frequently (see `tilesets.mirror`)
     '''
-    if hss.CACHE_DIR is None:
-        # no caching requested
-        return path
-
-    orig_path = path
-    cached_path = op.join(hss.CACHE_DIR, path)
-
-    if op.exists(cached_path):
-        # this file has already been cached
-        return cached_path
-
-    with tempfile.TemporaryDirectory() as dirpath:
-        tmp = op.join(dirpath, 'cached_file')
-        shutil.copyfile(orig_path, tmp)
-
-        # check to make sure the destination directory exists
-        dest_dir = op.dirname(cached_path)
+    return tmi.get_path(path)
 
-        if not op.exists(dest_dir):
-            os.makedirs(dest_dir)
+def mirrored(tileset):
+    '''
+    Get a tileset record whose data and index file paths point to their
+    copies in the cache directory if there are any (see
+    `get_cached_datapath`). Model instances are returned as they are.
+    '''
+    if tmi.mirror is None or not isinstance(tileset, tsr.TilesetRecord):
+        return tileset
 
-        shutil.move(tmp, cached_path)
+    datafile = tileset.datafile
+    indexfile = tileset.indexfile
 
-    return cached_path
+    return tileset._replace(
+        datafile=datafile._replace(path=get_cached_datapath(datafile.path)),
+        indexfile=indexfile._replace(path=get_cached_datapath(indexfile.path)),
+    )
 
 def extract_tileset_uid(tile_id):
     '''
@@ -130,18 +149,16 @@ def generate_1d_tiles(filename, tile_ids, get_data_function, tileset_options):
     Returns
     -------
     tile_list: [(tile_id, tile_data),...]
-        A list of tile_id, tile_data tuples
+        A list of tile_id, tile_data tuples. The dense data is left
+        as a numpy array and encoded when the response is serialized
+        (see `tilesets.tile_encoding`)
     '''
 
-    agg_func_map = {
-        "sum": lambda x: np.sum(x, axis=0),
-        "mean": lambda x: np.mean(x, axis=0),
-        "median": lambda x: np.median(x, axis=0),
-        "std": lambda x: np.std(x, axis=0),
-        "var": lambda x: np.var(x, axis=0),
-        "max": lambda x: np.amax(x, axis=0),
-        "min": lambda x: np.amin(x, axis=0),
-    }
+    agg_plan = None
+
+    if tileset_options != None and "aggGroups" in tileset_options and "aggFunc" in tileset_options:
+        agg_func_name = tileset_options["aggFunc"]
+        agg_plan = tagg.get_plan(tileset_options)
 
     generated_tiles = []
 
@@ -151,39 +168,11 @@ def generate_1d_tiles(filename, tile_ids, get_data_function, tileset_options):
 
         dense = get_data_function(filename, tile_position)
 
-        if tileset_options != None and "aggGroups" in tileset_options and "aggFunc" in tileset_options:
-            agg_func_name = tileset_options["aggFunc"]
-            agg_group_arr = [ x if type(x) == list else [x] for x in tileset_options["aggGroups"] ]
-            dense = np.array(list(map(agg_func_map[agg_func_name], [ dense[arr] for arr in agg_group_arr ])))
-        
-        if len(dense):
-            max_dense = max(dense.reshape(-1,))
-            min_dense = min(dense.reshape(-1,))
-        else:
-            max_dense = 0
-            min_dense = 0
+        if agg_plan is not None:
+            dense = tagg.aggregate(dense, agg_plan, agg_func_name)
 
-        min_f16 = np.finfo('float16').min
-        max_f16 = np.finfo('float16').max
-
-        has_nan = len([d for d in dense.reshape((-1,)) if np.isnan(d)]) > 0
-
-        if (
-            not has_nan and
-            max_dense > min_f16 and max_dense < max_f16 and
-            min_dense > min_f16 and min_dense < max_f16
-        ):
-            tile_value = {
-                'dense': base64.b64encode(dense.reshape((-1,)).astype('float16')).decode('utf-8'),
-                'dtype': 'float16',
-                'shape': dense.shape
-            }
-        else:
-            tile_value = {
-                'dense': base64.b64encode(dense.reshape((-1,)).astype('float32')).decode('utf-8'),
-                'dtype': 'float32',
-                'shape': dense.shape
-            }
+        tile_value = tte.encode_dense(dense)
+        tile_value['shape'] = dense.shape
 
         generated_tiles += [(tile_id, tile_value)]
 
@@ -205,78 +194,407 @@ def get_chromsizes(tileset):
         None if no chromsizes tileset with this coordSystem
         exists or if two exist with this coordSystem.
     '''
-    if tileset.coordSystem is None or len(tileset.coordSystem) == None:
+    chromsizes = tcs.registry.for_coord_system(tileset.coordSystem)
+
+    if chromsizes is None:
+        return None
+
+    return chromsizes.chromsizes
+
+def generate_tileset_info(tileset):
+    '''
+    Compute the tileset info of a tileset from its data file.
+
+    Parameters
+    ----------
+    tileset: tilesets.models.Tileset or tilesets.resolver.TilesetRecord
+        The tileset to compute the info for
+
+    Returns
+    -------
+    tileset_info: dict
+        The filetype specific tileset info (without the name, datatype
+        and coordSystems of the tileset) or a dict with an 'error' entry
+    '''
+    tileset = mirrored(tileset)
+
+    if (
+        tileset.filetype == 'hitile' or
+        tileset.filetype == 'hibed'
+    ):
+        with fh.borrow(tileset.datafile.path) as f:
+            hdf_info = hdft.get_tileset_info(f)
+        tileset_info = {
+            "min_pos": [int(hdf_info['min_pos'])],
+            "max_pos": [int(hdf_info['max_pos'])],
+            "max_width": 2 ** math.ceil(
+                math.log(
+                    hdf_info['max_pos'] - hdf_info['min_pos']
+                ) / math.log(2)
+            ),
+            "tile_size": int(hdf_info['tile_size']),
+            "max_zoom": int(hdf_info['max_zoom'])
+        }
+    elif tileset.filetype == 'bigwig':
+        chromsizes = get_chromsizes(tileset)
+        tsinfo = hgbi.tileset_info(
+                tileset.datafile.path,
+                chromsizes
+            )
+        #print('tsinfo:', tsinfo)
+        if 'chromsizes' in tsinfo:
+            tsinfo['chromsizes'] = [(c, int(s)) for c,s in tsinfo['chromsizes']]
+        tileset_info = tsinfo
+    elif tileset.filetype == 'chromsizes-tsv':
+        chromsizes = get_chromsizes(tileset)
+        tileset_info = {
+            'chromsizes': [(c, int(s)) for c,s in chromsizes]
+        }
+    elif tileset.filetype == 'fasta':
+        chromsizes = get_chromsizes(tileset)
+        tsinfo = hgfa.tileset_info(
+                tileset.datafile.path,
+                chromsizes
+            )
+        #print('tsinfo:', tsinfo)
+        if 'chromsizes' in tsinfo:
+            tsinfo['chromsizes'] = [(c, int(s)) for c,s in tsinfo['chromsizes']]
+        tileset_info = tsinfo
+        tileset_info['max_tile_width'] = hss.MAX_FASTA_TILE_WIDTH
+    elif tileset.filetype == 'bigbed':
+        chromsizes = get_chromsizes(tileset)
+        tsinfo = hgbi.tileset_info(
+                tileset.datafile.path,
+                chromsizes
+            )
+        #print('tsinfo:', tsinfo)
+        if 'chromsizes' in tsinfo:
+            tsinfo['chromsizes'] = [(c, int(s)) for c,s in tsinfo['chromsizes']]
+        tileset_info = tsinfo
+    elif tileset.filetype == 'multivec':
+        tileset_info = ctmu.tileset_info(
+                tileset.datafile.path)
+    elif tileset.filetype == "elastic_search":
+        response = urllib.request.urlopen(
+            tileset.datafile.name + "/tileset_info")
+        tileset_info = json.loads(response.read())
+    elif tileset.filetype == 'beddb':
+        tileset_info = cdt.get_tileset_info(
+            tileset.datafile.path
+        )
+    elif tileset.filetype == 'bed2ddb':
+        tileset_info = cdt.get_2d_tileset_info(
+            tileset.datafile.path
+        )
+    elif tileset.filetype == 'cooler':
+        with borrow_cooler(tileset.datafile.path):
+            tileset_info = hgco.tileset_info(
+                    tileset.datafile.path
+            )
+    elif tileset.filetype == 'time-interval-json':
+        tileset_info = ctti.tileset_info(
+                tileset.datafile.path
+        )
+    elif (
+        tileset.filetype == '2dannodb' or
+        tileset.filetype == 'imtiles'
+    ):
+        tileset_info = hgim.get_tileset_info(
+            tileset.datafile.path
+        )
+    elif tileset.filetype == 'geodb':
+        tileset_info = hggo.tileset_info(
+            tileset.datafile.path
+        )
+    elif tileset.filetype == 'bam':
+        tileset_info = ctb.tileset_info(
+            tileset.datafile.path
+        )
+        tileset_info['max_tile_width'] = hss.MAX_BAM_TILE_WIDTH
+    else:
+        # Unknown filetype
+        tileset_info = {
+            'error': 'Unknown filetype ' + tileset.filetype
+        }
+
+    return tileset_info
+
+def is_remote(tileset):
+    '''
+    Whether the data of this tileset lives on another server (e.g. it was
+    registered as a url and is read through httpfs)
+    '''
+    return (
+        tileset.filetype == 'elastic_search' or
+        tileset.datafile.name.startswith(('http/', 'https/', 'ftp/'))
+    )
+
+def get_datafile_mtime(tileset):
+    '''
+    The modification time of the data file of a tileset or None if it
+    isn't a local file
+    '''
+    if is_remote(tileset):
         return None
 
     try:
-        chrom_info_tileset = tm.Tileset.objects.get(coordSystem=tileset.coordSystem,
-                datatype='chromsizes')
-    except:
+        return op.getmtime(tileset.datafile.path)
+    except (OSError, TypeError, ValueError):
+        # missing file or no local path
         return None
 
-    return tcs.get_tsv_chromsizes(chrom_info_tileset.datafile.path)
+def materialize_tileset_info(tileset):
+    '''
+    Compute the tileset info of a tileset and store it in the database
+    along with the modification time of its data file. Errors aren't
+    stored.
 
-def generate_hitile_tiles(tileset, tile_ids):
+    Parameters
+    ----------
+    tileset: tilesets.models.Tileset or tilesets.resolver.TilesetRecord
+        The tileset to compute the info for
+
+    Returns
+    -------
+    tileset_info: dict
+        The computed tileset info
     '''
-    Generate tiles from a hitile file.
+    mtime = get_datafile_mtime(tileset)
+    tileset_info = generate_tileset_info(tileset)
+
+    if 'error' not in tileset_info:
+        tm.Tileset.objects.filter(uuid=tileset.uuid).update(
+            tileset_info=json.dumps(tileset_info),
+            tileset_info_mtime=mtime
+        )
+        tsr.invalidate(tileset.uuid)
+
+    return tileset_info
+
+def try_materialize_tileset_info(tileset):
+    '''
+    Like `materialize_tileset_info` but only logs errors, for use right
+    after a tileset was added. The tileset info is then computed on its
+    first request.
+    '''
+    try:
+        return materialize_tileset_info(tileset)
+    except Exception as e:
+        logger.warning('Unable to compute the tileset info of %s: %s',
+            tileset.uuid, e)
+
+def get_tileset_info(tileset):
+    '''
+    Get the tileset info of a tileset, from the database if it was stored
+    and the data file hasn't been modified since (see
+    TILESET_INFO_REVALIDATE) and from the data file otherwise.
+
+    Parameters
+    ----------
+    tileset: tilesets.models.Tileset or tilesets.resolver.TilesetRecord
+        The tileset to get the info for
+
+    Returns
+    -------
+    tileset_info: dict
+        The filetype specific tileset info
+    '''
+    if tileset.tileset_info is not None:
+        if (
+            not hss.TILESET_INFO_REVALIDATE or
+            is_remote(tileset) or
+            get_datafile_mtime(tileset) == tileset.tileset_info_mtime
+        ):
+            return json.loads(tileset.tileset_info)
+
+    return materialize_tileset_info(tileset)
+
+def tileset_saved(sender, instance, **kwargs):
+    '''
+    Receiver for the post_save and post_delete signals of Tileset. Drops
+    the stored tileset info which may depend on the changed tileset: its
+    own and, for chromsizes, that of the tilesets in its coordSystem.
+    '''
+    tilesets = tm.Tileset.objects.filter(uuid=instance.uuid)
+
+    if instance.datatype == 'chromsizes' and instance.coordSystem:
+        tilesets = tm.Tileset.objects.filter(
+            dbm.Q(uuid=instance.uuid) | dbm.Q(coordSystem=instance.coordSystem))
+
+    tilesets.exclude(tileset_info=None).update(
+        tileset_info=None, tileset_info_mtime=None)
+
+    if instance.datatype == 'chromsizes':
+        tsr.invalidate()
+        tsr.publish_generations(tilesets.values_list('uuid', flat=True))
+    else:
+        tsr.invalidate(instance.uuid)
+
+def read_tile_runs(tile_ids, read_run, read_tile):
+    '''
+    Read 1D tiles with one call per run of adjacent tiles at the same
+    zoom level rather than one per tile
 
     Parameters
     ----------
-    tileset: tilesets.models.Tileset object
-        The tileset that the tile ids should be retrieved from
     tile_ids: [str,...]
         A list of tile_ids (e.g. xyx.0.0) identifying the tiles
         to be retrieved
+    read_run: function
+        Called with the zoom level, position of the first tile and
+        number of tiles of every run. Returns the data of the tiles.
+    read_tile: function
+        Called with the zoom level and position of the tiles outside
+        of their zoom level, which are read one by one
 
     Returns
     -------
     tile_list: [(tile_id, tile_data),...]
         A list of tile_id, tile_data tuples
     '''
-    generated_tiles = []
+    runs = tile_rectangles(tile_ids, dimension=1, max_waste=0,
+        in_bounds=lambda zoom, position: 0 <= position[0] <= 2 ** zoom)
+
+    tiles = []
+    read = set()
+
+    for run in runs:
+        x = run.start[0]
+
+        for i, tile_data in enumerate(read_run(run.zoom, x, run.end[0] - x + 1)):
+            tile_id = run.tile_ids.get((x + i,))
+
+            if tile_id is not None:
+                tiles.append((tile_id, tile_data))
+
+        read.update(run.tile_ids.values())
 
     for tile_id in tile_ids:
-        tile_id_parts = tile_id.split('.')
-        tile_position = list(map(int, tile_id_parts[1:3]))
+        if tile_id not in read:
+            tile_id_parts = tile_id.split('.')
+            tiles.append((tile_id,
+                read_tile(int(tile_id_parts[1]), int(tile_id_parts[2]))))
 
-        dense = hdft.get_data(
-            h5py.File(
-                tileset.datafile.path
-            ),
-            tile_position[0],
-            tile_position[1]
-        )
+    return tiles
+
+def _hitile_meta(f):
+    '''
+    The tile size, zoom step, max zoom and max position of an open hitile
+    file
+    '''
+    d = f['meta']
 
-        if len(dense):
-            max_dense = max(dense)
-            min_dense = min(dense)
-        else:
-            max_dense = 0
-            min_dense = 0
+    tile_size = int(d.attrs['tile-size'])
+    max_zoom = int(d.attrs['max-zoom'])
 
-        min_f16 = np.finfo('float16').min
-        max_f16 = np.finfo('float16').max
+    if 'max-position' in d.attrs:
+        max_position = int(d.attrs['max-position'])
+    else:
+        max_position = tile_size * 2 ** max_zoom
 
-        has_nan = len([d for d in dense if np.isnan(d)]) > 0
+    return tile_size, int(d.attrs['zoom-step']), max_zoom, max_position
 
-        if (
-            not has_nan and
-            max_dense > min_f16 and max_dense < max_f16 and
-            min_dense > min_f16 and min_dense < max_f16
-        ):
-            tile_value = {
-                'dense': base64.b64encode(dense.astype('float16')).decode('utf-8'),
-                'dtype': 'float16'
-            }
-        else:
-            tile_value = {
-                'dense': base64.b64encode(dense.astype('float32')).decode('utf-8'),
-                'dtype': 'float32'
-            }
+def get_hitile_data(f, meta, z, x, num_tiles):
+    '''
+    Read adjacent tiles from a hitile file with one slice of its values
+    (and NaN counts). Same as calling `clodius.hdf_tiles.get_data` for
+    every tile.
 
-        generated_tiles += [(tile_id, tile_value)]
+    Parameters
+    ----------
+    f: h5py.File
+        The open hitile file
+    meta: tuple
+        Its tile size, zoom step, max zoom and max position (see
+        `_hitile_meta`)
+    z: int
+        The zoom level of the tiles
+    x: int
+        The position of the first tile
+    num_tiles: int
+        The number of tiles
 
-    return generated_tiles
+    Returns
+    -------
+    tiles: [np.array,...]
+        The data of the tiles
+    '''
+    tile_size, zoom_step, max_zoom, max_position = meta
+
+    # only some of the zoom levels are stored, the others are aggregated
+    rz = max_zoom - z
+    next_stored_zoom = zoom_step * math.floor(rz / zoom_step)
+    num_to_agg = 2 ** (rz - next_stored_zoom)
+    total_in_length = tile_size * num_to_agg
+    max_position = int(max_position / 2 ** next_stored_zoom)
+
+    run_start = x * total_in_length
+    run_end = run_start + num_tiles * total_in_length
+
+    values = f['values_' + str(int(next_stored_zoom))][run_start:run_end]
+
+    nan_name = 'nan_values_' + str(int(next_stored_zoom))
+    nan_values = f[nan_name][run_start:run_end] if nan_name in f else None
+
+    tiles = []
+
+    for i in range(num_tiles):
+        offset = i * total_in_length
+        start_pos = run_start + offset
+        end_pos = start_pos + total_in_length
+
+        a = values[offset:offset + total_in_length]
+
+        if start_pos > max_position:
+            # a tile after the last bit of data
+            a = np.full(total_in_length, np.nan)
+        elif start_pos < max_position and max_position < end_pos:
+            # indexed like clodius does
+            a = a.copy()
+            a[max_position + 1:end_pos] = np.nan
+
+        dense = cta.aggregate(a, num_to_agg)
+
+        if nan_values is not None:
+            nan_array = cta.aggregate(
+                nan_values[offset:offset + total_in_length], num_to_agg)
+            dense = dense / (2 ** (max_zoom - z) - nan_array)
+
+        tiles.append(dense)
+
+    return tiles
+
+def generate_hitile_tiles(tileset, tile_ids):
+    '''
+    Generate tiles from a hitile file. Adjacent tiles are read together
+    (see `get_hitile_data`).
+
+    Parameters
+    ----------
+    tileset: tilesets.models.Tileset object
+        The tileset that the tile ids should be retrieved from
+    tile_ids: [str,...]
+        A list of tile_ids (e.g. xyx.0.0) identifying the tiles
+        to be retrieved
+
+    Returns
+    -------
+    tile_list: [(tile_id, tile_data),...]
+        A list of tile_id, tile_data tuples. The dense data is left
+        as a numpy array and encoded when the response is serialized
+        (see `tilesets.tile_encoding`)
+    '''
+    path = tileset.datafile.path
+
+    with fh.borrow(path) as f:
+        meta = fh.state(path, 'hitile_meta', _hitile_meta)
+
+        tiles = read_tile_runs(
+            tile_ids,
+            lambda z, x, num_tiles: get_hitile_data(f, meta, z, x, num_tiles),
+            lambda z, x: hdft.get_data(f, z, x))
+
+    return [(tile_id, tte.encode_dense(dense)) for tile_id, dense in tiles]
 
 def generate_bed2ddb_tiles(tileset, tile_ids, retriever=cdt.get_2d_tiles):
     '''
@@ -297,49 +615,86 @@ def generate_bed2ddb_tiles(tileset, tile_ids, retriever=cdt.get_2d_tiles):
     '''
     generated_tiles = []
 
-    tile_ids_by_zoom = bin_tiles_by_zoom(tile_ids).values()
-    partitioned_tile_ids = list(it.chain(*[partition_by_adjacent_tiles(t)
-        for t in tile_ids_by_zoom]))
+    # only the tiles in bounds for their zoom level
+    rectangles = tile_rectangles(tile_ids,
+        in_bounds=lambda zoom, position: max(position) < 2 ** zoom)
 
-    for tile_group in partitioned_tile_ids:
-        zoom_level = int(tile_group[0].split('.')[1])
-        tileset_id = tile_group[0].split('.')[0]
+    for rectangle in rectangles:
+        start, end = rectangle.start, rectangle.end
 
-        tile_positions = [[int(x) for x in t.split('.')[2:4]] for t in tile_group]
+        tile_data_by_position = retriever(
+                tileset.datafile.path,
+                rectangle.zoom,
+                start[0], start[1],
+                end[0] - start[0] + 1,
+                end[1] - start[1] + 1
+            )
 
-        # filter for tiles that are in bounds for this zoom level
-        tile_positions = list(filter(lambda x: x[0] < 2 ** zoom_level, tile_positions))
-        tile_positions = list(filter(lambda x: x[1] < 2 ** zoom_level, tile_positions))
+        for position, tile_data in tile_data_by_position.items():
+            tile_id = rectangle.tile_ids.get(tuple(position))
 
-        if len(tile_positions) == 0:
-            # no in bounds tiles
-            continue
+            if tile_id is not None:
+                generated_tiles.append((tile_id, tile_data))
 
-        minx = min([t[0] for t in tile_positions])
-        maxx = max([t[0] for t in tile_positions])
+    return generated_tiles
 
-        miny = min([t[1] for t in tile_positions])
-        maxy = max([t[1] for t in tile_positions])
+def _compare_start(a, b):
+    return int(a[0]) - int(b[0])
 
-        cached_datapath = get_cached_datapath(tileset.datafile.path)
-        tile_data_by_position = retriever(
-                cached_datapath,
-                zoom_level,
-                minx, miny,
-                maxx - minx + 1,
-                maxy - miny + 1
-            )
+def get_hibed_data(f, z, x, num_tiles):
+    '''
+    Read adjacent tiles from a hibed file with one slice of its entries.
+    Same as calling `clodius.hdf_tiles.get_discrete_data` for every tile.
 
-        tiles = [(".".join(map(str, [tileset_id] + [zoom_level] + list(position))), tile_data)
-                for (position, tile_data) in tile_data_by_position.items()]
+    Parameters
+    ----------
+    f: h5py.File
+        The open hibed file
+    z: int
+        The zoom level of the tiles
+    x: int
+        The position of the first tile
+    num_tiles: int
+        The number of tiles
 
-        generated_tiles += tiles
+    Returns
+    -------
+    tiles: [np.array,...]
+        The entries of every tile
+    '''
+    d = f['meta']
+    tile_size = int(d.attrs['tile-size'])
+    max_zoom = int(d.attrs['max-zoom'])
 
-    return generated_tiles
+    entries = f[str(z)]
+
+    tile_width = tile_size * 2 ** (max_zoom - z)
+    run_start = x * tile_width
+    run_end = run_start + num_tiles * tile_width
+
+    # the entries are sorted by their start
+    block = entries[
+        hdft.bisect_left(entries, [run_start], comparator=_compare_start):
+        hdft.bisect_right(entries, [run_end], comparator=_compare_start)]
+    starts = np.array([int(entry[0]) for entry in block], dtype=np.int64)
+
+    tiles = []
+
+    for i in range(num_tiles):
+        tile_start = run_start + i * tile_width
+        tile_end = tile_start + tile_width
+
+        # entries starting at the end of a tile are in the next one too
+        tiles.append(block[
+            np.searchsorted(starts, tile_start, side='left'):
+            np.searchsorted(starts, tile_end, side='right')])
+
+    return tiles
 
 def generate_hibed_tiles(tileset, tile_ids):
     '''
-    Generate tiles from a hibed file.
+    Generate tiles from a hibed file. Adjacent tiles are read together
+    (see `get_hibed_data`).
 
     Parameters
     ----------
@@ -354,21 +709,309 @@ def generate_hibed_tiles(tileset, tile_ids):
     generated_tiles: [(tile_id, tile_data),...]
         A list of tile_id, tile_data tuples
     '''
+    with fh.borrow(tileset.datafile.path) as f:
+        tiles = read_tile_runs(
+            tile_ids,
+            lambda z, x, num_tiles: get_hibed_data(f, z, x, num_tiles),
+            lambda z, x: hdft.get_discrete_data(f, z, x))
+
+    return [
+        (tile_id, {'discrete': list([list([x.decode('utf-8') for x in d]) for d in dense])})
+        for tile_id, dense in tiles
+    ]
+
+def _multivec_info(f):
+    '''
+    The resolutions, tile size, tile shape and chromsizes of an open
+    multivec file (see `clodius.tiles.multivec.tileset_info`)
+    '''
+    resolutions = sorted([int(r) for r in f['resolutions'].keys()])[::-1]
+    tile_size = int(f['info'].attrs['tile-size'])
+    first_chrom = f['chroms']['name'][0]
+
+    shape = list(f['resolutions'][str(resolutions[0])]['values'][first_chrom].shape)
+    shape[0] = tile_size
+
+    chromsizes = list(zip(f['chroms']['name'], f['chroms']['length']))
+
+    return resolutions, tile_size, shape, chromsizes
+
+def get_multivec_tile(filename, tile_pos):
+    '''
+    Retrieve a single multivec tile using a pooled file handle. Same as
+    `clodius.tiles.multivec.get_single_tile` but without reopening the
+    file and recomputing its tileset info for every tile.
+
+    Parameters
+    ----------
+    filename: str
+        The multires file containing the multivec data
+    tile_pos: (z, x)
+        The zoom level and position of this tile
+
+    Returns
+    -------
+    dense: np.array
+        The data of the tile (rows x tile_size)
+    '''
+    with fh.borrow(filename) as f:
+        resolutions, tile_size, shape, chromsizes = fh.state(
+            filename, 'multivec_info', _multivec_info)
+
+        resolution = resolutions[tile_pos[0]]
+
+        # where in the data does the tile start and end
+        tile_start = tile_pos[1] * tile_size * resolution
+        tile_end = tile_start + tile_size * resolution
+
+        dense = ctmu.get_tile(f, chromsizes, resolution, tile_start, tile_end, shape)
+
+    if len(dense) < tile_size:
+        # if there aren't enough rows to fill this tile, add some zeros
+        dense = np.vstack([dense, np.zeros((tile_size - len(dense), shape[1]))])
+
+    return dense.T
+
+def _pack_base_tile(dense):
+    return tte.pack_fragment(tte.encode_binary_body({'dense': dense}))
+
+def _unpack_base_tile(packed):
+    body = tte.unpack_fragment(packed)
+
+    if body is None:
+        return None
+
+    return tte.decode_binary_body(body)[0].get('dense')
+
+# the raw (not aggregated) multivec tiles that aggregated tiles are
+# computed from, kept with their original dtype
+base_tile_cache = hc.TieredCache(
+    hu.getRdb(),
+    hss.MULTIVEC_BASE_TILE_LOCAL_MAX_BYTES,
+    _unpack_base_tile,
+    _pack_base_tile,
+    channel=hss.TILE_CACHE_INVALIDATION_CHANNEL
+)
+base_tile_policy = hc.TileCachePolicy(
+    default_ttl=hss.MULTIVEC_BASE_TILE_TTL,
+    max_entry_bytes=hss.MULTIVEC_BASE_TILE_MAX_BYTES
+)
+
+def base_tile_key(tileset, tile_id):
+    '''
+    The key of the raw multivec tile that the aggregated variants of a
+    tile are computed from. Like the keys of the tile cache (see
+    `tilesets.views.tile_cache_key`) it starts with the tile id and holds
+    the version of the tileset, so that the entries of a changed tileset
+    are orphaned. Deleting a tileset drops them explicitly.
+    '''
+    return '{}@{}:base'.format(tile_id, tileset.version)
+
+def get_base_multivec_tiles(tileset, tile_ids):
+    '''
+    Get the raw data of multivec tiles from the base tile cache, reading
+    (and caching) those that aren't cached from the file
+
+    Parameters
+    ----------
+    tileset: tilesets.resolver.TilesetRecord
+        The tileset that the tile ids should be retrieved from
+    tile_ids: [str,...]
+        A list of tile_ids (e.g. xyx.0.0) identifying the tiles
+        to be retrieved
+
+    Returns
+    -------
+    tiles: {(z, x): np.array}
+        The data of the tiles (rows x tile_size) by position
+    '''
+    tile_ids = list(tile_ids)
+    keys = [base_tile_key(tileset, tile_id) for tile_id in tile_ids]
+
+    tiles = {}
+    tiles_to_cache = []
+
+    for tile_id, key, dense in zip(tile_ids, keys, base_tile_cache.get_many(keys)):
+        tile_position = tuple(map(int, tile_id.split('.')[1:3]))
+
+        if dense is None:
+            start = time.perf_counter()
+            dense = get_multivec_tile(tileset.datafile.path, tile_position)
+            tiles_to_cache += [(key, dense, 'multivec', tile_position[0],
+                time.perf_counter() - start)]
+
+        tiles[tile_position] = dense
+
+    base_tile_cache.put_many(tiles_to_cache, base_tile_policy)
+
+    return tiles
+
+def _open_cooler(path):
+    '''
+    Open a cooler file for the pool and register the handle with
+    clodius, which looks open coolers up by path
+    '''
+    if path in hgco.mats:
+        f, info = hgco.mats[path]
+    else:
+        f, info = hgco.make_mats(path)
+
+    f.close()
+
+    f = fh.open_h5(path)
+    hgco.mats[path] = [f, info]
+
+    return f
+
+def _close_cooler(f):
+    for path, (mat_f, info) in list(hgco.mats.items()):
+        if mat_f is f:
+            del hgco.mats[path]
+
+    f.close()
+
+def borrow_cooler(path):
+    '''
+    Borrow the pooled handle of a cooler file. While it is borrowed
+    `clodius.tiles.cooler` uses it for this path.
+    '''
+    return fh.borrow(path, 'cooler', _open_cooler, _close_cooler)
+
+def generate_cooler_tiles(tileset, tile_ids):
+    '''
+    Generate tiles from a cooler file using a pooled handle. Same as
+    `clodius.tiles.cooler.generate_tiles` but the tiles are read with one
+    query per rectangle (see `tile_rectangles`), from the warm state of
+    the resolution (see `tilesets.cooler_state`) where possible.
+
+    Parameters
+    ----------
+    tileset: tilesets.models.Tileset object
+        The tileset that the tile ids should be retrieved from
+    tile_ids: [str,...]
+        A list of tile_ids (e.g. xyx.0.0.1.default) identifying the tiles
+        to be retrieved
+
+    Returns
+    -------
+    generated_tiles: [(tile_id, tile_data),...]
+        A list of tile_id, tile_data tuples
+    '''
+    BINS_PER_TILE = 256
+    path = tileset.datafile.path
     generated_tiles = []
-    for tile_id in tile_ids:
-        tile_id_parts = tile_id.split('.')
-        tile_position = list(map(int, tile_id_parts[1:3]))
-        dense = hdft.get_discrete_data(
-            h5py.File(
-                tileset.datafile.path
-            ),
-            tile_position[0],
-            tile_position[1]
-        )
 
-        tile_value = {'discrete': list([list([x.decode('utf-8') for x in d]) for d in dense])}
+    with borrow_cooler(path):
+        tileset_file, tileset_info = hgco.mats[path]
+        max_pos = tileset_info['max_pos']
+        resolutions = sorted(
+            [int(r) for r in tileset_info.get('resolutions', [])], reverse=True)
+
+        rectangles = tile_rectangles(tile_ids,
+            in_bounds=lambda zoom, position: all(
+                p < m + 1 for p, m in zip(position, max_pos)))
+
+        for rectangle in rectangles:
+            zoom_level = rectangle.zoom
+
+            transform_type = rectangle.transform or 'default'
+            start, end = rectangle.start, rectangle.end
+            x_width = end[0] - start[0] + 1
+            y_width = end[1] - start[1] + 1
+            state = None
+
+            if resolutions:
+                if zoom_level >= len(resolutions):
+                    # this tile has too high of a zoom level specified
+                    continue
+
+                resolution = resolutions[zoom_level]
+                root = 'resolutions/{}'.format(resolution)
+                hdf_for_resolution = tileset_file[root]
+
+                # the warm state of the resolution, unless the tiles need
+                # what only clodius reads
+                state = tco.get_state(
+                    path, root, 'cooler', _open_cooler, _close_cooler)
+
+                if (state.resolution != resolution
+                        or not tco.can_make_tiles(state, transform_type)):
+                    state = None
+            else:
+                if zoom_level > tileset_info['max_zoom']:
+                    continue
+
+                hdf_for_resolution = tileset_file[str(zoom_level)]
+                resolution = (tileset_info['max_width'] / 2 ** zoom_level) / BINS_PER_TILE
+
+            if state is not None:
+                tile_data_by_position = tco.make_tiles(
+                    state, start[0], start[1], transform_type,
+                    x_width, y_width)
+            else:
+                tile_data_by_position = hgco.make_tiles(
+                    hdf_for_resolution,
+                    resolution,
+                    start[0], start[1],
+                    transform_type,
+                    x_width,
+                    y_width
+                )
+
+            for position, tile_data in tile_data_by_position.items():
+                tile_id = rectangle.tile_ids.get(tuple(position))
+
+                if tile_id is not None:
+                    generated_tiles.append(
+                        (tile_id, hgfo.format_dense_tile(tile_data)))
 
-        generated_tiles += [(tile_id, tile_value)]
+    return generated_tiles
+
+def generate_imtiles_tiles(tileset, tile_ids, raw):
+    '''
+    Generate tiles from an imtiles file using a pooled connection. Same
+    as `clodius.tiles.imtiles.get_tiles`.
+
+    Parameters
+    ----------
+    tileset: tilesets.models.Tileset object
+        The tileset that the tile ids should be retrieved from
+    tile_ids: [str,...]
+        A list of tile_ids (e.g. xyx.0.0.1) identifying the tiles
+        to be retrieved
+    raw: str or False
+        Return the raw image data rather than base64 encoded data
+
+    Returns
+    -------
+    generated_tiles: [(tile_id, tile_data),...]
+        A list of tile_id, tile_data tuples
+    '''
+    generated_tiles = []
+
+    with fh.borrow(tileset.datafile.path, 'sqlite') as db:
+        # imtiles ids are z.y.x
+        for rectangle in tile_rectangles(tile_ids):
+            start, end = rectangle.start, rectangle.end
+
+            rows = db.execute(
+                'SELECT y, x, image FROM tiles WHERE z = ? AND '
+                'y BETWEEN ? AND ? AND x BETWEEN ? AND ?',
+                (rectangle.zoom, start[0], end[0], start[1], end[1])
+            )
+
+            for y, x, image in rows:
+                tile_id = rectangle.tile_ids.get((y, x))
+
+                if tile_id is None:
+                    continue
+
+                if raw:
+                    tile_data = {'image': image}
+                else:
+                    tile_data = {'dense': base64.b64encode(image).decode('latin-1')}
+
+                generated_tiles.append((tile_id, tile_data))
 
     return generated_tiles
 
@@ -429,9 +1072,85 @@ def bin_tiles_by_zoom_level_and_transform(tile_ids):
 
     return tile_id_lists
 
-def partition_by_adjacent_tiles(tile_ids, dimension=2):
+TileRectangle = col.namedtuple(
+    'TileRectangle', ['zoom', 'transform', 'start', 'end', 'tile_ids'])
+
+def partition_positions(positions, max_waste=None):
     '''
-    Partition a set of tile ids into sets of adjacent tiles
+    Cover a set of tile positions (at one zoom level) with rectangles.
+
+    Adjacent positions (within 1 of each other in every dimension) are
+    grouped using a hash of the positions, so the grouping takes linear
+    time. The bounding box of a group is split in half along its longest
+    side until at most `max_waste` of the positions in it weren't
+    requested.
+
+    Parameters
+    ----------
+    positions: [(x,), ...] or [(x, y), ...]
+        The tile positions
+    max_waste: float or None
+        The largest share of unrequested positions in a rectangle.
+        Defaults to settings.TILE_RECTANGLE_MAX_WASTE
+
+    Returns
+    -------
+    rectangles: [(start, end, [position,...]),...]
+        The first and last (inclusive) position of every rectangle and
+        the requested positions in it
+    '''
+    if max_waste is None:
+        max_waste = hss.TILE_RECTANGLE_MAX_WASTE
+
+    positions = sorted(set(positions))
+    remaining = set(positions)
+    rectangles = []
+
+    for seed in positions:
+        if seed not in remaining:
+            continue
+
+        remaining.discard(seed)
+        group = [seed]
+        offsets = [o for o in it.product((-1, 0, 1), repeat=len(seed)) if any(o)]
+
+        # the group grows while it's being iterated over
+        for position in group:
+            for offset in offsets:
+                neighbour = tuple(p + o for p, o in zip(position, offset))
+
+                if neighbour in remaining:
+                    remaining.discard(neighbour)
+                    group.append(neighbour)
+
+        _split_rectangle(group, max_waste, rectangles)
+
+    return rectangles
+
+def _split_rectangle(positions, max_waste, rectangles):
+    start = tuple(map(min, zip(*positions)))
+    end = tuple(map(max, zip(*positions)))
+    area = np.prod([e - s + 1 for s, e in zip(start, end)])
+
+    if len(positions) >= area * (1 - max_waste):
+        rectangles.append((start, end, sorted(positions)))
+        return
+
+    # the first and last row along the longest side are both requested,
+    # so neither half is empty
+    axis = max(range(len(start)), key=lambda a: end[a] - start[a])
+    middle = (start[axis] + end[axis]) // 2
+
+    _split_rectangle(
+        [p for p in positions if p[axis] <= middle], max_waste, rectangles)
+    _split_rectangle(
+        [p for p in positions if p[axis] > middle], max_waste, rectangles)
+
+def tile_rectangles(tile_ids, dimension=2, in_bounds=None, max_waste=None):
+    '''
+    Group tile ids into rectangles of tiles at the same zoom level and
+    with the same transform which can be read with one range query (see
+    `partition_positions`).
 
     Parameters
     ----------
@@ -440,52 +1159,64 @@ def partition_by_adjacent_tiles(tile_ids, dimension=2):
         to be retrieved
     dimension: int
         The dimensionality of the tiles
+    in_bounds: function or None
+        Called with the zoom level and position of every tile. Tiles for
+        which it returns False are left out.
+    max_waste: float or None
+        The largest share of unrequested tiles in a rectangle
 
     Returns
     -------
-    tile_lists: [tile_ids, tile_ids]
-        A list of tile lists, all of which have tiles that
-        are within 1 position of another tile in the list
+    rectangles: [TileRectangle,...]
+        The zoom level, transform ('' if there is none), first and last
+        (inclusive) position of every rectangle and the requested tile
+        ids in it by position
     '''
-    tile_id_lists = []
+    tile_ids_by_group = col.defaultdict(dict)
 
-    for tile_id in sorted(tile_ids, key=lambda x: [int(p) for p in x.split('.')[2:2+dimension]]):
-        tile_id_parts = tile_id.split('.')
+    for tile_id in tile_ids:
+        parts = tile_id.split('.')
+        zoom = int(parts[1])
+        position = tuple(map(int, parts[2:2+dimension]))
+        transform = '.'.join(parts[2+dimension:])
 
-        # exclude the zoom level in the position
-        # because the tiles should already have been partitioned
-        # by zoom level
-        tile_position = list(map(int, tile_id_parts[2:4]))
+        if in_bounds is not None and not in_bounds(zoom, position):
+            continue
 
-        added = False
+        # 1D and 2D ids are never grouped together
+        tile_ids_by_group[(zoom, transform, len(position))][position] = tile_id
 
-        for tile_id_list in tile_id_lists:
-            # iterate over each group of adjacent tiles
-            has_close_tile = False
+    rectangles = []
 
-            for ct_tile_id in tile_id_list:
-                ct_tile_id_parts = ct_tile_id.split('.')
-                ct_tile_position = list(map(int, ct_tile_id_parts[2:2+dimension]))
-                far_apart = False
+    for (zoom, transform, _), by_position in sorted(tile_ids_by_group.items()):
+        for start, end, positions in partition_positions(by_position, max_waste):
+            rectangles.append(TileRectangle(zoom, transform, start, end,
+                dict((p, by_position[p]) for p in positions)))
 
-                # iterate over each dimension and see if this tile is close
-                for p1,p2 in zip(tile_position, ct_tile_position):
-                    if abs(int(p1) - int(p2)) > 1:
-                        # too far apart can't be part of the same group
-                        far_apart = True
+    return rectangles
 
-                if not far_apart:
-                    # no position was too far
-                    tile_id_list += [tile_id]
-                    added = True
-                    break
+def partition_by_adjacent_tiles(tile_ids, dimension=2):
+    '''
+    Partition a set of tile ids into sets of adjacent tiles
 
-            if added:
-                break
-        if not added:
-            tile_id_lists += [[tile_id]]
+    Parameters
+    ----------
+    tile_ids: [str,...]
+        A list of tile_ids (e.g. xyx.0.0.1) identifying the tiles
+        to be retrieved
+    dimension: int
+        The dimensionality of the tiles
 
-    return tile_id_lists
+    Returns
+    -------
+    tile_lists: [tile_ids, tile_ids]
+        A list of tile lists, each of which covers most of a rectangle
+        of tiles at one zoom level (see `tile_rectangles`)
+    '''
+    return [
+        list(rectangle.tile_ids.values())
+        for rectangle in tile_rectangles(tile_ids, dimension)
+    ]
 
 def generate_tiles(tileset_tile_ids):
     '''
@@ -493,7 +1224,8 @@ def generate_tiles(tileset_tile_ids):
 
     All of the tile_ids must come from the same tileset. This function
     will determine the appropriate handler this tile given the tileset's
-    filetype and datatype
+    filetype and datatype. Tiles without options are served from the
+    tile store of the tileset (see `tilesets.tile_store`) if it has them.
 
     Parameters
     ----------
@@ -516,6 +1248,33 @@ def generate_tiles(tileset_tile_ids):
     '''
     tileset, tile_ids, raw, tileset_options = tileset_tile_ids
 
+    if raw or tileset_options is not None:
+        return generate_live_tiles(tileset_tile_ids)
+
+    # tiles from the tile store of the tileset, if it has one
+    stored_tiles = tts.get_tiles(tileset, tile_ids)
+
+    if not stored_tiles:
+        return generate_live_tiles(tileset_tile_ids)
+
+    tile_ids = [tile_id for tile_id in tile_ids if tile_id not in stored_tiles]
+    tile_list = list(stored_tiles.items())
+
+    if tile_ids:
+        tile_list += generate_live_tiles(
+            (tileset, tile_ids, raw, tileset_options))
+
+    return tile_list
+
+
+def generate_live_tiles(tileset_tile_ids):
+    '''
+    Generate tiles like `generate_tiles`, from the data file of the
+    tileset rather than its tile store
+    '''
+    tileset, tile_ids, raw, tileset_options = tileset_tile_ids
+    tileset = mirrored(tileset)
+
     if tileset.filetype == 'hitile':
         return generate_hitile_tiles(tileset, tile_ids)
     elif tileset.filetype == 'beddb':
@@ -527,7 +1286,7 @@ def generate_tiles(tileset_tile_ids):
     elif tileset.filetype == 'hibed':
         return generate_hibed_tiles(tileset, tile_ids)
     elif tileset.filetype == 'cooler':
-        return hgco.generate_tiles(tileset.datafile.path, tile_ids)
+        return generate_cooler_tiles(tileset, tile_ids)
     elif tileset.filetype == 'bigwig':
         chromsizes = get_chromsizes(tileset)
         return hgbi.tiles(tileset.datafile.path, tile_ids, chromsizes=chromsizes)
@@ -543,13 +1302,22 @@ def generate_tiles(tileset_tile_ids):
         chromsizes = get_chromsizes(tileset)
         return hgbb.tiles(tileset.datafile.path, tile_ids, chromsizes=chromsizes)
     elif tileset.filetype == 'multivec':
+        get_data_function = get_multivec_tile
+
+        if (hss.MULTIVEC_BASE_TILE_CACHE and tileset_options is not None
+                and 'aggGroups' in tileset_options
+                and getattr(tileset, 'version', None) is not None):
+            # every aggregation of a tile is computed from the same raw tile
+            base_tiles = get_base_multivec_tiles(tileset, tile_ids)
+            get_data_function = lambda filename, tile_pos: base_tiles[tuple(tile_pos)]
+
         return generate_1d_tiles(
                 tileset.datafile.path,
                 tile_ids,
-                ctmu.get_single_tile,
+                get_data_function,
                 tileset_options)
     elif tileset.filetype == 'imtiles':
-        return hgim.get_tiles(tileset.datafile.path, tile_ids, raw)
+        return generate_imtiles_tiles(tileset, tile_ids, raw)
     elif tileset.filetype == 'bam':
         return ctb.tiles(
             tileset.datafile.path,
@@ -562,8 +1330,281 @@ def generate_tiles(tileset_tile_ids):
         filepath = tileset.datafile.path
 
         if filetype in hgti.by_filetype:
-            return hgti.by_filetype[filetype](filepath).tiles(tile_ids)
+            # keep the tileset object (and the files it opened) around
+            with fh.borrow(filepath, 'hgti.' + filetype,
+                    hgti.by_filetype[filetype]) as ts:
+                return ts.tiles(tile_ids)
 
         return [(ti, {'error': 'Unknown tileset filetype: {}'.format(tileset.filetype)}) for ti in tile_ids]
 
 
+_executor = None
+_executor_pid = None
+
+
+def _init_process_worker():
+    '''
+    Drop the database connections inherited from the parent so that
+    the worker processes open their own ones. They aren't closed since
+    their sockets are shared with the parent, which is still using them.
+    '''
+    for conn in db.connections.all():
+        conn.connection = None
+
+
+def get_executor():
+    '''
+    Get the executor used to generate tiles in parallel.
+
+    The executor is created lazily and recreated if this process was
+    forked (e.g. by uWSGI) after it was created.
+
+    Returns
+    -------
+    executor: concurrent.futures.Executor or None
+        None if tiles should be generated serially
+    '''
+    global _executor, _executor_pid
+
+    if hss.TILE_GENERATION_EXECUTOR not in ('thread', 'process'):
+        return None
+
+    if _executor is not None and _executor_pid == os.getpid():
+        return _executor
+
+    if hss.TILE_GENERATION_EXECUTOR == 'process':
+        _executor = cf.ProcessPoolExecutor(
+            max_workers=hss.TILE_GENERATION_WORKERS,
+            initializer=_init_process_worker
+        )
+    else:
+        _executor = cf.ThreadPoolExecutor(
+            max_workers=hss.TILE_GENERATION_WORKERS
+        )
+    _executor_pid = os.getpid()
+
+    return _executor
+
+
+def split_by_zoom(tileset_tile_ids):
+    '''
+    Split the tile ids of a tileset into one task per zoom level so that
+    they can be generated independently.
+
+    Parameters
+    ----------
+    tileset_tile_ids: tuple
+        A (tileset, tile_ids, raw, tileset_options) tuple as passed
+        to `generate_tiles`
+
+    Returns
+    -------
+    tasks: [tuple,...]
+        A list of tuples of the same form, one per zoom level
+    '''
+    tileset, tile_ids, raw, tileset_options = tileset_tile_ids
+
+    try:
+        tile_ids_by_zoom = bin_tiles_by_zoom(tile_ids)
+    except (ValueError, IndexError):
+        # not all tile ids are of the form uuid.z.x[.y...]
+        return [tileset_tile_ids]
+
+    if len(tile_ids_by_zoom) < 2:
+        return [tileset_tile_ids]
+
+    return [(tileset, zoom_tile_ids, raw, tileset_options)
+            for zoom_tile_ids in tile_ids_by_zoom.values()]
+
+
+def _share_arrays(tiles):
+    '''
+    Move the numpy arrays in the tile values into shared memory blocks
+    and replace them by (name, shape, dtype) descriptors
+    '''
+    shared_tiles = []
+    names = []
+
+    try:
+        for tile_id, tile_value in tiles:
+            if isinstance(tile_value, dict):
+                tile_value = dict(tile_value)
+
+                for key, value in tile_value.items():
+                    if not isinstance(value, np.ndarray) or value.nbytes == 0:
+                        continue
+
+                    shm = shared_memory.SharedMemory(create=True, size=value.nbytes)
+                    names.append(shm.name)
+                    np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)[...] = value
+                    tile_value[key] = ('__shm__', shm.name, value.shape, value.dtype.str)
+                    shm.close()
+                    # the parent releases the block, attaching registers
+                    # it with the resource tracker again
+                    resource_tracker.unregister(shm._name, 'shared_memory')
+
+            shared_tiles += [(tile_id, tile_value)]
+    except BaseException:
+        _unlink_blocks(names)
+        raise
+
+    return shared_tiles
+
+
+def _shared_arrays(tiles):
+    '''
+    The (tile_value, key, name, shape, dtype) of every `_share_arrays`
+    descriptor in the tile values
+    '''
+    for tile_id, tile_value in tiles:
+        if not isinstance(tile_value, dict):
+            continue
+
+        for key, value in list(tile_value.items()):
+            if isinstance(value, tuple) and len(value) == 4 and value[0] == '__shm__':
+                yield (tile_value, key) + value[1:]
+
+
+def _unlink_blocks(names):
+    for name in names:
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+
+        shm.close()
+        shm.unlink()
+
+
+def _release_arrays(tiles):
+    '''
+    Release the shared blocks of tiles that won't be unshared
+    '''
+    _unlink_blocks([name for _, _, name, _, _ in _shared_arrays(tiles)])
+
+
+def _unshare_arrays(tiles):
+    '''
+    Copy the arrays referenced by `_share_arrays` descriptors out of
+    shared memory and release the shared blocks. The blocks are released
+    even if copying them fails.
+    '''
+    try:
+        for tile_value, key, name, shape, dtype in _shared_arrays(tiles):
+            shm = shared_memory.SharedMemory(name=name)
+
+            try:
+                tile_value[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+            finally:
+                shm.close()
+                shm.unlink()
+    except BaseException:
+        _release_arrays(tiles)
+        raise
+
+    return tiles
+
+
+def _generate_shared(executor, tasks):
+    '''
+    Generate the tiles of the tasks in a process pool, passing their
+    arrays through shared memory. Every block created by the workers is
+    released, also when a task fails.
+
+    Returns
+    -------
+    results: [(tile_list, elapsed),...]
+        The tiles and generation time of every task
+    '''
+    pending = [executor.submit(_generate_tiles_shared, task) for task in tasks]
+    results = []
+
+    try:
+        while pending:
+            tiles, elapsed = pending.pop(0).result()
+            results += [(_unshare_arrays(tiles), elapsed)]
+    finally:
+        for future in pending:
+            if future.cancel():
+                continue
+
+            try:
+                tiles, _ = future.result()
+            except Exception:
+                continue
+
+            _release_arrays(tiles)
+
+    return results
+
+
+def generate_tiles_timed(tileset_tile_ids):
+    '''
+    Generate tiles like `generate_tiles` and measure how long it takes
+
+    Returns
+    -------
+    tile_list: [(tile_id, tile_data),...]
+        The generated tiles
+    elapsed: float
+        The time it took to generate them in seconds
+    '''
+    start = time.perf_counter()
+    tile_list = generate_tiles(tileset_tile_ids)
+
+    return tile_list, time.perf_counter() - start
+
+
+def _generate_tiles_shared(tileset_tile_ids):
+    '''
+    Generate tiles in a worker process and return their arrays through
+    shared memory rather than pickling them back
+    '''
+    tile_list, elapsed = generate_tiles_timed(tileset_tile_ids)
+
+    return _share_arrays(tile_list), elapsed
+
+
+def generate_tiles_parallel(tilesets_tile_ids, costs=None):
+    '''
+    Generate the tiles for a number of tilesets, fanning out over the
+    tilesets and the zoom levels within each tileset when a parallel
+    executor is configured (see `TILE_GENERATION_EXECUTOR`).
+
+    Parameters
+    ----------
+    tilesets_tile_ids: [tuple,...]
+        A list of (tileset, tile_ids, raw, tileset_options) tuples
+        as passed to `generate_tiles`
+    costs: dict or None
+        If given, the time in seconds it took to generate every tile is
+        stored in it by tile id. Tiles generated together share the time
+        equally.
+
+    Returns
+    -------
+    tile_list: [(tile_id, tile_data),...]
+        A list of tile_id, tile_data tuples
+    '''
+    executor = get_executor()
+    tasks = list(it.chain(*map(split_by_zoom, tilesets_tile_ids)))
+
+    if executor is None or len(tasks) < 2:
+        results = map(generate_tiles_timed, tasks)
+    elif isinstance(executor, cf.ProcessPoolExecutor) and shared_memory is not None:
+        results = _generate_shared(executor, tasks)
+    else:
+        results = executor.map(generate_tiles_timed, tasks)
+
+    tile_list = []
+
+    for tiles, elapsed in results:
+        tiles = list(tiles)
+
+        if costs is not None:
+            for tile_id, _ in tiles:
+                costs[tile_id] = elapsed / len(tiles)
+
+        tile_list += tiles
+
+    return tile_list
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import tilesets.generate_tiles as tgt
+import tilesets.management.commands.warm_tiles as tmcw
+import tilesets.resolver as tsr
+import tilesets.tile_store as tts
+
+
+class Command(BaseCommand):
+    help = 'Precompute the tiles of tilesets which don\'t change into tile stores'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uuid', type=str, action='append', required=True,
+            help='Build the store of this tileset (can be given several times)')
+        parser.add_argument('--min-zoom', type=int, default=0)
+        parser.add_argument('--max-zoom', type=int, default=None,
+            help='The highest zoom level to store (default: all of them)')
+
+    def handle(self, *args, **options):
+        tilesets = tsr.resolve(options['uuid'])
+
+        for uuid in options['uuid']:
+            tileset = tilesets.get(uuid)
+
+            if tileset is None:
+                raise CommandError('No such tileset: {}'.format(uuid))
+
+            tileset_info = tgt.get_tileset_info(tileset)
+
+            if 'error' in tileset_info:
+                raise CommandError('{}: {}'.format(uuid, tileset_info['error']))
+            if 'max_width' not in tileset_info or 'max_zoom' not in tileset_info:
+                raise CommandError('{}: {} tilesets can not be stored'.format(
+                    uuid, tileset.filetype))
+
+            max_zoom = options['max_zoom']
+            if max_zoom is None:
+                max_zoom = int(tileset_info['max_zoom'])
+
+            writer = tts.TileStoreWriter(tileset)
+
+            try:
+                for _, _, tile_ids in tmcw.tile_batches(
+                        tileset, tileset_info, options['min_zoom'], max_zoom):
+                    writer.put_many(tgt.generate_live_tiles(
+                        (tileset, tile_ids, False, None)))
+            except BaseException:
+                writer.abort()
+                raise
+
+            writer.close()
+
+            self.stdout.write('Stored {} tiles of {} in {}'.format(
+                writer.num_tiles, uuid, writer.path))
@@ -1,3 +1,4 @@
+from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
 import django.core.exceptions as dce
 from django.core.files import File
@@ -10,6 +11,7 @@ import logging
 import os
 import os.path as op
 import tilesets.chromsizes  as tcs
+import tilesets.generate_tiles as tgt
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
@@ -96,7 +98,7 @@ def ingest(filename=None, datatype=None, filetype=None, coordSystem='', coordSys
             name=project_name
         )
 
-    return tm.Tileset.objects.create(
+    tileset = tm.Tileset.objects.create(
         datafile=django_file,
         indexfile=indexfile,
         filetype=filetype,
@@ -109,6 +111,10 @@ def ingest(filename=None, datatype=None, filetype=None, coordSystem='', coordSys
         temporary=temporary,
         name=name)
 
+    tgt.try_materialize_tileset_info(tileset)
+
+    return tileset
+
 def chromsizes_match(chromsizes1, chromsizes2):
     pass
 
@@ -231,6 +237,22 @@ class Command(BaseCommand):
             default=False,
             help='Skip upload',
         )
+        parser.add_argument(
+            '--warm-max-zoom',
+            type=int,
+            default=None,
+            help='Generate and cache the tiles of the new tileset down to '
+                 'this zoom level (see the warm_tiles command)',
+        )
 
     def handle(self, *args, **options):
-        ingest(**options)
+        tileset = ingest(**options)
+
+        if tileset is not None and options['warm_max_zoom'] is not None:
+            call_command(
+                'warm_tiles',
+                uuid=[tileset.uuid],
+                max_zoom=options['warm_max_zoom'],
+                stdout=self.stdout,
+                stderr=self.stderr,
+            )
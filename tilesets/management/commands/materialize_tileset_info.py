@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+import tilesets.generate_tiles as tgt
+import tilesets.models as tm
+
+
+class Command(BaseCommand):
+    help = 'Compute and store the tileset info of existing tilesets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uuid', type=str, action='append',
+            help='Only these tilesets (can be given several times)')
+        parser.add_argument('--force', action='store_true', default=False,
+            help='Also recompute tileset info which is already stored')
+
+    def handle(self, *args, **options):
+        tilesets = tm.Tileset.objects.all()
+
+        if options['uuid']:
+            tilesets = tilesets.filter(uuid__in=options['uuid'])
+        if not options['force']:
+            tilesets = tilesets.filter(tileset_info=None)
+
+        stored = 0
+        failed = 0
+
+        for tileset in tilesets.iterator():
+            try:
+                tileset_info = tgt.materialize_tileset_info(tileset)
+            except Exception as e:
+                tileset_info = {'error': str(e)}
+
+            if 'error' in tileset_info:
+                failed += 1
+                self.stderr.write('{}: {}'.format(tileset.uuid, tileset_info['error']))
+            else:
+                stored += 1
+
+        self.stdout.write('Stored the tileset info of {} tilesets ({} failed)'.format(
+            stored, failed))
@@ -0,0 +1,297 @@
+'''
+Compute the tiles of tilesets ahead of time and store them in the tile
+cache under the keys that the tiles endpoint reads, so that the first
+viewers after a deploy or a cache flush don't wait for them.
+
+Tiles are generated in batches by a pool of worker processes. Tiles which
+are already cached are skipped and, with --state, finished batches are
+recorded in a file so that an interrupted run can be resumed. With
+--cpu-share, every worker sleeps after a batch so that the command uses
+at most that share of the machine's CPUs.
+'''
+import concurrent.futures as cf
+import itertools as it
+import json
+import math
+import os
+import os.path as op
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+import tilesets.generate_tiles as tgt
+import tilesets.models as tm
+import tilesets.resolver as tsr
+import tilesets.tile_encoding as tte
+import tilesets.views as tsv
+
+# the number of tiles generated together
+BATCH_SIZE = 64
+
+
+def viewconf_tileset_uuids():
+    '''
+    The uuids of the tilesets referenced by the stored view configs
+    '''
+    uuids = set()
+
+    for viewconf in tm.ViewConf.objects.values_list(
+            'viewconf', flat=True).iterator():
+        try:
+            _collect_tileset_uuids(json.loads(viewconf), uuids)
+        except ValueError:
+            continue
+
+    return uuids
+
+
+def _collect_tileset_uuids(obj, uuids):
+    if isinstance(obj, dict):
+        if isinstance(obj.get('tilesetUid'), str):
+            uuids.add(obj['tilesetUid'])
+
+        for value in obj.values():
+            _collect_tileset_uuids(value, uuids)
+    elif isinstance(obj, list):
+        for value in obj:
+            _collect_tileset_uuids(value, uuids)
+
+
+def tile_positions(tileset_info, zoom):
+    '''
+    The positions of the tiles covering the data of a tileset at a zoom
+    level, as (x,) or (x, y) tuples
+
+    Parameters
+    ----------
+    tileset_info: dict
+        The tileset info, with a max_width and optionally min_pos and
+        max_pos
+    zoom: int
+        The zoom level
+    '''
+    max_width = tileset_info['max_width']
+    min_pos = tileset_info.get('min_pos', [0])
+    max_pos = tileset_info.get('max_pos', [max_width] * len(min_pos))
+    tile_width = max_width / 2 ** zoom
+
+    return it.product(*[
+        range(max(1, min(2 ** zoom, math.ceil((end - start) / tile_width))))
+        for start, end in zip(min_pos, max_pos)
+    ])
+
+
+def tile_batches(tileset, tileset_info, min_zoom, max_zoom):
+    '''
+    The tile ids of a tileset from min_zoom to max_zoom (at most its
+    max_zoom), in the form the tiles endpoint caches them, in batches
+
+    Returns
+    -------
+    batches: iterator of (zoom, index, [tile_id,...])
+    '''
+    max_zoom = min(max_zoom, int(tileset_info['max_zoom']))
+
+    for zoom in range(min_zoom, max_zoom + 1):
+        tile_ids = (
+            '.'.join(map(str, (tileset.uuid, zoom) + pos))
+            for pos in tile_positions(tileset_info, zoom)
+        )
+
+        if tileset.filetype == 'cooler':
+            tile_ids = map(tsv.add_transform_type, tile_ids)
+
+        for index in it.count():
+            batch = list(it.islice(tile_ids, BATCH_SIZE))
+
+            if not batch:
+                break
+
+            yield zoom, index, batch
+
+
+def warm_batch(uuid, tile_ids, wire_formats=('json',), duty=1.):
+    '''
+    Generate the tiles of a tileset which aren't cached and store them in
+    the tile cache. Concurrent generations of the same tiles by the tiles
+    endpoint are coalesced with this one.
+
+    Parameters
+    ----------
+    uuid: str
+        The uuid of the tileset
+    tile_ids: [str,...]
+        The tile ids, as returned by `tile_batches`
+    wire_formats: [str,...]
+        The formats to cache the tiles in (see `tte.WIRE_FORMATS`)
+    duty: float
+        The share of the time this worker may spend generating tiles. It
+        sleeps for the rest.
+
+    Returns
+    -------
+    num_generated: int
+        The number of tiles that weren't cached
+    '''
+    start = time.perf_counter()
+    tileset = tsr.get(uuid)
+    num_generated = 0
+
+    if tileset is None:
+        return 0
+
+    for wire_format in wire_formats:
+        keys = dict(
+            (tsv.tile_cache_key(tileset, tile_id, wire_format=wire_format), tile_id)
+            for tile_id in tile_ids
+        )
+        missing = [
+            key for key, value in zip(keys, tsv.tile_cache.get_many(keys))
+            if value is None
+        ]
+
+        def generate(keys_to_generate):
+            keys_to_generate = set(keys_to_generate)
+            tileset_tile_ids = (
+                tileset, set(keys[key] for key in keys_to_generate), False, None)
+
+            return dict(
+                (key, fragment) for _, key, fragment in tsv.generate_fragments(
+                    [tileset_tile_ids], wire_format)
+                if key in keys_to_generate
+            )
+
+        if missing:
+            tsv.tile_flight.run(missing, generate, tsv.tile_cache.get_many)
+            num_generated += len(missing)
+
+    if duty < 1:
+        time.sleep((time.perf_counter() - start) * (1 / duty - 1))
+
+    return num_generated
+
+
+class Command(BaseCommand):
+    help = 'Generate the tiles of tilesets and store them in the tile cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uuid', type=str, action='append',
+            help='Warm this tileset (can be given several times)')
+        parser.add_argument('--viewconfs', action='store_true', default=False,
+            help='Warm every tileset referenced by a stored view config')
+        parser.add_argument('--min-zoom', type=int, default=0)
+        parser.add_argument('--max-zoom', type=int, default=4,
+            help='The highest zoom level to warm (capped at the max_zoom of '
+                 'every tileset)')
+        parser.add_argument('--format', type=str, action='append',
+            choices=tte.WIRE_FORMATS, dest='formats',
+            help='The tile formats to cache (default: json)')
+        parser.add_argument('--workers', type=int, default=1,
+            help='The number of worker processes')
+        parser.add_argument('--cpu-share', type=float, default=1.,
+            help='The share of all CPUs that the workers may use together')
+        parser.add_argument('--state', type=str, default=None,
+            help='A file recording the finished batches, to resume an '
+                 'interrupted run')
+
+    def handle(self, *args, **options):
+        uuids = set(options['uuid'] or [])
+
+        if options['viewconfs']:
+            uuids |= viewconf_tileset_uuids()
+
+        if not uuids:
+            raise CommandError('Pass tilesets with --uuid or use --viewconfs')
+
+        wire_formats = tuple(options['formats'] or ['json'])
+        workers = max(1, options['workers'])
+        duty = min(1., options['cpu_share'] * (os.cpu_count() or 1) / workers)
+
+        state_path = options['state']
+        done = set()
+
+        if state_path and op.exists(state_path):
+            with open(state_path) as f:
+                done = set(line.strip() for line in f)
+
+        tasks = []
+        tilesets = tsr.resolve(uuids)
+
+        for uuid in sorted(uuids - set(tilesets)):
+            self.stderr.write('{}: no such tileset'.format(uuid))
+
+        for uuid, tileset in sorted(tilesets.items()):
+            try:
+                tileset_info = tgt.get_tileset_info(tileset)
+            except Exception as e:
+                tileset_info = {'error': str(e)}
+
+            if 'error' in tileset_info:
+                self.stderr.write('{}: {}'.format(uuid, tileset_info['error']))
+                continue
+            if 'max_width' not in tileset_info or 'max_zoom' not in tileset_info:
+                self.stderr.write('{}: {} tiles can not be warmed'.format(
+                    uuid, tileset.filetype))
+                continue
+
+            for zoom, index, tile_ids in tile_batches(
+                    tileset, tileset_info, options['min_zoom'], options['max_zoom']):
+                # batches of an older version of the tileset are redone
+                task_id = '{}@{} {} {}'.format(uuid, tileset.version, zoom, index)
+
+                if task_id not in done:
+                    tasks.append((task_id, uuid, tile_ids))
+
+        state = open(state_path, 'a') if state_path else None
+        num_generated = 0
+
+        def finish(task_id, generated):
+            if state is not None:
+                state.write(task_id + '\n')
+                state.flush()
+
+            return generated
+
+        try:
+            if workers == 1:
+                for task_id, uuid, tile_ids in tasks:
+                    num_generated += finish(
+                        task_id, warm_batch(uuid, tile_ids, wire_formats, duty))
+            else:
+                num_generated += self.run_pool(
+                    tasks, workers, wire_formats, duty, finish)
+        finally:
+            if state is not None:
+                state.close()
+
+        self.stdout.write('Generated {} tiles in {} batches'.format(
+            num_generated, len(tasks)))
+
+    def run_pool(self, tasks, workers, wire_formats, duty, finish):
+        '''
+        Run the tasks in a process pool, with at most two batches per
+        worker queued at a time
+        '''
+        num_generated = 0
+        pending = {}
+
+        with cf.ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=tgt._init_process_worker) as executor:
+            for task_id, uuid, tile_ids in tasks:
+                if len(pending) >= 2 * workers:
+                    finished, _ = cf.wait(
+                        pending, return_when=cf.FIRST_COMPLETED)
+
+                    for future in finished:
+                        num_generated += finish(
+                            pending.pop(future), future.result())
+
+                future = executor.submit(
+                    warm_batch, uuid, tile_ids, wire_formats, duty)
+                pending[future] = task_id
+
+            for future in cf.as_completed(list(pending)):
+                num_generated += finish(pending.pop(future), future.result())
+
+        return num_generated
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-17 08:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tilesets', '0014_auto_20211119_1939'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tileset',
+            name='tileset_info',
+            field=models.TextField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='tileset',
+            name='tileset_info_mtime',
+            field=models.FloatField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,313 @@
+'''
+Mirror frequently read data files to a local cache directory.
+
+Deployments with a slow (e.g. network mounted) media directory can set
+HIGLASS_CACHE_DIR to a fast local disk. Data files are copied there in
+the background once they were read CACHE_DIR_MIN_ACCESSES times by all
+workers together (counted in the shared cache, see `getRdb`, or per worker
+without one), and reads are served from the original file until the copy
+is complete. Copies are written to a temporary file and renamed into place,
+and a lock file makes sure that only one worker copies a given file. When
+the copies would exceed CACHE_DIR_MAX_BYTES, the least recently read ones
+are deleted first. A copy is only used while its size and modification
+time match the original's.
+'''
+import collections as col
+import concurrent.futures as cf
+import fcntl
+import logging
+import os
+import os.path as op
+import shutil
+import threading
+import time
+
+import higlass_server.settings as hss
+import higlass_server.utils as hu
+
+logger = logging.getLogger(__name__)
+
+# how often the access time of a mirrored file is updated on disk, in
+# seconds
+TOUCH_INTERVAL = 60
+
+ACCESS_PREFIX = 'mirror:accesses:'
+LOCK_SUFFIX = '.lock'
+PARTIAL_SUFFIX = '.partial'
+
+
+class FileMirror(object):
+    '''
+    Parameters
+    ----------
+    cache_dir: str
+        The directory the files are mirrored to
+    max_bytes: int
+        The maximum total size of the mirrored files (0 for no limit)
+    min_accesses: int
+        The number of reads after which a file is mirrored
+    rdb: object or None
+        The shared cache the reads are counted in, as returned by
+        `getRdb`. They're counted per process if it's None or can't
+        count.
+    '''
+    def __init__(self, cache_dir, max_bytes=0, min_accesses=1, rdb=None):
+        self.cache_dir = op.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.min_accesses = min_accesses
+        self.rdb = rdb
+
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._accesses = col.Counter()
+        self._touched = {}
+        self._copying = set()
+        self._executor = None
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # the copying thread belonged to the parent process
+            self._reset()
+
+    def mirror_path(self, path):
+        '''
+        The path of the copy of a file in the cache directory
+        '''
+        return op.join(self.cache_dir, op.abspath(path).lstrip(os.sep))
+
+    def path(self, path):
+        '''
+        Get the path to read a file from: its copy in the cache directory
+        if it's complete and up to date and the original path otherwise.
+        Schedules copying the file if it's read often enough.
+        '''
+        if op.abspath(path).startswith(self.cache_dir + os.sep):
+            return path
+
+        mirror_path = self.mirror_path(path)
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return path
+
+        try:
+            mirror_stat = os.stat(mirror_path)
+
+            if (
+                mirror_stat.st_size == stat.st_size and
+                mirror_stat.st_mtime_ns == stat.st_mtime_ns
+            ):
+                self._touch(mirror_path, mirror_stat)
+                return mirror_path
+        except OSError:
+            pass
+
+        with self._lock:
+            self._check_pid()
+
+            if path in self._copying:
+                return path
+
+        if self._count(path) >= self.min_accesses:
+            self._schedule(path)
+
+        return path
+
+    def _count(self, path):
+        '''
+        Count a read of a file that isn't mirrored and return the number
+        of reads so far
+        '''
+        with self._lock:
+            self._accesses[path] += 1
+            accesses = self._accesses[path]
+
+        if self.rdb is not None:
+            try:
+                shared = self.rdb.incr(ACCESS_PREFIX + path)
+            except Exception as ex:
+                logger.warning(ex)
+                shared = None
+
+            if shared is not None:
+                return int(shared)
+
+        return accesses
+
+    def _touch(self, mirror_path, mirror_stat):
+        '''
+        Record that the copy was read by setting its access time, which
+        eviction goes by. The modification time is kept since it tells
+        whether the copy is up to date.
+        '''
+        now = time.time()
+
+        with self._lock:
+            if now - self._touched.get(mirror_path, 0) < TOUCH_INTERVAL:
+                return
+            self._touched[mirror_path] = now
+
+        try:
+            os.utime(mirror_path, ns=(int(now * 1e9), mirror_stat.st_mtime_ns))
+        except OSError:
+            pass
+
+    def _schedule(self, path):
+        with self._lock:
+            if path in self._copying:
+                return
+
+            self._copying.add(path)
+
+            if self._executor is None:
+                self._executor = cf.ThreadPoolExecutor(max_workers=1)
+
+            executor = self._executor
+
+        executor.submit(self._copy, path)
+
+    def _copy(self, path):
+        try:
+            self.copy(path)
+        except Exception as ex:
+            logger.warning('Error mirroring %s: %s', path, ex)
+        finally:
+            with self._lock:
+                self._copying.discard(path)
+
+    def copy(self, path):
+        '''
+        Copy a file to the cache directory unless another worker is
+        already doing so. Returns whether a copy was made.
+        '''
+        mirror_path = self.mirror_path(path)
+        os.makedirs(op.dirname(mirror_path), exist_ok=True)
+
+        with open(mirror_path + LOCK_SUFFIX, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # another worker is copying this file
+                return False
+
+            stat = os.stat(path)
+
+            try:
+                mirror_stat = os.stat(mirror_path)
+                if (
+                    mirror_stat.st_size == stat.st_size and
+                    mirror_stat.st_mtime_ns == stat.st_mtime_ns
+                ):
+                    # copied by another worker in the meantime
+                    return False
+            except OSError:
+                pass
+
+            if self.max_bytes > 0:
+                if stat.st_size > self.max_bytes:
+                    return False
+
+                self.evict(self.max_bytes - stat.st_size, exclude=mirror_path)
+
+            partial_path = mirror_path + PARTIAL_SUFFIX
+            shutil.copyfile(path, partial_path)
+            os.utime(partial_path, ns=(time.time_ns(), stat.st_mtime_ns))
+            os.replace(partial_path, mirror_path)
+
+            logger.info('Mirrored %s to %s', path, mirror_path)
+
+            return True
+
+    def wait(self):
+        '''
+        Wait for the scheduled copies to finish
+        '''
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def remove(self, path):
+        '''
+        Delete the copy of a file, e.g. when its tileset is deleted
+        '''
+        try:
+            os.remove(self.mirror_path(path))
+        except OSError:
+            pass
+
+    def mirrored_files(self):
+        '''
+        The complete copies in the cache directory as (path, stat) tuples
+        '''
+        files = []
+
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith((LOCK_SUFFIX, PARTIAL_SUFFIX)):
+                    continue
+
+                path = op.join(dirpath, filename)
+
+                try:
+                    files.append((path, os.stat(path)))
+                except OSError:
+                    pass
+
+        return files
+
+    def evict(self, max_bytes, exclude=None):
+        '''
+        Delete the least recently read copies until the remaining ones
+        take up at most max_bytes
+        '''
+        files = sorted(self.mirrored_files(), key=lambda f: f[1].st_atime)
+        total = sum(stat.st_size for _, stat in files)
+
+        for path, stat in files:
+            if total <= max_bytes:
+                break
+            if path == exclude:
+                continue
+
+            try:
+                os.remove(path)
+                total -= stat.st_size
+                logger.info('Evicted %s from the cache directory', path)
+            except OSError:
+                pass
+
+
+mirror = None
+
+if hss.CACHE_DIR is not None:
+    mirror = FileMirror(
+        hss.CACHE_DIR,
+        hss.CACHE_DIR_MAX_BYTES,
+        hss.CACHE_DIR_MIN_ACCESSES,
+        hu.getRdb(),
+    )
+
+
+def remove(path):
+    '''
+    Delete the copy of a data file if there is one
+    '''
+    if mirror is not None and path:
+        mirror.remove(path)
+
+
+def get_path(path):
+    '''
+    The path to read a data file from, see `FileMirror.path`
+    '''
+    if mirror is None or not path:
+        return path
+
+    return mirror.path(path)
@@ -85,6 +85,11 @@ class Tileset(models.Model):
     private = models.BooleanField(default=False)
     name = models.TextField(blank=True)
 
+    # the tileset info computed from the data file (as JSON) and the
+    # modification time of the data file when it was computed
+    tileset_info = models.TextField(default=None, blank=True, null=True)
+    tileset_info_mtime = models.FloatField(default=None, blank=True, null=True)
+
     class Meta:
         ordering = ("created",)
         permissions = (
@@ -0,0 +1,550 @@
+'''
+Read remote (http/https) data files with range requests.
+
+Tilesets registered as urls are stored with data file names like
+`https/example.com/file.hitile..`, which point into the simple-httpfs
+mount under MEDIA_ROOT. With REMOTE_RANGE_READER enabled, readers that
+accept file objects (h5py, i.e. hitile, hibed, multivec and cooler files)
+get a `RangeReader` for the url instead and skip the mount:
+
+    f = h5py.File(trr.open_remote(path), 'r')
+
+Files are read in blocks of REMOTE_BLOCK_SIZE bytes, which are shared by
+all the files of a worker in an in-process LRU cache of
+REMOTE_CACHE_MAX_BYTES bytes and, if REMOTE_CACHE_DIR is set, in a
+`DiskRDB` of REMOTE_CACHE_DIR_MAX_BYTES bytes shared by the workers of a
+machine. Adjacent missing blocks are fetched with a single request over
+a pool of keep-alive connections, concurrent reads of the same block wait
+for one request and the blocks following a read are prefetched in the
+background. How much is read ahead depends on the format, see
+READ_AHEAD.
+'''
+import collections as col
+import concurrent.futures as cf
+import io
+import logging
+import os
+import os.path as op
+import re
+import requests
+import requests.adapters
+import threading
+
+import higlass_server.cache as hc
+import higlass_server.disk_cache as hdc
+import higlass_server.settings as hss
+
+logger = logging.getLogger(__name__)
+
+REMOTE_SCHEMES = ('http', 'https')
+
+ReadAhead = col.namedtuple('ReadAhead', ['head', 'blocks'])
+ReadAhead.__doc__ = '''
+How a format is read ahead: `head` bytes at the start of the file are
+fetched when it's opened (-1 for the whole file) and `blocks` blocks are
+prefetched after every read.
+'''
+
+# by file extension, overridden by the REMOTE_READ_AHEAD setting
+READ_AHEAD = {
+    # indexes are small and read in full
+    '.bai': ReadAhead(-1, 0),
+    '.csi': ReadAhead(-1, 0),
+    '.tbi': ReadAhead(-1, 0),
+    # alignments are read sequentially from the offset found in the index
+    '.bam': ReadAhead(0, 4),
+    # the header, zoom level headers and chromosome tree come first
+    '.bw': ReadAhead(64 * 1024, 1),
+    '.bigwig': ReadAhead(64 * 1024, 1),
+    '.bb': ReadAhead(64 * 1024, 1),
+    '.bigbed': ReadAhead(64 * 1024, 1),
+    # HDF5 files start with the superblock and most of the object headers
+    # and B-trees, chunks are read at random
+    '.h5': ReadAhead(1024 ** 2, 0),
+    '.hdf5': ReadAhead(1024 ** 2, 0),
+    '.hitile': ReadAhead(1024 ** 2, 0),
+    '.hibed': ReadAhead(1024 ** 2, 0),
+    '.multires': ReadAhead(1024 ** 2, 0),
+    '.multivec': ReadAhead(1024 ** 2, 0),
+    '.cool': ReadAhead(1024 ** 2, 0),
+    '.mcool': ReadAhead(1024 ** 2, 0),
+}
+
+DEFAULT_READ_AHEAD = ReadAhead(0, 1)
+
+
+def read_ahead(url):
+    '''
+    The read ahead policy for a file, by the extension of its url
+    '''
+    ext = op.splitext(url.split('?')[0])[1].lower()
+
+    if ext in hss.REMOTE_READ_AHEAD:
+        return ReadAhead(*hss.REMOTE_READ_AHEAD[ext])
+
+    return READ_AHEAD.get(ext, DEFAULT_READ_AHEAD)
+
+
+def remote_url(path):
+    '''
+    The url of a remote data file given its path in the httpfs mount
+    (e.g. MEDIA_ROOT/https/example.com/file.hitile..) or None if it isn't
+    one
+    '''
+    path = op.abspath(path)
+    media_root = op.abspath(hss.MEDIA_ROOT)
+
+    if not path.startswith(media_root + os.sep) or not path.endswith('..'):
+        return None
+
+    scheme, _, rest = path[len(media_root) + 1:-2].partition(os.sep)
+
+    if scheme not in REMOTE_SCHEMES or not rest:
+        return None
+
+    return '{}://{}'.format(scheme, rest.replace(os.sep, '/'))
+
+
+class BlockCache(object):
+    '''
+    An in-process `LRUCache` of blocks in front of an optional `DiskRDB`
+    '''
+    def __init__(self, max_bytes, disk=None):
+        self.memory = hc.LRUCache(max_bytes)
+        self.disk = disk
+
+    def get(self, key):
+        block = self.memory.get(key)
+
+        if block is None and self.disk is not None:
+            block = self.disk.get(key)
+
+            if block is not None:
+                self.memory.set(key, block, len(block))
+
+        return block
+
+    def set(self, key, block):
+        self.memory.set(key, block, len(block))
+
+        if self.disk is not None:
+            self.disk.set(key, block)
+
+    def __contains__(self, key):
+        if key in self.memory._entries:
+            return True
+
+        return self.disk is not None and self.disk.exists(key)
+
+
+class RemoteFiles(object):
+    '''
+    Reads remote files in blocks through a `BlockCache`.
+
+    Parameters
+    ----------
+    cache: BlockCache
+        Where the blocks are kept
+    block_size: int
+        The size of the blocks in bytes
+    max_connections: int
+        The maximum number of connections kept open per host
+    prefetch_workers: int
+        The number of threads prefetching blocks
+    timeout: float
+        Seconds to wait for a server to connect or send data
+    '''
+    def __init__(self, cache, block_size=256 * 1024, max_connections=16,
+                 prefetch_workers=4, timeout=10.):
+        self.cache = cache
+        self.block_size = block_size
+        self.max_connections = max_connections
+        self.prefetch_workers = prefetch_workers
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._session = None
+        self._executor = None
+        self._inflight = {}
+        self._sizes = {}
+        self.requests = 0
+        self.bytes_fetched = 0
+
+    def _check_pid(self):
+        # must be called with the lock held
+        if self._pid != os.getpid():
+            # the connections and threads belonged to the parent process
+            self._reset()
+
+    def session(self):
+        '''
+        The session of this process, which keeps connections alive
+        '''
+        with self._lock:
+            self._check_pid()
+
+            if self._session is None:
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self.max_connections,
+                    pool_maxsize=self.max_connections,
+                    pool_block=True,
+                )
+                self._session = requests.Session()
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+
+            return self._session
+
+    def _get(self, url, headers):
+        response = self.session().get(
+            url, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+
+        with self._lock:
+            self.requests += 1
+            self.bytes_fetched += len(response.content)
+
+        return response
+
+    def size(self, url):
+        '''
+        The size of a remote file in bytes
+        '''
+        with self._lock:
+            self._check_pid()
+            size = self._sizes.get(url)
+
+        if size is not None:
+            return size
+
+        response = self._get(url, {'Range': 'bytes=0-0'})
+        content_range = response.headers.get('Content-Range', '')
+        match = re.match(r'bytes \d+-\d+/(\d+)', content_range)
+
+        if response.status_code == 206 and match:
+            size = int(match.group(1))
+        elif response.status_code == 200:
+            # the server doesn't do ranges and sent the whole file
+            size = len(response.content)
+        else:
+            raise OSError('No size for {}'.format(url))
+
+        with self._lock:
+            self._sizes[url] = size
+
+        return size
+
+    def fetch(self, url, start, end):
+        '''
+        Fetch the bytes from start to end (exclusive) of a remote file
+        '''
+        response = self._get(
+            url, {'Range': 'bytes={}-{}'.format(start, end - 1)})
+
+        if response.status_code == 206:
+            return response.content
+
+        # the whole file
+        return response.content[start:end]
+
+    def _key(self, url, size, index):
+        # the size stands in for a version, the block size for the layout
+        return 'remote:{}:{}:{}:{}'.format(url, size, self.block_size, index)
+
+    def blocks(self, url, size, indices):
+        '''
+        Get blocks of a remote file from the cache, fetching the missing
+        ones. Runs of adjacent missing blocks are fetched with one
+        request and blocks that are already being fetched by another
+        thread aren't fetched again.
+
+        Parameters
+        ----------
+        url: str
+            The url of the file
+        size: int
+            The size of the file, see `size`
+        indices: [int,...]
+            The indices of the blocks
+
+        Returns
+        -------
+        blocks: [bytes,...]
+            The blocks in the order of indices
+        '''
+        found = {}
+        missing = []
+
+        for index in indices:
+            block = self.cache.get(self._key(url, size, index))
+
+            if block is None:
+                missing.append(index)
+            else:
+                found[index] = block
+
+        if not missing:
+            return [found[index] for index in indices]
+
+        futures = {}
+        owned = []
+
+        with self._lock:
+            self._check_pid()
+
+            for index in missing:
+                key = self._key(url, size, index)
+                future = self._inflight.get(key)
+
+                if future is None:
+                    future = cf.Future()
+                    self._inflight[key] = future
+                    owned.append(index)
+
+                futures[index] = future
+
+        for first, last in runs(owned):
+            self._load(url, size, first, last, futures)
+
+        for index, future in futures.items():
+            found[index] = future.result()
+
+        return [found[index] for index in indices]
+
+    def _load(self, url, size, first, last, futures):
+        '''
+        Fetch the blocks first to last (inclusive) with one request and
+        resolve their futures
+        '''
+        keys = [self._key(url, size, i) for i in range(first, last + 1)]
+
+        try:
+            data = self.fetch(
+                url,
+                first * self.block_size,
+                min(size, (last + 1) * self.block_size)
+            )
+
+            for i, key in zip(range(first, last + 1), keys):
+                offset = (i - first) * self.block_size
+                block = data[offset:offset + self.block_size]
+
+                self.cache.set(key, block)
+                futures[i].set_result(block)
+        except Exception as ex:
+            for i in range(first, last + 1):
+                if not futures[i].done():
+                    futures[i].set_exception(ex)
+        finally:
+            with self._lock:
+                for key in keys:
+                    self._inflight.pop(key, None)
+
+    def prefetch(self, url, size, indices):
+        '''
+        Fetch blocks in the background, with up to prefetch_workers
+        requests in parallel
+        '''
+        indices = [
+            index for index in indices
+            if self._key(url, size, index) not in self.cache and
+            self._key(url, size, index) not in self._inflight
+        ]
+
+        if not indices or self.prefetch_workers <= 0:
+            return
+
+        with self._lock:
+            self._check_pid()
+
+            if self._executor is None:
+                self._executor = cf.ThreadPoolExecutor(
+                    max_workers=self.prefetch_workers)
+
+            executor = self._executor
+
+        per_worker = -(-len(indices) // self.prefetch_workers)
+
+        for i in range(0, len(indices), per_worker):
+            executor.submit(
+                self._prefetch, url, size, indices[i:i + per_worker])
+
+    def _prefetch(self, url, size, indices):
+        try:
+            self.blocks(url, size, indices)
+        except Exception as ex:
+            logger.warning('Error prefetching %s: %s', url, ex)
+
+    def read(self, url, size, offset, length, read_ahead_blocks=0):
+        '''
+        Read length bytes at offset of a remote file and prefetch the
+        read_ahead_blocks blocks after them
+        '''
+        end = min(size, offset + length)
+
+        if end <= offset:
+            return b''
+
+        first = offset // self.block_size
+        last = (end - 1) // self.block_size
+        num_blocks = -(-size // self.block_size)
+
+        if read_ahead_blocks > 0:
+            self.prefetch(url, size, range(
+                last + 1, min(num_blocks, last + 1 + read_ahead_blocks)))
+
+        data = b''.join(self.blocks(url, size, range(first, last + 1)))
+        start = offset - first * self.block_size
+
+        return data[start:start + end - offset]
+
+    def wait(self):
+        '''
+        Wait for the scheduled prefetches to finish
+        '''
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'bytes_fetched': self.bytes_fetched,
+            'blocks': self.cache.memory.stats(),
+        }
+
+
+def runs(indices):
+    '''
+    Split sorted indices into runs of consecutive ones, as (first, last)
+    tuples
+    '''
+    result = []
+
+    for index in indices:
+        if result and result[-1][1] == index - 1:
+            result[-1] = (result[-1][0], index)
+        else:
+            result.append((index, index))
+
+    return result
+
+
+class RangeReader(io.RawIOBase):
+    '''
+    A read-only, seekable file object for a remote file.
+
+    Parameters
+    ----------
+    url: str
+        The url of the file
+    files: RemoteFiles
+        Where the blocks are read from, defaults to the ones of this
+        process
+    policy: ReadAhead or None
+        How the file is read ahead, see `read_ahead`
+    '''
+    def __init__(self, url, files=None, policy=None):
+        super().__init__()
+
+        self.url = url
+        self.files = files or remote_files()
+        self.policy = policy or read_ahead(url)
+        self.size = self.files.size(url)
+        self._pos = 0
+
+        if self.policy.head != 0:
+            head = self.size if self.policy.head < 0 else min(
+                self.size, self.policy.head)
+            self.files.prefetch(url, self.size, range(
+                -(-head // self.files.block_size)))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError('Invalid whence: {}'.format(whence))
+
+        if pos < 0:
+            raise OSError('Negative seek position {}'.format(pos))
+
+        self._pos = pos
+        return pos
+
+    def readinto(self, buffer):
+        try:
+            data = self.files.read(
+                self.url, self.size, self._pos, len(buffer),
+                self.policy.blocks)
+        except requests.RequestException as ex:
+            raise OSError('Error reading {}: {}'.format(self.url, ex))
+
+        buffer[:len(data)] = data
+        self._pos += len(data)
+
+        return len(data)
+
+
+_remote_files = None
+_remote_files_lock = threading.Lock()
+
+
+def remote_files():
+    '''
+    The `RemoteFiles` shared by the readers of this process
+    '''
+    global _remote_files
+
+    with _remote_files_lock:
+        if _remote_files is None:
+            disk = None
+
+            if hss.REMOTE_CACHE_DIR:
+                disk = hdc.DiskRDB(
+                    hss.REMOTE_CACHE_DIR, hss.REMOTE_CACHE_DIR_MAX_BYTES)
+
+            _remote_files = RemoteFiles(
+                BlockCache(hss.REMOTE_CACHE_MAX_BYTES, disk),
+                block_size=hss.REMOTE_BLOCK_SIZE,
+                max_connections=hss.REMOTE_MAX_CONNECTIONS,
+                prefetch_workers=hss.REMOTE_PREFETCH_WORKERS,
+                timeout=hss.REMOTE_TIMEOUT,
+            )
+
+        return _remote_files
+
+
+def open_remote(path):
+    '''
+    Get a `RangeReader` for a data file in the httpfs mount or None if
+    it isn't remote or REMOTE_RANGE_READER is disabled
+    '''
+    if not hss.REMOTE_RANGE_READER:
+        return None
+
+    url = remote_url(path)
+
+    if url is None:
+        return None
+
+    return RangeReader(url)
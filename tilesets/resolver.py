@@ -0,0 +1,273 @@
+'''
+Resolve tileset uuids to the metadata needed to serve them.
+
+The hot endpoints (tiles, tileset_info, fragments) only need a handful of
+fields of a tileset. They are loaded for all requested uuids with a single
+query and kept as immutable records in a per-process cache. Entries are
+dropped when a tileset is saved or deleted in this process (see
+`tilesets.apps`). Saves and deletes also replace the generation token of
+the tileset in the shared cache (see `getRdb`), which the other processes
+check their records against every TILESET_RESOLVER_CHECK_INTERVAL seconds,
+so that a tileset that was made private or deleted elsewhere stops being
+served soon after. All records are reloaded after TILESET_RESOLVER_TTL
+seconds.
+
+Every record carries a version token derived from the identity of the
+tileset and its data files (see `version_token`). It is part of the keys
+under which tiles and fragments are cached, so that replacing, modifying
+or deleting a tileset orphans all of its cached entries at once instead
+of having to find and delete them.
+'''
+import collections as col
+import hashlib
+import logging
+import os
+import time
+
+import higlass_server.settings as hss
+import higlass_server.utils as hu
+import tilesets.models as tm
+
+logger = logging.getLogger(__name__)
+
+
+class FileRef(col.namedtuple('FileRef', ['name', 'path'])):
+    '''
+    The name (relative to the storage) and the local path of a data file,
+    standing in for the model's FieldFile
+    '''
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+    def __bool__(self):
+        return bool(self.name)
+
+
+class TilesetRecord(col.namedtuple('TilesetRecord', [
+    'uuid', 'filetype', 'datatype', 'datafile', 'indexfile', 'private',
+    'owner_id', 'coordSystem', 'coordSystem2', 'name', 'tileset_info',
+    'tileset_info_mtime', 'version'
+])):
+    '''
+    The metadata of a tileset. It has the same attributes as the Tileset
+    model for everything the tile generation code needs.
+    '''
+    __slots__ = ()
+
+    def readable_by(self, user):
+        '''
+        Whether the user (e.g. request.user) may read this tileset
+        '''
+        if not self.private:
+            return True
+
+        return user.is_authenticated and user.id == self.owner_id
+
+
+def _file_ref(field_file):
+    if not field_file:
+        return FileRef('', None)
+
+    try:
+        return FileRef(field_file.name, field_file.path)
+    except (NotImplementedError, ValueError):
+        # the storage has no local paths
+        return FileRef(field_file.name, None)
+
+
+def _file_identity(file_ref):
+    if file_ref.path is None:
+        return None
+
+    try:
+        st = os.stat(file_ref.path)
+    except OSError:
+        return None
+
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def version_token(tileset, datafile=None, indexfile=None):
+    '''
+    A short token which changes whenever the data served for a tileset
+    may change: when it's re-created (even under the same uuid), when its
+    filetype or data files are replaced and when a data file is modified
+    in place.
+
+    Parameters
+    ----------
+    tileset: tilesets.models.Tileset
+        The tileset
+    datafile, indexfile: FileRef or None
+        The files of the tileset if they were already looked up
+
+    Returns
+    -------
+    version: str
+        A hex string
+    '''
+    if datafile is None:
+        datafile = _file_ref(tileset.datafile)
+    if indexfile is None:
+        indexfile = _file_ref(tileset.indexfile)
+
+    parts = (
+        tileset.pk,
+        tileset.filetype,
+        tileset.datatype,
+        datafile.name,
+        _file_identity(datafile),
+        indexfile.name,
+        _file_identity(indexfile),
+    )
+
+    return hashlib.blake2b(
+        repr(parts).encode('utf-8'), digest_size=8
+    ).hexdigest()
+
+
+def to_record(tileset):
+    '''
+    Create the record for a Tileset model instance
+    '''
+    datafile = _file_ref(tileset.datafile)
+    indexfile = _file_ref(tileset.indexfile)
+
+    return TilesetRecord(
+        uuid=tileset.uuid,
+        filetype=tileset.filetype,
+        datatype=tileset.datatype,
+        datafile=datafile,
+        indexfile=indexfile,
+        private=tileset.private,
+        owner_id=tileset.owner_id,
+        coordSystem=tileset.coordSystem,
+        coordSystem2=tileset.coordSystem2,
+        name=tileset.name,
+        tileset_info=tileset.tileset_info,
+        tileset_info_mtime=tileset.tileset_info_mtime,
+        version=version_token(tileset, datafile, indexfile),
+    )
+
+
+_Entry = col.namedtuple('_Entry', ['record', 'generation', 'expires', 'checked'])
+
+_records = {}
+
+GENERATION_PREFIX = 'tileset_resolver:generation:'
+
+
+def _shared_generations(uuids):
+    '''
+    The generation tokens of a number of tilesets in the shared cache, None
+    for the tilesets that were never changed (or if it can't be reached)
+    '''
+    try:
+        return hu.getRdb().mget([GENERATION_PREFIX + uuid for uuid in uuids])
+    except Exception as ex:
+        logger.warning(ex)
+        return [None] * len(uuids)
+
+
+def publish_generations(uuids):
+    '''
+    Make all processes reload the records of a number of tilesets
+    '''
+    try:
+        pipe = hu.getRdb().pipeline(transaction=False)
+
+        for uuid in uuids:
+            pipe.set(GENERATION_PREFIX + uuid, os.urandom(8).hex())
+
+        pipe.execute()
+    except Exception as ex:
+        # the other processes pick up the change after TILESET_RESOLVER_TTL
+        logger.warning(ex)
+
+
+def resolve(uuids):
+    '''
+    Get the records of a number of tilesets.
+
+    Records older than TILESET_RESOLVER_CHECK_INTERVAL are checked
+    against the generation tokens in the shared cache, in one round trip,
+    and reloaded if their tileset was changed by another process.
+
+    Parameters
+    ----------
+    uuids: iterable of str
+        The uuids of the tilesets
+
+    Returns
+    -------
+    records: {uuid: TilesetRecord}
+        The records of the tilesets that exist
+    '''
+    now = time.monotonic()
+    records = {}
+    to_check = {}
+    to_load = set()
+
+    for uuid in uuids:
+        entry = _records.get(uuid)
+
+        if entry is None or entry.expires <= now:
+            to_load.add(uuid)
+        elif entry.checked + hss.TILESET_RESOLVER_CHECK_INTERVAL <= now:
+            to_check[uuid] = entry
+        else:
+            records[uuid] = entry.record
+
+    if not to_check and not to_load:
+        return records
+
+    uuids = list(to_check) + list(to_load)
+    generations = dict(zip(uuids, _shared_generations(uuids)))
+
+    for uuid, entry in to_check.items():
+        if entry.generation == generations[uuid]:
+            _records[uuid] = entry._replace(checked=now)
+            records[uuid] = entry.record
+        else:
+            to_load.add(uuid)
+
+    if to_load:
+        expires = now + hss.TILESET_RESOLVER_TTL
+        loaded = tm.Tileset.objects.in_bulk(list(to_load), field_name='uuid')
+
+        for uuid in to_load:
+            _records.pop(uuid, None)
+
+        for uuid, tileset in loaded.items():
+            record = to_record(tileset)
+            _records[uuid] = _Entry(record, generations[uuid], expires, now)
+            records[uuid] = record
+
+    return records
+
+
+def get(uuid):
+    '''
+    Get the record of a single tileset or None if it doesn't exist
+    '''
+    return resolve([uuid]).get(uuid)
+
+
+def invalidate(uuid=None):
+    '''
+    Drop a tileset (or all tilesets if no uuid is given) from the cache
+    '''
+    if uuid is None:
+        _records.clear()
+    else:
+        _records.pop(uuid, None)
+
+
+def tileset_changed(sender, instance, **kwargs):
+    '''
+    Receiver for the post_save and post_delete signals of Tileset
+    '''
+    invalidate(instance.uuid)
+    publish_generations([instance.uuid])
@@ -11,18 +11,42 @@ import base64
 import django.test as dt
 import h5py
 import clodius.tiles.cooler as hgco
+import cooler
 import json
 import logging
 import os
 import os.path as op
 import numpy as np
+import pandas as pd
 import rest_framework.status as rfs
 import tilesets.models as tm
+import higlass_server.cache as hc
+import higlass_server.disk_cache as hdc
 import higlass_server.settings as hss
+import higlass_server.tests as hst
+import tilesets.aggregation as tagg
+import tilesets.chromsizes as tcs
+import tilesets.cooler_state as tco
+import tilesets.file_handles as tfh
+import tilesets.mirror as tmi
+import tilesets.range_reader as trr
 import tilesets.generate_tiles as tgt
+import tilesets.management.commands.warm_tiles as tmcw
+import tilesets.resolver as tsr
+import tilesets.tile_encoding as tte
+import tilesets.tile_store as tts
+import tilesets.views as tsv
+import fcntl
+import functools
+import http.server
+import io
+import re
 import slugid
+import tempfile
+import threading
+import time
 
-from unittest import skip
+from unittest import mock, skip
 
 logger = logging.getLogger(__name__)
 
@@ -377,6 +401,1187 @@ class TileTests(dt.TestCase):
 
         assert(len(result) == 1)
 
+    def test_tile_rectangles(self):
+        # a full 12x10 screen of tiles is read in one query
+        tile_ids = ['a.5.{}.{}.default'.format(x, y)
+            for x in range(12) for y in range(10)]
+        rectangles = tgt.tile_rectangles(tile_ids)
+
+        assert(len(rectangles) == 1)
+        assert(rectangles[0].start == (0, 0) and rectangles[0].end == (11, 9))
+        assert(rectangles[0].transform == 'default')
+        assert(len(rectangles[0].tile_ids) == 120)
+
+        # an L of adjacent tiles is split rather than read as a square
+        tile_ids = ['a.5.{}.0'.format(x) for x in range(8)] + \
+            ['a.5.0.{}'.format(y) for y in range(1, 8)]
+        rectangles = tgt.tile_rectangles(tile_ids)
+
+        assert(len(rectangles) > 1)
+        assert(sum(len(r.tile_ids) for r in rectangles) == 15)
+        for r in rectangles:
+            area = (r.end[0] - r.start[0] + 1) * (r.end[1] - r.start[1] + 1)
+            assert(len(r.tile_ids) >= area * (1 - hss.TILE_RECTANGLE_MAX_WASTE))
+
+        rectangles = tgt.tile_rectangles(['a.1.0.1', 'a.1.2.0'],
+            in_bounds=lambda zoom, position: max(position) < 2 ** zoom)
+        assert([r.tile_ids for r in rectangles] == [{(0, 1): 'a.1.0.1'}])
+
+    def test_split_by_zoom(self):
+        tileset = tm.Tileset(uuid='a', filetype='unknown', datafile='uploads/a')
+        tasks = tgt.split_by_zoom((tileset, ["a.5.0", "a.5.1", "a.6.2"], False, None))
+
+        assert(len(tasks) == 2)
+        assert(sorted(len(t[1]) for t in tasks) == [1, 2])
+
+        for tile_ids in [["a", "a.5.0"], ["a.x.0", "a.6.2"]]:
+            tasks = tgt.split_by_zoom((tileset, tile_ids, False, None))
+            assert(len(tasks) == 1)
+            assert(tasks[0][1] == tile_ids)
+
+    def test_generate_tiles_parallel(self):
+        tileset = tm.Tileset(uuid='a', filetype='unknown', datafile='uploads/a')
+        tile_ids = ["a.5.0", "a.5.1", "a.6.2"]
+        executor = hss.TILE_GENERATION_EXECUTOR
+
+        def generate_tiles(tileset_tile_ids):
+            return [(t, {'dense': np.zeros(4)}) for t in tileset_tile_ids[1]]
+
+        try:
+            with mock.patch.object(tgt, 'generate_tiles', generate_tiles):
+                for mode in ['serial', 'thread']:
+                    hss.TILE_GENERATION_EXECUTOR = mode
+                    tiles = dict(tgt.generate_tiles_parallel(
+                        [(tileset, tile_ids, False, None)]))
+
+                    assert(sorted(tiles.keys()) == tile_ids)
+                    assert(tiles['a.6.2']['dense'].shape == (4,))
+        finally:
+            hss.TILE_GENERATION_EXECUTOR = executor
+
+    def test_generate_tiles_process(self):
+        tileset = tm.Tileset(uuid='a', filetype='unknown', datafile='uploads/a')
+        tile_ids = ["a.5.0", "a.5.1", "a.6.2", "a.7.0"]
+        executor = hss.TILE_GENERATION_EXECUTOR
+
+        def generate_tiles(tileset_tile_ids):
+            if 'a.5.0' in tileset_tile_ids[1] and tileset.name == 'fail':
+                raise ValueError('failed')
+
+            return [(t, {'dense': np.arange(4, dtype=np.float32)})
+                for t in tileset_tile_ids[1]]
+
+        def shared_blocks():
+            return set(os.listdir('/dev/shm'))
+
+        blocks = shared_blocks()
+
+        try:
+            hss.TILE_GENERATION_EXECUTOR = 'process'
+            tgt._executor = None
+
+            with mock.patch.object(tgt, 'generate_tiles', generate_tiles):
+                tiles = dict(tgt.generate_tiles_parallel(
+                    [(tileset, tile_ids, False, None)]))
+
+                assert(sorted(tiles.keys()) == tile_ids)
+                assert(tiles['a.7.0']['dense'].tolist() == [0, 1, 2, 3])
+                assert(shared_blocks() == blocks)
+
+                tileset.name = 'fail'
+                tgt._executor.shutdown()
+                tgt._executor = None
+
+                with self.assertRaises(ValueError):
+                    tgt.generate_tiles_parallel(
+                        [(tileset, tile_ids, False, None)])
+
+                assert(shared_blocks() == blocks)
+        finally:
+            hss.TILE_GENERATION_EXECUTOR = executor
+
+            if tgt._executor is not None:
+                tgt._executor.shutdown()
+                tgt._executor = None
+
+
+class AggregationTest(dt.TestCase):
+    def test_aggregate(self):
+        dense = np.random.RandomState(1).rand(12, 16).astype(np.float32)
+        dense[3, 2] = np.nan
+        agg_groups = [[0, 1], 5, [2, 3, 4], [11, 0, 7, 7], [6]]
+        plan = tagg.compile_groups(agg_groups)
+
+        assert(list(plan.starts) == [0, 2, 3, 6, 10])
+
+        for agg_func_name, agg_func in tagg.AGG_FUNCS.items():
+            expected = np.array([agg_func(dense[g if type(g) == list else [g]])
+                for g in agg_groups])
+            aggregated = tagg.aggregate(dense, plan, agg_func_name)
+
+            assert(aggregated.shape == (5, 16))
+            assert(aggregated.dtype == expected.dtype)
+            assert(np.allclose(aggregated, expected, equal_nan=True, rtol=1e-5))
+
+        # half precision tiles keep their dtype
+        for agg_func_name in ['sum', 'mean', 'std', 'max']:
+            aggregated = tagg.aggregate(dense.astype(np.float16), plan, agg_func_name)
+            assert(aggregated.dtype == np.float16)
+
+        # empty groups are aggregated one by one
+        plan = tagg.compile_groups([[0, 1], []])
+        assert(np.array_equal(tagg.aggregate(dense, plan, 'sum')[1], np.zeros(16)))
+
+    def test_plan_cache(self):
+        options = {'aggGroups': [[0, 1], [2]], 'aggFunc': 'sum', 'options_hash': 'h'}
+
+        with mock.patch.object(tagg, 'plans', hc.LRUCache(1024)), \
+                mock.patch.object(tagg, 'compile_groups',
+                    mock.Mock(wraps=tagg.compile_groups)) as compile_groups:
+            tiles = tgt.generate_1d_tiles('f', ['a.0.0', 'a.0.1'],
+                lambda filename, pos: np.arange(8.).reshape(4, 2), options)
+            tgt.generate_1d_tiles('f', ['a.0.2'],
+                lambda filename, pos: np.arange(8.).reshape(4, 2), options)
+
+        # compiled once for all tiles and requests with the same options
+        assert(compile_groups.call_count == 1)
+        assert(tiles[0][1]['shape'] == (2, 2))
+        assert(np.array_equal(tiles[0][1]['dense'], [[2, 4], [4, 5]]))
+
+    def test_base_tiles(self):
+        reads = []
+
+        def get_multivec_tile(filename, tile_pos):
+            reads.append(tuple(tile_pos))
+            return np.arange(12, dtype=np.float32).reshape(4, 3) * (tile_pos[1] + 1)
+
+        tileset = mock.Mock(filetype='multivec', version='v1',
+            datafile=tsr.FileRef('mv', 'mv'))
+        base_tile_cache = hc.TieredCache(hst.CountingRDB(), 2 ** 20,
+            tgt._unpack_base_tile, tgt._pack_base_tile)
+
+        with mock.patch.object(tgt, 'get_multivec_tile', get_multivec_tile), \
+                mock.patch.object(tgt, 'base_tile_cache', base_tile_cache):
+            sums = dict(tgt.generate_live_tiles((tileset, ['m.1.0', 'm.1.1'], False,
+                {'aggGroups': [[0, 1], [2, 3]], 'aggFunc': 'sum', 'options_hash': 's'})))
+            maxes = dict(tgt.generate_live_tiles((tileset, ['m.1.1'], False,
+                {'aggGroups': [[0, 3]], 'aggFunc': 'max', 'options_hash': 'm'})))
+
+            # every aggregation of a tile is computed from one read
+            assert(reads == [(1, 0), (1, 1)])
+            assert(np.array_equal(sums['m.1.1']['dense'], [[6, 10, 14], [30, 34, 38]]))
+            assert(np.array_equal(maxes['m.1.1']['dense'], [[18, 20, 22]]))
+
+            # a new version of the tileset is read again
+            tileset.version = 'v2'
+            tgt.generate_live_tiles((tileset, ['m.1.1'], False,
+                {'aggGroups': [[0]], 'aggFunc': 'sum'}))
+            assert(reads == [(1, 0), (1, 1), (1, 1)])
+
+            # raw tiles larger than MULTIVEC_BASE_TILE_MAX_BYTES aren't cached
+            with mock.patch.object(tgt, 'base_tile_policy',
+                    hc.TileCachePolicy(max_entry_bytes=16)):
+                for i in range(2):
+                    tgt.get_base_multivec_tiles(tileset, ['m.2.0'])
+            assert(reads[3:] == [(2, 0), (2, 0)])
+
+            assert(len(base_tile_cache.local) == 3)
+            base_tile_cache.invalidate_prefix('m.')
+            assert(len(base_tile_cache.local) == 0)
+
+
+class TileEncodingTest(dt.TestCase):
+    def setUp(self):
+        tm.Tileset.objects.create(uuid='a', filetype='multivec', datafile='uploads/a')
+
+    def test_binary_round_trip(self):
+        dense = np.arange(12, dtype=np.float16).reshape((3, 4))
+        tiles = [
+            ('a.0.0', {'dense': dense, 'dtype': 'float16', 'shape': dense.shape}),
+            ('a.0.1', {'dense': base64.b64encode(dense).decode('utf-8'),
+                'dtype': 'float16', 'shape': [3, 4], 'min_value': 0}),
+            ('a.1.0', {'error': 'Out of bounds'}),
+            # imtiles tiles hold base64 encoded images without a dtype
+            ('a.1.1', {'dense': base64.b64encode(b'\x89PNG\r').decode('utf-8')}),
+        ]
+
+        decoded = tte.decode_binary(tte.encode_binary(tiles))
+
+        assert(np.array_equal(decoded['a.0.0']['dense'], dense))
+        assert(decoded['a.0.0']['shape'] == [3, 4])
+        assert(np.array_equal(decoded['a.0.1']['dense'], dense))
+        assert(decoded['a.0.1']['min_value'] == 0)
+        assert(decoded['a.1.0'] == {'error': 'Out of bounds'})
+        assert(decoded['a.1.1'] == tiles[3][1])
+
+    def test_encode_dense(self):
+        dense = np.array([[0.5, 1], [2, -3]])
+        assert(tte.encode_dense(dense, 'auto')['dtype'] == 'float16')
+        assert(tte.encode_dense(dense, 'float32')['dtype'] == 'float32')
+        assert(tte.encode_dense(np.array([]), 'auto')['dtype'] == 'float16')
+        assert(tte.encode_dense(np.array([1, 1e6]), 'auto')['dtype'] == 'float32')
+        assert(tte.encode_dense(np.array([1, -np.inf]), 'auto')['dtype'] == 'float32')
+
+        dense = np.array([1, np.nan, 2], dtype=np.float32)
+        assert(tte.encode_dense(dense, 'auto')['dtype'] == 'float32')
+        assert(tte.encode_dense(dense, 'auto')['dense'] is dense)
+
+        tile_value = tte.encode_dense(dense, 'float16-nan')
+        assert(tile_value['dtype'] == 'float16')
+        assert(np.isnan(tile_value['dense'][1]))
+        assert(tte.encode_dense(
+            np.array([np.nan, 1e6]), 'float16-nan')['dtype'] == 'float32')
+
+        with self.assertRaises(ValueError):
+            tte.encode_dense(dense, 'float8')
+
+    def test_get_tiles(self):
+        dense = np.linspace(0, 1, 8, dtype=np.float32)
+
+        def generate_tiles(tileset_tile_ids):
+            return [(t, {'dense': dense, 'dtype': 'float32'})
+                for t in tileset_tile_ids[1]]
+
+        with mock.patch.object(tgt, 'generate_tiles', generate_tiles):
+            ret = self.client.get('/api/v1/tiles/?d=a.0.0')
+            content = json.loads(ret.content.decode('utf-8'))
+            q = np.frombuffer(base64.b64decode(content['a.0.0']['dense']), dtype=np.float32)
+            assert(np.array_equal(q, dense))
+
+            ret = self.client.get('/api/v1/tiles/?d=a.0.0&format=hgtiles')
+            assert(ret['Content-Type'] == tte.BINARY_MEDIA_TYPE)
+            assert(np.array_equal(tte.decode_binary(ret.content)['a.0.0']['dense'], dense))
+
+            ret = self.client.get('/api/v1/tiles/?d=a.0.0',
+                HTTP_ACCEPT=tte.BINARY_MEDIA_TYPE)
+            assert(ret['Content-Type'] == tte.BINARY_MEDIA_TYPE)
+
+
+    def test_fragments(self):
+        tiles = [('a.0.0', {'min_value': 1.5, 'x': [1, 2]}), ('a.0.1', {'error': 'x'})]
+
+        spliced = tte.splice_json(
+            (tile_id, tte.encode_fragment(tile_value)) for tile_id, tile_value in tiles)
+        assert(json.loads(spliced.decode('utf-8')) == dict(tiles))
+        assert(tte.splice_json([]) == b'{}')
+
+        fragment = tte.encode_fragment(tiles[0][1])
+        for compression in ('', 'zlib'):
+            assert(tte.unpack_fragment(
+                tte.pack_fragment(fragment, compression)) == fragment)
+        # entries which weren't written as fragments are misses
+        assert(tte.unpack_fragment(b'\x80\x03}q\x00.') is None)
+
+    def test_cached_tiles(self):
+        calls = []
+
+        def generate_tiles(tileset_tile_ids):
+            calls.extend(tileset_tile_ids[1])
+            return [(t, {'dense': np.ones(4, dtype=np.float32), 'dtype': 'float32'})
+                for t in tileset_tile_ids[1]]
+
+        rdb = hst.CountingRDB()
+        cache = hc.TieredCache(rdb, 0, tte.unpack_fragment, tte.pack_fragment)
+
+        with mock.patch.object(tgt, 'generate_tiles', generate_tiles), \
+                mock.patch.object(tsv, 'tile_cache', cache):
+            first = self.client.get('/api/v1/tiles/?d=a.0.0&d=a.1.0')
+            second = self.client.get('/api/v1/tiles/?d=a.0.0&d=a.1.0&d=a.1.1')
+            binary = self.client.get('/api/v1/tiles/?d=a.0.0&format=hgtiles')
+
+        # the binary fragments are cached separately
+        assert(sorted(calls) == ['a.0.0', 'a.0.0', 'a.1.0', 'a.1.1'])
+        assert(second['Content-Type'] == 'application/json')
+
+        first = json.loads(first.content.decode('utf-8'))
+        second = json.loads(second.content.decode('utf-8'))
+        assert(second['a.0.0'] == first['a.0.0'])
+        assert(np.array_equal(
+            tte.decode_binary(binary.content)['a.0.0']['dense'], np.ones(4)))
+
+        # nothing in the shared cache is pickled
+        assert(all(v[:1] in (b'\x00', b'\x01') for v in rdb.data.values()))
+
+
+class FileHandlePoolTest(dt.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_file(self, name):
+        path = op.join(self.tmpdir.name, name)
+
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('x', data=np.arange(10))
+
+        return path
+
+    def test_eviction(self):
+        pool = tfh.HandlePool(max_open=2, idle_timeout=60)
+        paths = [self.make_file('{}.h5'.format(i)) for i in range(3)]
+
+        with pool.borrow(paths[0]) as f0:
+            with pool.borrow(paths[0]) as f:
+                # the same handle is handed out again
+                assert(f is f0)
+
+            with pool.borrow(paths[1]), pool.borrow(paths[2]):
+                assert(len(pool) == 3)
+
+            # the borrowed handle stays open, the least recently used
+            # idle one is closed
+            assert(len(pool) == 2)
+            assert(f0['x'][3] == 3)
+
+        with pool.borrow(paths[1]):
+            pass
+        with pool.borrow(paths[2]):
+            pass
+        # paths[0] is now the least recently used one
+        assert(not f0)
+
+        pool.idle_timeout = 0
+        time.sleep(0.01)
+        with pool.borrow(paths[0]):
+            pass
+        assert(len(pool) == 0)
+
+    def test_state_and_fork(self):
+        pool = tfh.HandlePool(max_open=2, idle_timeout=60)
+        path = self.make_file('a.h5')
+        calls = []
+
+        def compute(f):
+            calls.append(1)
+            return int(f['x'][-1])
+
+        assert(pool.state(path, 'last', compute) == 9)
+        assert(pool.state(path, 'last', compute) == 9)
+        assert(len(calls) == 1)
+
+        pool.close(path)
+        assert(len(pool) == 0)
+        assert(pool.state(path, 'last', compute) == 9)
+        assert(len(calls) == 2)
+
+        pool._pid = -1
+        with pool.borrow(path):
+            assert(len(pool) == 1)
+        assert(pool._pid == os.getpid())
+
+    def test_state_budget(self):
+        pool = tfh.HandlePool(max_open=4, idle_timeout=60, max_state_bytes=100)
+        paths = [self.make_file('{}.h5'.format(i)) for i in range(2)]
+        calls = []
+
+        def compute(f):
+            calls.append(1)
+            return np.zeros(6)
+
+        def nbytes(state):
+            return state.nbytes
+
+        pool.state(paths[0], 'a', compute, nbytes=nbytes)
+        pool.state(paths[1], 'a', compute, nbytes=nbytes)
+        assert(pool.state_nbytes == 96)
+
+        # the least recently used state is dropped, the handle stays open
+        pool.state(paths[0], 'a', compute, nbytes=nbytes)
+        pool.state(paths[0], 'b', compute, nbytes=nbytes)
+        assert(pool.state_nbytes == 96)
+        assert(len(calls) == 3)
+        pool.state(paths[1], 'a', compute, nbytes=nbytes)
+        assert(len(calls) == 4)
+        assert(len(pool) == 2)
+
+        pool.close()
+        assert(pool.state_nbytes == 0)
+
+    def test_multivec_tile(self):
+        import clodius.tiles.multivec as ctmu
+
+        path = op.join(self.tmpdir.name, 'a.multires.mv5')
+
+        with h5py.File(path, 'w') as f:
+            f.create_group('info').attrs['tile-size'] = 4
+            f.create_group('chroms')
+            f['chroms'].create_dataset('name', data=np.array([b'chr1', b'chr2']))
+            f['chroms'].create_dataset('length', data=np.array([10, 7]))
+
+            for resolution in [1, 2, 4]:
+                values = f.create_group('resolutions/{}/values'.format(resolution))
+                for chrom, length in [('chr1', 10), ('chr2', 7)]:
+                    n = -(-length // resolution)
+                    values.create_dataset(chrom,
+                        data=np.arange(3 * n, dtype=np.float32).reshape((n, 3)))
+
+        for tile_pos in [(0, 0), (1, 1), (2, 1), (2, 4)]:
+            assert(np.array_equal(
+                tgt.get_multivec_tile(path, tile_pos),
+                ctmu.get_single_tile(path, tile_pos)))
+
+
+class FileMirrorTest(dt.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_dir = op.join(self.tmpdir.name, 'cache')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_file(self, name, size):
+        path = op.join(self.tmpdir.name, 'media', name)
+        os.makedirs(op.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+
+        return path
+
+    def test_mirror(self):
+        mirror = tmi.FileMirror(self.cache_dir, min_accesses=2)
+        path = self.make_file('a.hitile', 100)
+        mirror_path = mirror.mirror_path(path)
+
+        assert(mirror_path.startswith(self.cache_dir))
+
+        # read from the original until the copy is complete
+        assert(mirror.path(path) == path)
+        mirror.wait()
+        assert(not op.exists(mirror_path))
+
+        assert(mirror.path(path) == path)
+        mirror.wait()
+        assert(mirror.path(path) == mirror_path)
+        assert(mirror.path(mirror_path) == mirror_path)
+
+        # the copy is out of date
+        with open(path, 'ab') as f:
+            f.write(b'y')
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+        assert(mirror.path(path) == path)
+        mirror.wait()
+        assert(mirror.path(path) == mirror_path)
+
+    def test_shared_accesses(self):
+        rdb = hdc.DiskRDB(op.join(self.tmpdir.name, 'rdb'), 10000, shards=1)
+        workers = [tmi.FileMirror(self.cache_dir, min_accesses=2, rdb=rdb)
+            for i in range(2)]
+        path = self.make_file('a.hitile', 100)
+
+        # the reads of all workers count
+        assert(workers[0].path(path) == path)
+        assert(workers[1].path(path) == path)
+        workers[1].wait()
+        assert(workers[0].path(path) == workers[0].mirror_path(path))
+        assert(rdb.get(tmi.ACCESS_PREFIX + path) == b'2')
+
+    def test_single_copy(self):
+        mirror = tmi.FileMirror(self.cache_dir)
+        path = self.make_file('a.hitile', 100)
+        mirror_path = mirror.mirror_path(path)
+        os.makedirs(op.dirname(mirror_path))
+
+        with open(mirror_path + tmi.LOCK_SUFFIX, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # another worker holds the lock
+            assert(not mirror.copy(path))
+
+        assert(mirror.copy(path))
+        assert(not mirror.copy(path))
+
+    def test_eviction(self):
+        mirror = tmi.FileMirror(self.cache_dir, max_bytes=250)
+        paths = [self.make_file('f{}'.format(i), 100) for i in range(3)]
+
+        mirror.copy(paths[0])
+        mirror.copy(paths[1])
+        os.utime(mirror.mirror_path(paths[1]), (1, 1))
+        mirror.copy(paths[2])
+
+        # f1 was read least recently
+        assert(op.exists(mirror.mirror_path(paths[0])))
+        assert(not op.exists(mirror.mirror_path(paths[1])))
+        assert(op.exists(mirror.mirror_path(paths[2])))
+
+        assert(not mirror.copy(self.make_file('big', 300)))
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    '''
+    Serves the files of the current directory with support for single
+    byte range requests and counts the requests
+    '''
+    requests = []
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+
+        if not op.isfile(path) or match is None:
+            return super().send_head()
+
+        size = op.getsize(path)
+        start, end = int(match.group(1)), min(size - 1, int(match.group(2)))
+        RangeRequestHandler.requests.append((self.path, start, end))
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start + 1)
+
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+            start, end, size))
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+        return io.BytesIO(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeReaderTest(dt.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        RangeRequestHandler.requests = []
+
+        handler = functools.partial(
+            RangeRequestHandler, directory=self.tmpdir.name)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.host = '127.0.0.1:{}'.format(self.server.server_address[1])
+        self.files = trr.RemoteFiles(
+            trr.BlockCache(1024 ** 2), block_size=100, prefetch_workers=2)
+
+    def tearDown(self):
+        self.files.wait()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def url(self, name):
+        return 'http://{}/{}'.format(self.host, name)
+
+    def test_remote_url(self):
+        with mock.patch.object(hss, 'MEDIA_ROOT', '/data/media'):
+            assert(trr.remote_url(
+                '/data/media/https/example.com/a/b.hitile..') ==
+                'https://example.com/a/b.hitile')
+            assert(trr.remote_url('/data/media/ftp/example.com/b.h5..') is None)
+            assert(trr.remote_url('/data/media/uploads/b.hitile') is None)
+
+    def test_blocks(self):
+        data = bytes(range(256)) * 4
+
+        with open(op.join(self.tmpdir.name, 'a.bin'), 'wb') as f:
+            f.write(data)
+
+        reader = trr.RangeReader(
+            self.url('a.bin'), self.files, trr.ReadAhead(0, 0))
+        assert(reader.size == len(data))
+
+        reader.seek(150)
+        assert(reader.read(300) == data[150:450])
+        # blocks 1 to 4 with one request
+        assert(RangeRequestHandler.requests[-1] == ('/a.bin', 100, 499))
+
+        num_requests = len(RangeRequestHandler.requests)
+        reader.seek(-30, io.SEEK_END)
+        assert(reader.read() == data[-30:])
+        reader.seek(120)
+        assert(reader.read(10) == data[120:130])
+        assert(len(RangeRequestHandler.requests) == num_requests + 1)
+
+        # the blocks after a read are fetched in the background
+        reader = trr.RangeReader(
+            self.url('a.bin'), self.files, trr.ReadAhead(0, 2))
+        reader.read(10)
+        self.files.wait()
+        num_requests = len(RangeRequestHandler.requests)
+        assert(reader.read(290) == data[10:300])
+        assert(len(RangeRequestHandler.requests) == num_requests)
+
+    def test_disk_blocks(self):
+        disk = hdc.DiskRDB(op.join(self.tmpdir.name, 'blocks'), 10000, shards=1)
+        trr.BlockCache(1024, disk).set('a:0', b'block')
+
+        # blocks on disk aren't prefetched again by other workers
+        cache = trr.BlockCache(1024, disk)
+        assert('a:0' in cache)
+        assert('a:1' not in cache)
+        assert(cache.get('a:0') == b'block')
+
+    def test_stats_without_range_reader(self):
+        with mock.patch.object(hss, 'REMOTE_RANGE_READER', False), \
+                mock.patch.object(trr, 'remote_files') as remote_files:
+            ret = self.client.get('/api/v1/cache_stats/')
+
+        assert(json.loads(ret.content.decode('utf-8'))['remote'] is None)
+        assert(not remote_files.called)
+
+    def test_hdf5(self):
+        values = np.arange(10000, dtype=np.float32)
+
+        with h5py.File(op.join(self.tmpdir.name, 'a.hitile'), 'w') as f:
+            f.create_dataset('values_0', data=values, chunks=(1000,))
+
+        media_root = op.join(self.tmpdir.name, 'media')
+        path = op.join(media_root, 'http', self.host, 'a.hitile..')
+
+        with mock.patch.object(hss, 'MEDIA_ROOT', media_root), \
+                mock.patch.object(hss, 'REMOTE_RANGE_READER', True), \
+                mock.patch.object(trr, '_remote_files', self.files):
+            f = tfh.open_h5(path)
+
+            assert(np.all(f['values_0'][2500:5500] == values[2500:5500]))
+            f.close()
+
+        with mock.patch.object(hss, 'MEDIA_ROOT', media_root):
+            # disabled by default
+            assert(trr.open_remote(path) is None)
+
+
+class WarmTilesTest(dt.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tileset_info = {
+            'max_width': 1000, 'min_pos': [0], 'max_pos': [600], 'max_zoom': 3}
+
+        tm.Tileset.objects.create(uuid='w', filetype='multivec', datafile='uploads/w')
+        tm.Tileset.objects.filter(uuid='w').update(
+            tileset_info=json.dumps(self.tileset_info))
+        tsr.invalidate('w')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_tile_batches(self):
+        tileset = tsr.get('w')
+        batches = list(tmcw.tile_batches(tileset, self.tileset_info, 0, 5))
+
+        assert([b[0] for b in batches] == [0, 1, 2, 3])
+        assert(batches[2][2] == ['w.2.0', 'w.2.1', 'w.2.2'])
+
+        cooler = tileset._replace(filetype='cooler')
+        tileset_info = {'max_width': 100, 'min_pos': [0, 0],
+            'max_pos': [100, 100], 'max_zoom': 1}
+        batches = list(tmcw.tile_batches(cooler, tileset_info, 1, 1))
+        assert(batches[0][2] == ['w.1.0.0.default', 'w.1.0.1.default',
+            'w.1.1.0.default', 'w.1.1.1.default'])
+
+    def test_viewconfs(self):
+        tm.ViewConf.objects.create(viewconf=json.dumps({'views': [{'tracks': {
+            'top': [{'tilesetUid': 'w'}, {'type': 'combined', 'contents': [
+                {'tilesetUid': 'x'}]}]}}]}))
+
+        assert(tmcw.viewconf_tileset_uuids() == {'w', 'x'})
+
+    def test_warm(self):
+        calls = []
+
+        def generate_tiles(tileset_tile_ids):
+            calls.extend(tileset_tile_ids[1])
+            return [(t, {'dense': np.ones(4, dtype=np.float32), 'dtype': 'float32'})
+                for t in tileset_tile_ids[1]]
+
+        rdb = hst.CountingRDB()
+        cache = hc.TieredCache(rdb, 0, tte.unpack_fragment, tte.pack_fragment)
+        state = op.join(self.tmpdir.name, 'state')
+
+        with mock.patch.object(tgt, 'generate_tiles', generate_tiles), \
+                mock.patch.object(tsv, 'tile_cache', cache), \
+                mock.patch.object(hss, 'TILESET_INFO_REVALIDATE', False):
+            dcm.call_command('warm_tiles', uuid=['w', 'missing'], max_zoom=1,
+                state=state, stdout=io.StringIO(), stderr=io.StringIO())
+            assert(sorted(calls) == ['w.0.0', 'w.1.0', 'w.1.1'])
+
+            # the finished batches are skipped
+            dcm.call_command('warm_tiles', uuid=['w'], max_zoom=2,
+                state=state, stdout=io.StringIO())
+            assert(sorted(calls) == ['w.0.0', 'w.1.0', 'w.1.1', 'w.2.0', 'w.2.1', 'w.2.2'])
+
+            # the tiles endpoint reads the warmed tiles
+            ret = self.client.get('/api/v1/tiles/?d=w.1.1&d=w.2.2')
+            assert(len(calls) == 6)
+            assert(set(json.loads(ret.content.decode('utf-8'))) == {'w.1.1', 'w.2.2'})
+
+
+class TileStoreTest(dt.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        tileset_info = {'max_width': 1000, 'max_zoom': 3}
+
+        tm.Tileset.objects.create(uuid='s', filetype='multivec', datafile='uploads/s')
+        tm.Tileset.objects.filter(uuid='s').update(
+            tileset_info=json.dumps(tileset_info))
+        tsr.invalidate('s')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_store(self):
+        calls = []
+
+        def generate_live_tiles(tileset_tile_ids):
+            calls.extend(tileset_tile_ids[1])
+            return [(t, {'dense': np.arange(4, dtype=np.float32), 'min_value': 0})
+                for t in tileset_tile_ids[1]]
+
+        assert(tts.tile_key('s.2.1') == (2, 1, -1, ''))
+        assert(tts.tile_key('s.2.1.3.default') == (2, 1, 3, 'default'))
+        assert(tts.tile_key('s.x.1') is None)
+
+        with mock.patch.object(tgt, 'generate_live_tiles', generate_live_tiles), \
+                mock.patch.object(hss, 'TILE_STORE_DIR', self.tmpdir.name), \
+                mock.patch.object(hss, 'TILESET_INFO_REVALIDATE', False):
+            dcm.call_command('build_tile_store', uuid=['s'], max_zoom=1,
+                stdout=io.StringIO())
+            assert(sorted(calls) == ['s.0.0', 's.1.0', 's.1.1'])
+            del calls[:]
+
+            tileset = tsr.get('s')
+            tiles = dict(tgt.generate_tiles((tileset, ['s.1.1', 's.2.0'], False, None)))
+
+            # only the tile that isn't stored is read from the data file
+            assert(calls == ['s.2.0'])
+            assert(np.array_equal(tiles['s.1.1']['dense'], np.arange(4)))
+            assert(tiles['s.1.1']['min_value'] == 0)
+
+            # tiles with options and stores of another version aren't used
+            tgt.generate_tiles((tileset, ['s.1.1'], False, {'a': 1}))
+            tgt.generate_tiles((tileset._replace(version='x'), ['s.1.0'], False, None))
+            assert(calls == ['s.2.0', 's.1.1', 's.1.0'])
+
+    def test_multivec_round_trip(self):
+        dense = np.arange(12, dtype=np.float32).reshape((3, 4))
+        tiles = tgt.generate_1d_tiles('s', ['s.0.0'], lambda f, p: dense, None)
+
+        with mock.patch.object(hss, 'TILE_STORE_DIR', self.tmpdir.name), \
+                mock.patch.object(hss, 'TILESET_INFO_REVALIDATE', False):
+            tileset = tsr.get('s')
+
+            writer = tts.TileStoreWriter(tileset)
+            writer.put_many(tiles)
+            writer.close()
+
+            stored = tts.get_tiles(tileset, ['s.0.0'])
+
+        # the same JSON as the tile read from the data file
+        assert(json.loads(tte.encode_fragment(stored['s.0.0'])) ==
+            json.loads(tte.encode_fragment(tiles[0][1])))
+        assert(stored['s.0.0']['shape'] == [3, 4])
+
+
+class TileRunsTest(dt.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_hitile(self):
+        path = op.join(self.tmpdir.name, 'a.hitile')
+
+        with h5py.File(path, 'w') as f:
+            meta = f.create_dataset('meta', (1,), dtype='f')
+            meta.attrs['tile-size'] = 4
+            meta.attrs['zoom-step'] = 2
+            meta.attrs['max-zoom'] = 4
+            meta.attrs['max-position'] = 50
+
+            values = np.arange(64, dtype=np.float32)
+            values[[3, 17, 18]] = np.nan
+            f.create_dataset('values_0', data=values)
+            f.create_dataset('nan_values_0', data=np.isnan(values).astype('f'))
+            f.create_dataset('values_2', data=np.arange(16, dtype=np.float32))
+            f.create_dataset('nan_values_2', data=np.zeros(16, dtype='f'))
+
+        tileset = mock.Mock(datafile=tsr.FileRef(path, path))
+        tile_ids = ['h.4.{}'.format(x) for x in [0, 1, 2, 3, 5, 12, 13, 14]] + \
+            ['h.3.{}'.format(x) for x in range(4)] + ['h.1.0', 'h.1.1']
+
+        calls = []
+        get_hitile_data = tgt.get_hitile_data
+
+        def counting_get_hitile_data(*args):
+            calls.append(args[2:])
+            return get_hitile_data(*args)
+
+        with mock.patch.object(tgt, 'get_hitile_data', counting_get_hitile_data):
+            tiles = dict(tgt.generate_hitile_tiles(tileset, tile_ids))
+
+        # one read per run of adjacent tiles
+        assert(sorted(calls) == [(1, 0, 2), (3, 0, 4), (4, 0, 4), (4, 5, 1), (4, 12, 3)])
+
+        with h5py.File(path, 'r') as f:
+            for tile_id in tile_ids:
+                z, x = map(int, tile_id.split('.')[1:])
+                expected = tte.encode_dense(tgt.hdft.get_data(f, z, x))
+
+                assert(np.array_equal(tiles[tile_id]['dense'], expected['dense'],
+                    equal_nan=True))
+
+    def test_hibed(self):
+        path = op.join(self.tmpdir.name, 'a.hibed')
+        entries = [[str(s), str(s + 3), 'e{}'.format(s)] for s in range(0, 64, 3)]
+
+        with h5py.File(path, 'w') as f:
+            meta = f.create_dataset('meta', (1,), dtype='f')
+            meta.attrs['tile-size'] = 4
+            meta.attrs['max-zoom'] = 4
+
+            for z in range(5):
+                f.create_dataset(str(z), data=np.array(entries, dtype='S'))
+
+        tileset = mock.Mock(datafile=tsr.FileRef(path, path))
+        tile_ids = ['b.4.{}'.format(x) for x in [0, 1, 2, 3, 7, 15, 16]] + ['b.2.1', 'b.2.2']
+        tiles = dict(tgt.generate_hibed_tiles(tileset, tile_ids))
+
+        with h5py.File(path, 'r') as f:
+            for tile_id in tile_ids:
+                z, x = map(int, tile_id.split('.')[1:])
+                expected = [[v.decode('utf-8') for v in d]
+                    for d in tgt.hdft.get_discrete_data(f, z, x)]
+
+                assert(tiles[tile_id]['discrete'] == expected)
+
+        # entries starting at a tile boundary are in both tiles
+        assert(tiles['b.4.2']['discrete'][-1] == ['12', '15', 'e12'])
+        assert(tiles['b.4.3']['discrete'][0] == ['12', '15', 'e12'])
+
+
+class CoolerStateTest(dt.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = op.join(self.tmpdir.name, 'a.mcool')
+        base_path = op.join(self.tmpdir.name, 'a.cool')
+
+        # chromosomes which don't end at bin or tile boundaries
+        rng = np.random.RandomState(0)
+        chromsizes = pd.Series({'chr1': 12345, 'chr2': 8001})
+        bins = cooler.binnify(chromsizes, 100)
+
+        bin1 = rng.randint(0, len(bins), 3000)
+        bin2 = rng.randint(0, len(bins), 3000)
+        pixels = pd.DataFrame({
+            'bin1_id': np.minimum(bin1, bin2),
+            'bin2_id': np.maximum(bin1, bin2),
+            'count': rng.randint(1, 10, len(bin1)),
+        }).groupby(['bin1_id', 'bin2_id'], as_index=False).sum()
+
+        cooler.create_cooler(base_path, bins, pixels)
+        cooler.zoomify_cooler(base_path, self.path, [100, 200, 400], 10 ** 6)
+
+        # weights with missing bins
+        with h5py.File(self.path, 'r+') as f:
+            for group in f['resolutions'].values():
+                weights = rng.uniform(0.5, 2, len(group['bins/start']))
+                weights[::7] = np.nan
+                group['bins'].create_dataset('weight', data=weights)
+
+    def tearDown(self):
+        tfh.pool.close(self.path)
+        self.tmpdir.cleanup()
+
+    def test_fetch_pixels(self):
+        with tfh.borrow(self.path):
+            state = tco.get_state(self.path, 'resolutions/100')
+
+            # cached per handle
+            assert(tco.get_state(self.path, '/resolutions/100/') is state)
+
+            windows = [(0, 10, 0, 10), (5, 90, 40, 200), (150, 300, 0, 300),
+                (60, 80, 0, 50), (210, 210, 0, 10), (0, 10, 0, 10)]
+
+            for i0, i1, j0, j1 in windows:
+                expected = state.cooler.matrix(
+                    as_pixels=True, balance=False)[i0:i1, j0:j1]
+                bin1, bin2, counts = tco.fetch_pixels(state, i0, i1, j0, j1)
+
+                assert(np.array_equal(bin1, expected['bin1_id'].values))
+                assert(np.array_equal(bin2, expected['bin2_id'].values))
+                assert(np.array_equal(counts, expected['count'].values))
+
+            # overlapping windows read together, in one span or in spans
+            # of at most 100 pixels
+            for max_span_pixels in [tco.MAX_SPAN_PIXELS, 100]:
+                pixels = tco.fetch_pixels_many(
+                    state, windows, max_span_pixels=max_span_pixels)
+
+                for window, window_pixels in zip(windows, pixels):
+                    expected = tco.fetch_pixels(state, *window)
+
+                    for values, expected_values in zip(window_pixels, expected):
+                        assert(np.array_equal(values, expected_values))
+
+    def test_make_tiles(self):
+        with h5py.File(self.path, 'r') as f:
+            for resolution in [100, 200, 400]:
+                group = f['resolutions/{}'.format(resolution)]
+                state = tco.load(group)
+
+                for transform_type in ['default', 'weight', 'none']:
+                    # including rectangles past the end of the genome
+                    for x, y, width, height in [
+                            (0, 0, 1, 1), (0, 1, 1, 1), (1, 0, 2, 2), (3, 3, 1, 1)]:
+                        expected = hgco.make_tiles(group, resolution, x, y,
+                            transform_type, width, height)
+                        tiles = tco.make_tiles(state, x, y, transform_type,
+                            width, height)
+
+                        assert(tiles.keys() == expected.keys())
+                        for position, data in expected.items():
+                            assert(np.array_equal(tiles[position], data,
+                                equal_nan=True))
+
+    def test_generate_cooler_tiles(self):
+        tileset = mock.Mock(datafile=tsr.FileRef(self.path, self.path))
+        tile_ids = ['c.2.0.0', 'c.2.0.1', 'c.2.1.1', 'c.1.0.0.none',
+            'c.2.1.0.KR', 'c.0.0.0']
+
+        tiles = dict(tgt.generate_cooler_tiles(tileset, tile_ids))
+
+        # the same tiles when all of them are read by clodius
+        with mock.patch.object(tco, 'can_make_tiles', return_value=False):
+            expected = dict(tgt.generate_cooler_tiles(tileset, tile_ids))
+
+        assert(tiles.keys() == set(tile_ids))
+        assert(tiles.keys() == expected.keys())
+        for tile_id in expected:
+            assert(tiles[tile_id] == expected[tile_id])
+
+
+class ResolverTest(dt.TestCase):
+    def setUp(self):
+        tsr.invalidate()
+
+        self.user = dcam.User.objects.create_user(
+            username='user1', password='pass')
+        tm.Tileset.objects.create(uuid='a', filetype='hitile',
+            datafile='uploads/a.hitile', coordSystem='hg19')
+        tm.Tileset.objects.create(uuid='b', filetype='bam',
+            datafile='uploads/b.bam', indexfile='uploads/b.bai',
+            private=True, owner=self.user)
+
+    def test_resolve(self):
+        with self.assertNumQueries(1):
+            records = tsr.resolve(['a', 'b', 'c'])
+
+        assert(set(records.keys()) == {'a', 'b'})
+        assert(records['a'].datafile.path == op.join(hss.MEDIA_ROOT, 'uploads/a.hitile'))
+        assert(str(records['b'].indexfile) == 'uploads/b.bai')
+        assert(not records['a'].indexfile)
+
+        with self.assertNumQueries(0):
+            assert(tsr.get('a') is records['a'])
+
+        user = dcam.User.objects.create_user(username='user2', password='pass')
+        assert(records['a'].readable_by(dcam.AnonymousUser()))
+        assert(not records['b'].readable_by(dcam.AnonymousUser()))
+        assert(not records['b'].readable_by(user))
+        assert(records['b'].readable_by(self.user))
+
+    def test_invalidation(self):
+        assert(tsr.get('a').filetype == 'hitile')
+
+        tileset = tm.Tileset.objects.get(uuid='a')
+        tileset.filetype = 'hibed'
+        tileset.save()
+        assert(tsr.get('a').filetype == 'hibed')
+
+        tileset.delete()
+        assert(tsr.get('a') is None)
+
+    def test_invalidation_in_other_workers(self):
+        rdb = hst.CountingRDB()
+
+        with mock.patch.object(tsr.hu, 'getRdb', return_value=rdb), \
+                mock.patch.object(hss, 'TILESET_RESOLVER_CHECK_INTERVAL', 0):
+            assert(tsr.get('b').private)
+            record = tsr.get('a')
+
+            # made public by another worker, which publishes a new generation
+            tm.Tileset.objects.filter(uuid='b').update(private=False)
+            assert(tsr.get('b').private)
+            tsr.publish_generations(['b'])
+
+            with self.assertNumQueries(1):
+                records = tsr.resolve(['a', 'b'])
+
+            assert(not records['b'].private)
+            assert(records['a'] is record)
+
+            # deleted through this worker
+            tm.Tileset.objects.get(uuid='a').delete()
+            assert(tsr.GENERATION_PREFIX + 'a' in rdb.data)
+            assert(tsr.get('a') is None)
+
+        # generations are only checked every TILESET_RESOLVER_CHECK_INTERVAL
+        round_trips = rdb.round_trips
+
+        with mock.patch.object(tsr.hu, 'getRdb', return_value=rdb):
+            tsr.get('b')
+
+        assert(rdb.round_trips == round_trips)
+
+    def test_tiles(self):
+        def generate_tiles(tileset_tile_ids):
+            return [(t, {'uuid': tileset_tile_ids[0].uuid})
+                for t in tileset_tile_ids[1]]
+
+        with mock.patch.object(tgt, 'generate_tiles', generate_tiles):
+            with self.assertNumQueries(1):
+                ret = self.client.get('/api/v1/tiles/?d=a.0.0&d=b.0.0&d=c.0.0')
+
+            content = json.loads(ret.content.decode('utf-8'))
+            assert(content['a.0.0'] == {'uuid': 'a'})
+            assert('b.0.0' not in content)
+            assert('error' in content['c.0.0'])
+
+            with self.assertNumQueries(0):
+                self.client.get('/api/v1/tiles/?d=a.0.1&d=b.0.1')
+
+            self.client.login(username='user1', password='pass')
+            ret = self.client.get('/api/v1/tiles/?d=b.0.2')
+            content = json.loads(ret.content.decode('utf-8'))
+            assert(content['b.0.2'] == {'uuid': 'b'})
+
+
+    def test_versions(self):
+        def create():
+            return tm.Tileset.objects.create(uuid='v', filetype='bedfile',
+                datafile=dcfu.SimpleUploadedFile('version.bed', b'chr1\t0\t1\n'))
+
+        tileset = create()
+        version = tsr.get('v').version
+
+        assert(tsr.get('a').version != version)
+        assert(tsv.tile_cache_key(tsr.get('v'), 'v.0.0') == 'v.0.0@' + version)
+
+        try:
+            # modified in place, picked up once the record is reloaded
+            with open(tileset.datafile.path, 'ab') as f:
+                f.write(b'chr1\t1\t2\n')
+            assert(tsr.get('v').version == version)
+            tsr.invalidate('v')
+            assert(tsr.get('v').version != version)
+            version = tsr.get('v').version
+
+            # re-created under the same uuid
+            os.remove(tileset.datafile.path)
+            tileset.delete()
+            tileset = create()
+            assert(tsr.get('v').version != version)
+        finally:
+            os.remove(tileset.datafile.path)
+
+
+class TilesetInfoMaterializationTest(dt.TestCase):
+    def setUp(self):
+        tsr.invalidate()
+
+        self.tileset = tm.Tileset.objects.create(
+            datafile=dcfu.SimpleUploadedFile(
+                'materialize.chrom.sizes', b'chr1\t100\nchr2\t50\n'),
+            filetype='chromsizes-tsv',
+            datatype='chromsizes',
+            coordSystem='materialize',
+            uuid='cs')
+
+    def tearDown(self):
+        os.remove(self.tileset.datafile.path)
+
+    def stored_info(self):
+        return tm.Tileset.objects.get(uuid='cs').tileset_info
+
+    def get_info(self):
+        ret = self.client.get('/api/v1/tileset_info/?d=cs')
+        return json.loads(ret.content.decode('utf-8'))['cs']
+
+    def test_materialize(self):
+        assert(self.stored_info() is None)
+        assert(self.get_info()['chromsizes'] == [['chr1', 100], ['chr2', 50]])
+        assert(json.loads(self.stored_info())['chromsizes'][1] == ['chr2', 50])
+
+        with mock.patch.object(tgt, 'generate_tileset_info') as generate:
+            info = self.get_info()
+            assert(info['chromsizes'][0] == ['chr1', 100])
+            assert(info['coordSystem'] == 'materialize')
+            assert(not generate.called)
+
+            # the data file changed
+            mtime = op.getmtime(self.tileset.datafile.path)
+            os.utime(self.tileset.datafile.path, (mtime + 10, mtime + 10))
+            generate.return_value = {'chromsizes': []}
+            assert(self.get_info()['chromsizes'] == [])
+            assert(generate.called)
+
+        # saving the tileset drops the stored info
+        self.tileset.save()
+        assert(self.stored_info() is None)
+
+    def test_backfill(self):
+        dcm.call_command('materialize_tileset_info', uuid=['cs'])
+        assert(json.loads(self.stored_info())['chromsizes'][0] == ['chr1', 100])
+
+
+class ChromSizesRegistryTest(dt.TestCase):
+    def setUp(self):
+        tsr.invalidate()
+        tcs.registry.invalidate()
+
+        self.tilesets = [tm.Tileset.objects.create(
+            datafile=dcfu.SimpleUploadedFile(
+                'registry.chrom.sizes', b'chr1\t100\nchr2\t50\n'),
+            filetype='chromsizes-tsv',
+            datatype='chromsizes',
+            coordSystem='registry',
+            uuid='cs')]
+
+    def tearDown(self):
+        for tileset in self.tilesets:
+            os.remove(tileset.datafile.path)
+
+    def test_endpoint(self):
+        ret = self.client.get('/api/v1/chrom-sizes/?id=cs')
+        assert(ret.content == b'chr1\t100\nchr2\t50\n')
+
+        ret = self.client.get('/api/v1/chrom-sizes/?id=cs&type=json')
+        assert(json.loads(ret.content.decode('utf-8')) == {
+            'chr1': {'size': 100}, 'chr2': {'size': 50}})
+
+        ret = self.client.get('/api/v1/chrom-sizes/?id=cs&type=json&cum=1')
+        assert(json.loads(ret.content.decode('utf-8')) == {
+            'chr1': {'size': 100, 'offset': 0},
+            'chr2': {'size': 50, 'offset': 100}})
+
+        ret = self.client.get('/api/v1/chrom-sizes/?id=xx&type=json')
+        assert(ret.status_code == 404)
+
+    def test_coord_system(self):
+        tileset = tm.Tileset(coordSystem='registry')
+
+        with self.assertNumQueries(2):
+            assert(tgt.get_chromsizes(tileset) == [['chr1', 100], ['chr2', 50]])
+        with self.assertNumQueries(0):
+            chromsizes = tcs.registry.for_coord_system('registry')
+
+        assert(list(chromsizes.offsets) == [0, 100])
+        assert(tgt.get_chromsizes(tm.Tileset(coordSystem='other')) is None)
+
+        # two chromsizes tilesets for the same coordSystem are ambiguous
+        self.tilesets += [tm.Tileset.objects.create(
+            datafile=dcfu.SimpleUploadedFile('registry2.chrom.sizes', b'chr1\t1\n'),
+            filetype='chromsizes-tsv',
+            datatype='chromsizes',
+            coordSystem='registry',
+            uuid='cs2')]
+        assert(tgt.get_chromsizes(tileset) is None)
+
 
 class BamTests(dt.TestCase):
     @skip("Reinstating the tests and this one fails")
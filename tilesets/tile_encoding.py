@@ -0,0 +1,449 @@
+'''
+Serialization of generated tiles for the tiles endpoint.
+
+Tile values are dicts. Dense numeric tiles carry their data as a numpy
+array under the `dense` key until they are serialized, either to JSON
+(base64 encoded) or to the binary framed format:
+
+    magic       4 bytes   b'HGT1'
+    count       uint32    number of tiles
+
+followed by one frame per tile:
+
+    id_len      uint16    length of the tile id
+    id          bytes     utf-8 encoded tile id
+    dtype       uint8     index into DTYPES (0: no dense data)
+    ndim        uint8     number of dimensions of the dense data
+    shape       uint32 x ndim
+    meta_len    uint32    length of the JSON metadata
+    meta        bytes     utf-8 encoded JSON object with the remaining
+                          entries of the tile value (the whole tile
+                          value for tiles without dense data)
+    nbytes      uint64    length of the dense data
+    data        bytes     dense data, little-endian, C order
+
+All integers are little-endian.
+
+The tiles endpoint caches every tile as its serialized fragment in the
+requested format (`encode_fragment`): the JSON value of the tile or its
+binary frame without the tile id. Responses are assembled from the
+fragments with `splice_json` and `splice_binary` without decoding them.
+Fragments are stored in the cache with a one byte header telling whether
+they are compressed (see `pack_fragment`).
+'''
+import json
+import pybase64
+import struct
+import zlib
+
+import higlass_server.settings as hss
+import numpy as np
+
+from rest_framework.renderers import BaseRenderer
+
+BINARY_MAGIC = b'HGT1'
+BINARY_MEDIA_TYPE = 'application/x-higlass-tiles'
+BINARY_FORMAT = 'hgtiles'
+
+DTYPES = [None, 'float16', 'float32', 'float64', 'int8', 'int16', 'int32',
+          'int64', 'uint8', 'uint16', 'uint32', 'uint64']
+
+DENSE_ENCODINGS = ('auto', 'float16-nan', 'float32')
+
+WIRE_FORMATS = ('json', BINARY_FORMAT)
+
+FRAGMENT_COMPRESSIONS = {
+    '': b'\x00',
+    'zlib': b'\x01',
+}
+
+MAX_F16 = np.finfo('float16').max
+
+
+class BinaryTilesRenderer(BaseRenderer):
+    '''
+    Lets the tiles endpoint negotiate the binary framed format, either
+    through the Accept header or through `?format=hgtiles`. The view
+    builds the response body itself.
+    '''
+    media_type = BINARY_MEDIA_TYPE
+    format = BINARY_FORMAT
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+
+def _fits_float16(lo, hi):
+    return lo > -MAX_F16 and lo < MAX_F16 and hi > -MAX_F16 and hi < MAX_F16
+
+
+def encode_dense(dense, encoding=None):
+    '''
+    Pick the dtype that dense numeric tile data is sent as and convert it.
+
+    The range and NaN checks are done with two vectorized reductions over
+    the data: NaNs propagate through min and max so a NaN result means that
+    the tile contains NaNs. The data is only copied when its dtype changes.
+
+    Parameters
+    ----------
+    dense: np.ndarray
+        The tile data
+    encoding: str or None
+        One of DENSE_ENCODINGS. Defaults to settings.TILE_DENSE_ENCODING
+
+    Returns
+    -------
+    tile_value: dict
+        A dict with the converted data under 'dense' and its dtype
+        under 'dtype'
+    '''
+    if encoding is None:
+        encoding = hss.TILE_DENSE_ENCODING
+
+    if encoding not in DENSE_ENCODINGS:
+        raise ValueError('Unknown dense tile encoding: {}'.format(encoding))
+
+    dtype = 'float32'
+
+    if encoding != 'float32':
+        flat = dense.reshape(-1)
+
+        if len(flat):
+            lo = flat.min()
+            hi = flat.max()
+        else:
+            lo = hi = 0
+
+        if not np.isnan(lo) and not np.isnan(hi):
+            if _fits_float16(lo, hi):
+                dtype = 'float16'
+        elif encoding == 'float16-nan':
+            # float16 has a NaN so only the finite values need to fit
+            finite = flat[~np.isnan(flat)]
+
+            if not len(finite) or _fits_float16(finite.min(), finite.max()):
+                dtype = 'float16'
+
+    return {
+        'dense': dense.astype(dtype, copy=False),
+        'dtype': dtype,
+    }
+
+
+def json_tile_value(tile_value):
+    '''
+    Convert a tile value to something that can be serialized to JSON,
+    i.e. base64 encode its dense data if it is still a numpy array.
+
+    Parameters
+    ----------
+    tile_value: dict
+        The tile value as returned by `generate_tiles`
+
+    Returns
+    -------
+    tile_value: dict
+        The tile value with `dense` as a base64 string
+    '''
+    if not isinstance(tile_value, dict):
+        return tile_value
+
+    dense = tile_value.get('dense')
+
+    if not isinstance(dense, np.ndarray):
+        return tile_value
+
+    tile_value = dict(tile_value)
+    tile_value['dense'] = pybase64.b64encode(
+        np.ascontiguousarray(dense)).decode('utf-8')
+
+    return tile_value
+
+
+def _dense_array(tile_value):
+    '''
+    Get the dense data of a tile as a little-endian numpy array, or None
+    if the tile has no dense data.
+    '''
+    dense = tile_value.get('dense')
+
+    if isinstance(dense, str):
+        # tiles from readers which return base64 encoded data already,
+        # other base64 data (e.g. the images of imtiles tiles) is left
+        # in the metadata
+        dtype = tile_value.get('dtype')
+
+        if dtype not in DTYPES[1:]:
+            return None
+
+        dense = np.frombuffer(pybase64.b64decode(dense), dtype=dtype)
+
+        if 'shape' in tile_value:
+            dense = dense.reshape(tile_value['shape'])
+
+    if not isinstance(dense, np.ndarray) or dense.dtype.name not in DTYPES:
+        return None
+
+    return dense.astype(dense.dtype.newbyteorder('<'), copy=False)
+
+
+def encode_binary_body(tile_value):
+    '''
+    Encode a single tile as a frame of the binary format without the
+    leading tile id
+
+    Parameters
+    ----------
+    tile_value: dict
+        The tile value as returned by `generate_tiles`
+
+    Returns
+    -------
+    body: bytes
+        The encoded frame starting with the dtype
+    '''
+    dense = _dense_array(tile_value) if isinstance(tile_value, dict) else None
+
+    if dense is None:
+        meta = tile_value
+        header = struct.pack('<BB', 0, 0)
+        data = b''
+        nbytes = 0
+    else:
+        # the shape stays in the metadata, clients of the JSON format
+        # read it from there
+        meta = {k: v for k, v in tile_value.items()
+                if k not in ('dense', 'dtype')}
+        header = (
+            struct.pack('<BB', DTYPES.index(dense.dtype.name), dense.ndim) +
+            struct.pack('<{}I'.format(dense.ndim), *dense.shape)
+        )
+        data = np.ascontiguousarray(dense).data
+        nbytes = dense.nbytes
+
+    meta_bytes = json.dumps(meta).encode('utf-8') if meta else b''
+
+    return b''.join([
+        header,
+        struct.pack('<I', len(meta_bytes)), meta_bytes,
+        struct.pack('<Q', nbytes), data
+    ])
+
+
+def encode_binary_tile(tile_id, tile_value):
+    '''
+    Encode a single tile as a frame of the binary format
+
+    Parameters
+    ----------
+    tile_id: str
+        The id of the tile (e.g. xyz.0.0)
+    tile_value: dict
+        The tile value as returned by `generate_tiles`
+
+    Returns
+    -------
+    frame: bytes
+        The encoded frame
+    '''
+    id_bytes = tile_id.encode('utf-8')
+
+    return b''.join([
+        struct.pack('<H', len(id_bytes)), id_bytes,
+        encode_binary_body(tile_value)
+    ])
+
+
+def encode_binary(tiles):
+    '''
+    Encode a number of tiles in the binary framed format
+
+    Parameters
+    ----------
+    tiles: [(tile_id, tile_value),...]
+        The tiles to encode
+
+    Returns
+    -------
+    data: bytes
+        The encoded tiles
+    '''
+    return splice_binary(
+        (tile_id, encode_binary_body(tile_value))
+        for tile_id, tile_value in tiles
+    )
+
+
+def encode_fragment(tile_value, wire_format='json'):
+    '''
+    Serialize a single tile value to the fragment which is cached and
+    spliced into responses
+
+    Parameters
+    ----------
+    tile_value: dict
+        The tile value as returned by `generate_tiles`
+    wire_format: str
+        One of WIRE_FORMATS
+
+    Returns
+    -------
+    fragment: bytes
+        The JSON encoded tile value or its binary frame without the id
+    '''
+    if wire_format == BINARY_FORMAT:
+        return encode_binary_body(tile_value)
+
+    return json.dumps(json_tile_value(tile_value)).encode('utf-8')
+
+
+def splice_json(fragments):
+    '''
+    Assemble a JSON object from tile ids and JSON fragments
+
+    Parameters
+    ----------
+    fragments: [(tile_id, bytes),...]
+        The tile ids and their `encode_fragment(..., 'json')` fragments
+
+    Returns
+    -------
+    data: bytes
+        The JSON object mapping the tile ids to the tile values
+    '''
+    return b'{' + b','.join(
+        json.dumps(tile_id).encode('utf-8') + b':' + fragment
+        for tile_id, fragment in fragments
+    ) + b'}'
+
+
+def splice_binary(fragments):
+    '''
+    Assemble a binary response from tile ids and binary fragments
+
+    Parameters
+    ----------
+    fragments: [(tile_id, bytes),...]
+        The tile ids and their `encode_binary_body` fragments
+
+    Returns
+    -------
+    data: bytes
+        The encoded tiles
+    '''
+    frames = []
+
+    for tile_id, fragment in fragments:
+        id_bytes = tile_id.encode('utf-8')
+        frames += [struct.pack('<H', len(id_bytes)), id_bytes, fragment]
+
+    return b''.join(
+        [BINARY_MAGIC, struct.pack('<I', len(frames) // 3)] + frames
+    )
+
+
+def pack_fragment(fragment, compression=None):
+    '''
+    Prepare a fragment for the shared cache, compressing it according to
+    settings.TILE_CACHE_COMPRESSION unless a compression is given
+    '''
+    if compression is None:
+        compression = hss.TILE_CACHE_COMPRESSION
+
+    if compression == 'zlib':
+        fragment = zlib.compress(fragment, hss.TILE_CACHE_COMPRESSION_LEVEL)
+
+    return FRAGMENT_COMPRESSIONS[compression] + fragment
+
+
+def unpack_fragment(packed):
+    '''
+    Get a fragment back from what `pack_fragment` stored. Returns None if
+    the value wasn't stored by `pack_fragment` (e.g. by an older version)
+    '''
+    header = packed[:1]
+
+    try:
+        if header == FRAGMENT_COMPRESSIONS['']:
+            return packed[1:]
+        if header == FRAGMENT_COMPRESSIONS['zlib']:
+            return zlib.decompress(packed[1:])
+    except zlib.error:
+        pass
+
+    return None
+
+
+def decode_binary_body(data, pos=0):
+    '''
+    Decode a frame encoded with `encode_binary_body`
+
+    Parameters
+    ----------
+    data: bytes
+        The data holding the frame
+    pos: int
+        The position of the frame in data
+
+    Returns
+    -------
+    tile_value: dict
+        The tile value with its dense data as a numpy array
+    end: int
+        The position after the frame
+    '''
+    view = memoryview(data)
+
+    dtype_idx, ndim = struct.unpack_from('<BB', data, pos)
+    shape = struct.unpack_from('<{}I'.format(ndim), data, pos + 2)
+    pos += 2 + 4 * ndim
+
+    (meta_len,) = struct.unpack_from('<I', data, pos)
+    meta = bytes(view[pos + 4:pos + 4 + meta_len])
+    pos += 4 + meta_len
+
+    (nbytes,) = struct.unpack_from('<Q', data, pos)
+    pos += 8
+
+    tile_value = json.loads(meta.decode('utf-8')) if meta_len else {}
+
+    if dtype_idx > 0:
+        dtype = np.dtype(DTYPES[dtype_idx]).newbyteorder('<')
+        tile_value['dense'] = np.frombuffer(
+            view[pos:pos + nbytes], dtype=dtype).reshape(shape)
+        tile_value['dtype'] = DTYPES[dtype_idx]
+
+    return tile_value, pos + nbytes
+
+
+def decode_binary(data):
+    '''
+    Decode tiles encoded with `encode_binary`
+
+    Parameters
+    ----------
+    data: bytes
+        The encoded tiles
+
+    Returns
+    -------
+    tiles: {tile_id: tile_value}
+        The tile values with their dense data as numpy arrays
+    '''
+    if data[:4] != BINARY_MAGIC:
+        raise ValueError('Not a binary tile response')
+
+    view = memoryview(data)
+    (count,) = struct.unpack_from('<I', data, 4)
+    pos = 8
+    tiles = {}
+
+    for _ in range(count):
+        (id_len,) = struct.unpack_from('<H', data, pos)
+        tile_id = bytes(view[pos + 2:pos + 2 + id_len]).decode('utf-8')
+        tiles[tile_id], pos = decode_binary_body(data, pos + 2 + id_len)
+
+    return tiles
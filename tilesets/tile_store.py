@@ -0,0 +1,217 @@
+'''
+Materialized tile stores for tilesets which don't change.
+
+A tile store is a SQLite file per tileset in TILE_STORE_DIR holding its
+tiles as binary frames (see `tte.encode_binary_body`) keyed by zoom, x, y
+(-1 for 1D tiles) and transform ('' if there is none). It's built with
+`manage.py build_tile_store` and records the version of the tileset it
+was built from (see `tsr.version_token`). `generate_tiles` serves tiles
+from the store while the version matches and reads the tiles that the
+store doesn't hold (e.g. deeper zoom levels or tiles with options) from
+the data file.
+
+Stores are written to a temporary file which is renamed into place, and
+workers open the new file instead of their pooled connection to the old
+one as soon as its modification time changes.
+'''
+import logging
+import os
+import os.path as op
+import sqlite3
+import time
+
+import higlass_server.settings as hss
+import tilesets.file_handles as fh
+import tilesets.tile_encoding as tte
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tiles (
+    zoom INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    transform TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    PRIMARY KEY (zoom, x, y, transform)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS metadata (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+PARTIAL_SUFFIX = '.partial'
+
+
+def store_path(uuid):
+    '''
+    The path of the tile store of a tileset
+    '''
+    return op.join(hss.TILE_STORE_DIR, '{}.tiles.sqlite'.format(uuid))
+
+
+def tile_key(tile_id):
+    '''
+    The (zoom, x, y, transform) key of a tile id like uuid.2.1 or
+    uuid.2.1.0.default in a store, or None if it doesn't have that form
+    '''
+    parts = tile_id.split('.')[1:]
+
+    try:
+        zoom, x = int(parts[0]), int(parts[1])
+        y = int(parts[2]) if len(parts) > 2 else -1
+    except (IndexError, ValueError):
+        return None
+
+    if len(parts) > 4:
+        return None
+
+    return (zoom, x, y, parts[3] if len(parts) > 3 else '')
+
+
+class TileStoreWriter(object):
+    '''
+    Writes the tile store of a tileset. The store replaces the previous
+    one when the writer is closed.
+
+    Parameters
+    ----------
+    tileset: tilesets.resolver.TilesetRecord
+        The tileset the tiles belong to
+    path: str or None
+        Where to write the store, `store_path(tileset.uuid)` by default
+    '''
+    def __init__(self, tileset, path=None):
+        self.path = path or store_path(tileset.uuid)
+        self.partial_path = self.path + PARTIAL_SUFFIX
+        self.num_tiles = 0
+
+        os.makedirs(op.dirname(self.path) or '.', exist_ok=True)
+
+        if op.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+        self.conn = sqlite3.connect(self.partial_path)
+        self.conn.executescript(SCHEMA)
+        self.conn.executemany(
+            'INSERT INTO metadata (name, value) VALUES (?, ?)', [
+                ('uuid', tileset.uuid),
+                ('filetype', tileset.filetype),
+                ('version', tileset.version),
+                ('created', str(time.time())),
+            ])
+
+    def put_many(self, tiles):
+        '''
+        Store tiles as returned by `generate_tiles`. Tiles with errors
+        and tile ids without a store key are skipped.
+
+        Returns
+        -------
+        num_stored: int
+            The number of tiles that were stored
+        '''
+        rows = []
+
+        for tile_id, tile_value in tiles:
+            key = tile_key(tile_id)
+
+            if key is None or (
+                    isinstance(tile_value, dict) and 'error' in tile_value):
+                continue
+
+            rows.append(key + (tte.encode_binary_body(tile_value),))
+
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO tiles (zoom, x, y, transform, payload) '
+            'VALUES (?, ?, ?, ?, ?)', rows)
+        self.num_tiles += len(rows)
+
+        return len(rows)
+
+    def close(self):
+        self.conn.execute(
+            'INSERT INTO metadata (name, value) VALUES (?, ?)',
+            ('num_tiles', str(self.num_tiles)))
+        self.conn.commit()
+        self.conn.close()
+
+        os.replace(self.partial_path, self.path)
+
+    def abort(self):
+        self.conn.close()
+        os.remove(self.partial_path)
+
+
+def _metadata(conn):
+    return dict(conn.execute('SELECT name, value FROM metadata'))
+
+
+def get_tiles(tileset, tile_ids):
+    '''
+    Get the tiles of a tileset which are in its tile store
+
+    Parameters
+    ----------
+    tileset: tilesets.resolver.TilesetRecord
+        The tileset
+    tile_ids: [str,...]
+        The ids of the tiles
+
+    Returns
+    -------
+    tiles: {tile_id: tile_value}
+        The tiles found in the store, none if there is no store or it
+        was built from another version of the tileset
+    '''
+    version = getattr(tileset, 'version', None)
+
+    if not hss.TILE_STORE_DIR or version is None:
+        return {}
+
+    path = store_path(tileset.uuid)
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+
+    # a rebuilt store is opened again
+    kind = 'tile-store.{}'.format(stat.st_mtime_ns)
+    tiles = {}
+
+    try:
+        metadata = fh.state(path, 'metadata', _metadata, kind, fh.open_sqlite)
+
+        if metadata.get('version') != version:
+            return {}
+
+        with fh.borrow(path, kind, fh.open_sqlite) as conn:
+            for tile_id in tile_ids:
+                key = tile_key(tile_id)
+
+                if key is None:
+                    continue
+
+                row = conn.execute(
+                    'SELECT payload FROM tiles WHERE zoom = ? AND x = ? AND '
+                    'y = ? AND transform = ?', key).fetchone()
+
+                if row is not None:
+                    tiles[tile_id], _ = tte.decode_binary_body(row[0])
+    except sqlite3.Error as ex:
+        logger.warning('Error reading the tile store %s: %s', path, ex)
+        return {}
+
+    return tiles
+
+
+def remove(uuid):
+    '''
+    Delete the tile store of a tileset if there is one
+    '''
+    try:
+        os.remove(store_path(uuid))
+    except OSError:
+        pass
@@ -19,6 +19,7 @@ urlpatterns = [
     url(r'^uids_by_filename', views.uids_by_filename),
     url(r'^tiles/$', views.tiles),
     url(r'^tileset_info/$', views.tileset_info),
+    url(r'^cache_stats/$', views.cache_stats),
     url(r'^suggest/$', views.suggest),
     url(r'^', include(router.urls)),
     url(r'^link_tile/$', views.link_tile),
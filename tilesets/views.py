@@ -2,13 +2,8 @@
 from __future__ import print_function
 
 import csv
-import h5py
 import json
 import logging
-import math
-
-import clodius.db_tiles as cdt
-import clodius.hdf_tiles as hdft
 
 import collections as col
 
@@ -20,25 +15,22 @@ import django.http as dh
 import guardian.utils as gu
 
 import higlass_server.settings as hss
-import itertools as it
 
 import tilesets.chromsizes as tcs
+import tilesets.file_handles as tfh
 import tilesets.generate_tiles as tgt
 import tilesets.json_schemas as tjs
+import tilesets.mirror as tmi
+import tilesets.range_reader as trr
+import tilesets.tile_encoding as tte
+import tilesets.tile_store as tts
 
-import clodius.tiles.bam as ctb
 import clodius.tiles.cooler as hgco
-import clodius.tiles.bigwig as hgbi
-import clodius.tiles.fasta as hgfa
-import clodius.tiles.bigbed as hgbb
-import clodius.tiles.multivec as hgmu
-import clodius.tiles.time_interval as hgti
-import clodius.tiles.geo as hggo
-import clodius.tiles.imtiles as hgim
 
 import tilesets.chromsizes as tcs
 import tilesets.models as tm
 import tilesets.permissions as tsp
+import tilesets.resolver as tsr
 import tilesets.serializers as tss
 import tilesets.suggestions as tsu
 
@@ -52,16 +44,10 @@ import rest_framework.parsers as rfp
 import rest_framework.status as rfs
 
 import slugid
-import urllib
 import hashlib
 from jsonschema import validate as json_validate
 from jsonschema.exceptions import ValidationError as JsonValidationError
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.models import User
 from django.http import JsonResponse, HttpResponse
@@ -69,15 +55,36 @@ from django.utils.decorators import method_decorator
 from django.views.decorators.gzip import gzip_page
 from rest_framework import generics
 from rest_framework import viewsets
-from rest_framework.decorators import api_view, authentication_classes
+from rest_framework.decorators import api_view, authentication_classes, renderer_classes
 from rest_framework.authentication import BasicAuthentication
+from rest_framework.renderers import JSONRenderer
 from fragments.drf_disable_csrf import CsrfExemptSessionAuthentication
 
+from higlass_server.cache import SingleFlight, TieredCache, TileCachePolicy
 from higlass_server.utils import getRdb
 
 logger = logging.getLogger(__name__)
 
 rdb = getRdb()
+tile_cache = TieredCache(
+    rdb,
+    hss.TILE_CACHE_LOCAL_MAX_BYTES,
+    tte.unpack_fragment,
+    tte.pack_fragment,
+    channel=hss.TILE_CACHE_INVALIDATION_CHANNEL
+)
+tile_cache_policy = TileCachePolicy(
+    default_ttl=hss.TILE_CACHE_TTL,
+    ttls=hss.TILE_CACHE_TTLS,
+    min_cost=hss.TILE_CACHE_MIN_COST,
+    max_entry_bytes=hss.TILE_CACHE_MAX_ENTRY_BYTES,
+    derived_min_cost=hss.TILE_CACHE_DERIVED_MIN_COST
+)
+tile_flight = SingleFlight(
+    rdb,
+    lease_ttl=hss.GENERATION_LEASE_TTL,
+    wait_timeout=hss.GENERATION_WAIT_TIMEOUT
+)
 
 
 class UserList(generics.ListAPIView):
@@ -176,10 +183,9 @@ def sizes(request):
         )
 
     # Try to find the db entry
-    try:
-        chrom_sizes = tm.Tileset.objects.get(uuid=uuid)
-    except Exception as e:
-        logger.exception(e)
+    chrom_sizes = tsr.get(uuid)
+
+    if chrom_sizes is None:
         err_msg = 'Oh lord! ChromSizes for %s not found. 😬' % uuid
         err_status = 404
 
@@ -188,24 +194,10 @@ def sizes(request):
 
         return response(err_msg, status=err_status)
 
-    # Try to load the chromosome sizes and return them as a list of
-    # (name, size) tuples
+    # Load the chromosome sizes, the payloads are rendered once per
+    # tileset and kept by the registry
     try:
-        if tgt.get_tileset_filetype(chrom_sizes) == 'bigwig':
-            data = hgbi.chromsizes(chrom_sizes.datafile.path)
-        elif tgt.get_tileset_filetype(chrom_sizes) == 'fasta':
-            data = hgfa.chromsizes(chrom_sizes.datafile.path)
-        elif tgt.get_tileset_filetype(chrom_sizes) == 'bigbed':
-            data = hgbb.chromsizes(chrom_sizes.datafile.path)
-        elif tgt.get_tileset_filetype(chrom_sizes) == 'cooler':
-            data = tcs.get_cooler_chromsizes(chrom_sizes.datafile.path)
-        elif tgt.get_tileset_filetype(chrom_sizes) == 'chromsizes-tsv':
-            data = tcs.get_tsv_chromsizes(chrom_sizes.datafile.path)
-        elif tgt.get_tileset_filetype(chrom_sizes) == 'multivec':
-            data = tcs.get_multivec_chromsizes(chrom_sizes.datafile.path)
-        else:
-            data = '';
-
+        data = tcs.registry.for_tileset(chrom_sizes)
     except Exception as ex:
         logger.exception(ex)
         err_msg = str(ex)
@@ -216,52 +208,13 @@ def sizes(request):
 
         return response(err_msg, status=err_status)
 
-    # Convert the stuff if needed
-    try:
-        # data should be a list of (name, size) tuples coming
-        # coming and converted to a more appropriate data type
-        # going out
-        if res_type == 'tsv':
-            lines = []
-            for (name, size) in data:
-                lines += ["{}\t{}\n".format(name, size)]
-                data = lines
-
-        if res_type == 'json' and not incl_cum:
-            json_out = {}
-
-            for row in data:
-                json_out[row[0]] = {
-                    'size': int(row[1])
-                }
-
-            data = json_out
-
-        if res_type == 'json' and incl_cum:
-            json_out = {}
-            cum = 0
-
-            for row in data:
-                size = int(row[1])
-
-                json_out[row[0]] = {
-                    'size': size,
-                    'offset': cum
-                }
-                cum += size
-
-            data = json_out
-    except Exception as e:
-        logger.exception(e)
-        err_msg = 'THIS IS AN OUTRAGE!!!1! Something failed. 😡'
-        err_status = 500
+    if res_type == 'json' and incl_cum:
+        return HttpResponse(data.cum_json, content_type='application/json')
 
-        if is_json:
-            return response({'error': err_msg}, status=err_status)
-
-        return response(err_msg, status=err_status)
+    if res_type == 'json':
+        return HttpResponse(data.json, content_type='application/json')
 
-    return response(data)
+    return HttpResponse(data.tsv)
 
 @api_view(['GET'])
 def suggest(request):
@@ -272,9 +225,9 @@ def suggest(request):
     tileset_uuid = request.GET['d']
     text = request.GET['ac']
 
-    try:
-        tileset = tm.Tileset.objects.get(uuid=tileset_uuid)
-    except ObjectDoesNotExist:
+    tileset = tsr.get(tileset_uuid)
+
+    if tileset is None:
         raise rfe.NotFound('Suggestion source file not found')
 
     result_dict = tsu.get_gene_suggestions(
@@ -383,7 +336,99 @@ def add_transform_type(tile_id):
     return new_tile_id
 
 
+def tile_cache_key(tileset, tile_id, options_hash='', wire_format='json'):
+    '''
+    The key under which the serialized fragment of a tile is cached. It
+    starts with the tile id so that all the tiles of a tileset share the
+    prefix '<uuid>.' and contains the version of the tileset so that the
+    entries of a tileset which was replaced or modified are never served
+    again.
+
+    Parameters
+    ----------
+    tileset: tilesets.resolver.TilesetRecord
+        The tileset the tile belongs to
+    tile_id: str
+        The id of the tile (e.g. 'uuid.2.1.0')
+    options_hash: str
+        The hash of the options passed along with the tile request
+    wire_format: str
+        The format the tile is serialized to (see tte.WIRE_FORMATS)
+
+    Returns
+    -------
+    key: str
+        The cache key
+    '''
+    key = '{}@{}{}'.format(tile_id, tileset.version, options_hash)
+
+    if wire_format != 'json':
+        key += ':' + wire_format
+
+    return key
+
+
+def tile_zoom(tile_id):
+    '''
+    The zoom level of a tile id (e.g. 2 for 'uuid.2.1.0') or None if it
+    doesn't have one
+    '''
+    try:
+        return int(tile_id.split('.')[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def generate_fragments(tilesets_tile_ids, wire_format):
+    '''
+    Generate tiles, serialize them and store them in the tile cache
+
+    Parameters
+    ----------
+    tilesets_tile_ids: [tuple,...]
+        A list of (tileset, tile_ids, raw, tileset_options) tuples as
+        passed to `tgt.generate_tiles_parallel`
+    wire_format: str
+        The format the tiles are serialized in ('json' or
+        `tte.BINARY_FORMAT`)
+
+    Returns
+    -------
+    fragments: [(tile_id, cache_key, fragment),...]
+        The serialized tiles and the keys they're cached under
+    '''
+    generation_costs = {}
+    generated_tiles = tgt.generate_tiles_parallel(
+        tilesets_tile_ids, generation_costs)
+    tilesets = dict((tti[0].uuid, tti) for tti in tilesets_tile_ids)
+
+    fragments = []
+    tiles_to_cache = []
+
+    for (tile_id, tile_value) in generated_tiles:
+        tileset, _, _, tileset_options = tilesets[
+            tgt.extract_tileset_uid(tile_id)]
+        fragment = tte.encode_fragment(tile_value, wire_format)
+
+        if tileset_options is not None:
+            cache_key = tile_cache_key(tileset, tile_id, tileset_options["options_hash"], wire_format)
+        else:
+            cache_key = tile_cache_key(tileset, tile_id, wire_format=wire_format)
+
+        fragments += [(tile_id, cache_key, fragment)]
+        # tiles with options are derived from cached tiles (see
+        # `tgt.get_base_multivec_tiles`) and only cached when expensive
+        tiles_to_cache += [(cache_key, fragment, tileset.filetype,
+            tile_zoom(tile_id), generation_costs.get(tile_id, 0),
+            tileset_options is not None)]
+
+    tile_cache.put_many(tiles_to_cache, tile_cache_policy)
+
+    return fragments
+
+
 @api_view(['GET', 'POST'])
+@renderer_classes((JSONRenderer, tte.BinaryTilesRenderer))
 def tiles(request):
     '''Retrieve a set of tiles
 
@@ -397,7 +442,10 @@ def tiles(request):
     Returns:
         django.http.JsonResponse: A JSON object containing all of the tile
             data being requested. The JSON object is just a dictionary of
-            (tile_id, tile_data) items.
+            (tile_id, tile_data) items. If the binary format is requested
+            (`Accept: application/x-higlass-tiles` or `?format=hgtiles`)
+            the tiles are returned in the framed format described in
+            `tilesets.tile_encoding` instead.
 
     '''
     tileids_to_fetch = set()
@@ -445,33 +493,36 @@ def tiles(request):
             'error': "Too many tiles were requested.",
         }, status=rfs.HTTP_400_BAD_REQUEST)
     
-    # with ProcessPoolExecutor() as executor:
-    #       res = executor.map(parallelize, hargs)
-    '''
-    p = mp.Pool(4)
-    res = p.map(parallelize, hargs)
-    '''
-
     # Return the raw data if only one tile is requested. This currently only
     # works for `imtiles`
     raw = request.GET.get('raw', False)
 
+    if request.accepted_renderer.format == tte.BINARY_FORMAT:
+        wire_format = tte.BINARY_FORMAT
+    else:
+        wire_format = 'json'
+
     tileids_by_tileset = col.defaultdict(set)
-    generated_tiles = []
+    cached_tiles = []
 
-    tilesets = {}
     transform_id_to_original_id = {}
+    cache_keys = {}
+    missing_tiles = []
+
+    # get the metadata of all the tilesets at once
+    tilesets = tsr.resolve(set(map(tgt.extract_tileset_uid, tileids_to_fetch)))
 
     # sort tile_ids by the dataset they come from
     for tile_id in tileids_to_fetch:
         tileset_uuid = tgt.extract_tileset_uid(tile_id)
+        tileset = tilesets.get(tileset_uuid)
 
-        # get the tileset object first
-        if tileset_uuid in tilesets:
-            tileset = tilesets[tileset_uuid]
-        else:
-            tileset = tm.Tileset.objects.get(uuid=tileset_uuid)
-            tilesets[tileset_uuid] = tileset
+        if tileset is None:
+            transform_id_to_original_id[tile_id] = tile_id
+            missing_tiles += [(tile_id, {
+                'error': 'No such tileset with uid: {}'.format(tileset_uuid)
+            })]
+            continue
 
         if tileset.filetype == 'cooler':
             # cooler tiles can have a transform (e.g. 'ice', 'kr') which
@@ -482,67 +533,86 @@ def tiles(request):
         else:
             transform_id_to_original_id[tile_id] = tile_id
 
-        # see if the tile is cached
-        tile_value = None
-        try:
-            if tileset_uuid in tileset_to_options:
-                tileset_options = tileset_to_options[tileset_uuid]
-                tile_value = rdb.get(tile_id + tileset_options["options_hash"])
-            else:
-                tile_value = rdb.get(tile_id)
-        except Exception as ex:
-            # there was an error accessing the cache server
-            # log the error and carry forward fetching the tile
-            # from the original data
-            logger.warn(ex)
+        if tileset_uuid in tileset_to_options:
+            tileset_options = tileset_to_options[tileset_uuid]
+            cache_keys[tile_id] = tile_cache_key(
+                tileset, tile_id, tileset_options["options_hash"], wire_format)
+        else:
+            cache_keys[tile_id] = tile_cache_key(
+                tileset, tile_id, wire_format=wire_format)
 
-        #tile_value = None
+    # see which tiles are cached, raw tiles (images) aren't
+    if raw:
+        cached_values = [None] * len(cache_keys)
+    else:
+        cached_values = tile_cache.get_many(cache_keys.values())
+
+    for tile_id, tile_value in zip(cache_keys, cached_values):
+        tileset_uuid = tgt.extract_tileset_uid(tile_id)
+        filetype = tilesets[tileset_uuid].filetype
 
         if tile_value is not None:
             # we found the tile in the cache, no need to fetch it again
-            tile_value = pickle.loads(tile_value)
-            generated_tiles += [(tile_id, tile_value)]
+            tile_cache_policy.count(filetype, 'hits')
+            cached_tiles += [(tile_id, tile_value)]
             continue
 
+        tile_cache_policy.count(filetype, 'misses')
         tileids_by_tileset[tileset_uuid].add(tile_id)
 
     # fetch the tiles
-    tilesets = [tilesets[tu] for tu in tileids_by_tileset]
-    accessible_tilesets = [(t, tileids_by_tileset[t.uuid], raw, tileset_to_options.get(t.uuid, None)) for t in tilesets if ((not t.private) or request.user == t.owner)]
+    tilesets_to_fetch = [tilesets[tu] for tu in tileids_by_tileset]
+    accessible_tilesets = [(t, tileids_by_tileset[t.uuid], raw, tileset_to_options.get(t.uuid, None)) for t in tilesets_to_fetch if t.readable_by(request.user)]
 
-    #pool = mp.Pool(6)
+    if raw:
+        # raw tiles aren't cached
+        generated_tiles = tgt.generate_tiles_parallel(accessible_tilesets)
 
-    generated_tiles += list(it.chain(*map(tgt.generate_tiles, accessible_tilesets)))
+        if len(generated_tiles) == 1 and not missing_tiles:
+            tile_value = generated_tiles[0][1]
 
-    '''
-    for tileset_uuid in tileids_by_tileset:
-        # load the tileset object
-        tileset = tilesets[tileset_uuid]
+            if 'image' in tile_value:
+                return HttpResponse(tile_value['image'], content_type='image/jpeg')
 
-        # check permissions
-        if tileset.private and request.user != tileset.owner:
-            generated_tiles += [(tile_id, {'error': "Forbidden"}) for tile_id in tileids_by_tileset[tileset_uuid]]
-        else:
-            generated_tiles += generate_tiles(tileset, tileids_by_tileset[tileset_uuid])
-    '''
+        generated_fragments = [
+            (tile_id, tte.encode_fragment(tile_value, wire_format))
+            for tile_id, tile_value in generated_tiles
+        ]
+    else:
+        tile_ids_by_key = dict(
+            (cache_keys[tile_id], tile_id)
+            for _, tile_ids, _, _ in accessible_tilesets
+            for tile_id in tile_ids
+        )
 
-    # store the tiles in redis
+        def generate(keys):
+            keys = set(keys)
+            tilesets_tile_ids = [
+                (tileset, set(t for t in tile_ids if cache_keys[t] in keys),
+                    raw, options)
+                for tileset, tile_ids, raw, options in accessible_tilesets
+            ]
+
+            return dict(
+                (key, fragment) for _, key, fragment in generate_fragments(
+                    [tti for tti in tilesets_tile_ids if tti[1]], wire_format)
+                if key in keys
+            )
 
-    tiles_to_return = {}
+        # concurrent requests for the same tiles generate them once
+        generated_fragments = [
+            (tile_ids_by_key[key], fragment) for key, fragment in
+            tile_flight.run(tile_ids_by_key, generate, tile_cache.get_many).items()
+        ]
 
-    for (tile_id, tile_value) in generated_tiles:
-        tileset_uuid = tgt.extract_tileset_uid(tile_id)
-        try:
-            if tileset_uuid in tileset_to_options:
-                tileset_options = tileset_to_options[tileset_uuid]
-                rdb.set(tile_id + tileset_options["options_hash"], pickle.dumps(tile_value))
-            else:
-                rdb.set(tile_id, pickle.dumps(tile_value))
-        except Exception as ex:
-            # error caching a tile
-            # log the error and carry forward, this isn't critical
-            logger.warn(ex)
+    missing_fragments = [
+        (tile_id, tte.encode_fragment(tile_value, wire_format))
+        for tile_id, tile_value in missing_tiles
+    ]
 
+    tiles_to_return = {}
+
+    for (tile_id, fragment) in cached_tiles + generated_fragments + missing_fragments:
         if tile_id in transform_id_to_original_id:
             original_tile_id = transform_id_to_original_id[tile_id]
         else:
@@ -551,14 +621,42 @@ def tiles(request):
             continue
 
         if original_tile_id in tileids_to_fetch:
-            tiles_to_return[original_tile_id] = tile_value
+            tiles_to_return[original_tile_id] = fragment
 
-    if len(generated_tiles) == 1 and raw and 'image' in generated_tiles[0][1]:
+    # the cached fragments are spliced together as they are
+    if wire_format == tte.BINARY_FORMAT:
         return HttpResponse(
-            generated_tiles[0][1]['image'], content_type='image/jpeg'
+            tte.splice_binary(tiles_to_return.items()),
+            content_type=tte.BINARY_MEDIA_TYPE
         )
 
-    return JsonResponse(tiles_to_return, safe=False)
+    return HttpResponse(
+        tte.splice_json(tiles_to_return.items()),
+        content_type='application/json'
+    )
+
+
+@api_view(['GET'])
+def cache_stats(request):
+    '''
+    Get the hit / miss counters and the size of the in-process tile cache
+    of the worker serving this request, as well as its hit ratio and the
+    number of tiles admitted to and rejected from the cache by filetype,
+    the health of its connection to redis, the requests made for remote
+    data files (None if REMOTE_RANGE_READER is disabled) and how many tile
+    generations were coalesced.
+
+    Return:
+        django.http.JsonResponse: A JSON object with the statistics
+    '''
+    return JsonResponse({
+        'local': tile_cache.stats(),
+        'filetypes': tile_cache_policy.stats(),
+        'redis': rdb.health(),
+        'remote': (
+            trr.remote_files().stats() if hss.REMOTE_RANGE_READER else None),
+        'coalescing': tile_flight.stats(),
+    })
 
 
 @api_view(['GET'])
@@ -577,7 +675,6 @@ def tileset_info(request):
         django.http.JsonResponse: A JSON object containing
             the tileset meta-information
     '''
-    queryset = tm.Tileset.objects.all()
     tileset_uuids = request.GET.getlist("d")
     tileset_infos = {}
 
@@ -593,14 +690,14 @@ def tileset_info(request):
     else:
         if 'ci' in request.GET:
             try:
-                chromsizes = tm.Tileset.objects.get(uuid=request.GET['ci'])
-                data = tcs.chromsizes_array_to_series(
-                        tcs.get_tsv_chromsizes(chromsizes.datafile.path))
+                data = tcs.registry.for_tileset(tsr.get(request.GET['ci']))
             except Exception as ex:
                 pass
 
+    tileset_objects = tsr.resolve(tileset_uuids)
+
     for tileset_uuid in tileset_uuids:
-        tileset_object = queryset.filter(uuid=tileset_uuid).first()
+        tileset_object = tileset_objects.get(tileset_uuid)
 
         if tileset_uuid == 'osm-image':
             tileset_infos[tileset_uuid] = {
@@ -619,108 +716,12 @@ def tileset_info(request):
             }
             continue
 
-        if tileset_object.private and request.user != tileset_object.owner:
+        if not tileset_object.readable_by(request.user):
             # dataset is not public
             tileset_infos[tileset_uuid] = {'error': "Forbidden"}
             continue
 
-        if (
-            tileset_object.filetype == 'hitile' or
-            tileset_object.filetype == 'hibed'
-        ):
-            tileset_info = hdft.get_tileset_info(
-                h5py.File(tileset_object.datafile.path, 'r'))
-            tileset_infos[tileset_uuid] = {
-                "min_pos": [int(tileset_info['min_pos'])],
-                "max_pos": [int(tileset_info['max_pos'])],
-                "max_width": 2 ** math.ceil(
-                    math.log(
-                        tileset_info['max_pos'] - tileset_info['min_pos']
-                    ) / math.log(2)
-                ),
-                "tile_size": int(tileset_info['tile_size']),
-                "max_zoom": int(tileset_info['max_zoom'])
-            }
-        elif tileset_object.filetype == 'bigwig':
-            chromsizes = tgt.get_chromsizes(tileset_object)
-            tsinfo = hgbi.tileset_info(
-                    tileset_object.datafile.path,
-                    chromsizes
-                )
-            #print('tsinfo:', tsinfo)
-            if 'chromsizes' in tsinfo:
-                tsinfo['chromsizes'] = [(c, int(s)) for c,s in tsinfo['chromsizes']]
-            tileset_infos[tileset_uuid] = tsinfo
-        elif tileset_object.filetype == 'chromsizes-tsv':
-            chromsizes = tgt.get_chromsizes(tileset_object)
-            tileset_infos[tileset_uuid] = {
-                'chromsizes': [(c, int(s)) for c,s in chromsizes]
-            }
-        elif tileset_object.filetype == 'fasta':
-            chromsizes = tgt.get_chromsizes(tileset_object)
-            tsinfo = hgfa.tileset_info(
-                    tileset_object.datafile.path,
-                    chromsizes
-                )
-            #print('tsinfo:', tsinfo)
-            if 'chromsizes' in tsinfo:
-                tsinfo['chromsizes'] = [(c, int(s)) for c,s in tsinfo['chromsizes']]
-            tileset_infos[tileset_uuid] = tsinfo
-            tileset_infos[tileset_uuid]['max_tile_width'] = hss.MAX_FASTA_TILE_WIDTH
-        elif tileset_object.filetype == 'bigbed':
-            chromsizes = tgt.get_chromsizes(tileset_object)
-            tsinfo = hgbi.tileset_info(
-                    tileset_object.datafile.path,
-                    chromsizes
-                )
-            #print('tsinfo:', tsinfo)
-            if 'chromsizes' in tsinfo:
-                tsinfo['chromsizes'] = [(c, int(s)) for c,s in tsinfo['chromsizes']]
-            tileset_infos[tileset_uuid] = tsinfo
-        elif tileset_object.filetype == 'multivec':
-            tileset_infos[tileset_uuid] = hgmu.tileset_info(
-                    tileset_object.datafile.path)
-        elif tileset_object.filetype == "elastic_search":
-            response = urllib.urlopen(
-                tileset_object.datafile + "/tileset_info")
-            tileset_infos[tileset_uuid] = json.loads(response.read())
-        elif tileset_object.filetype == 'beddb':
-            tileset_infos[tileset_uuid] = cdt.get_tileset_info(
-                tileset_object.datafile.path
-            )
-        elif tileset_object.filetype == 'bed2ddb':
-            tileset_infos[tileset_uuid] = cdt.get_2d_tileset_info(
-                tileset_object.datafile.path
-            )
-        elif tileset_object.filetype == 'cooler':
-            tileset_infos[tileset_uuid] = hgco.tileset_info(
-                    tileset_object.datafile.path
-            )
-        elif tileset_object.filetype == 'time-interval-json':
-            tileset_infos[tileset_uuid] = hgti.tileset_info(
-                    tileset_object.datafile.path
-            )
-        elif (
-            tileset_object.filetype == '2dannodb' or
-            tileset_object.filetype == 'imtiles'
-        ):
-            tileset_infos[tileset_uuid] = hgim.get_tileset_info(
-                tileset_object.datafile.path
-            )
-        elif tileset_object.filetype == 'geodb':
-            tileset_infos[tileset_uuid] = hggo.tileset_info(
-                tileset_object.datafile.path
-            )
-        elif tileset_object.filetype == 'bam':
-            tileset_infos[tileset_uuid] = ctb.tileset_info(
-                tileset_object.datafile.path
-            )
-            tileset_infos[tileset_uuid]['max_tile_width'] = hss.MAX_BAM_TILE_WIDTH
-        else:
-            # Unknown filetype
-            tileset_infos[tileset_uuid] = {
-                'error': 'Unknown filetype ' + tileset_object.filetype
-            }
+        tileset_infos[tileset_uuid] = tgt.get_tileset_info(tileset_object)
 
         tileset_infos[tileset_uuid]['name'] = tileset_object.name
         tileset_infos[tileset_uuid]['datatype'] = tileset_object.datatype
@@ -773,6 +774,7 @@ def link_tile(request):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=422)
 
+    tgt.try_materialize_tileset_info(obj)
 
     return JsonResponse({'uuid': str(obj.uuid)}, status=201)
 
@@ -863,10 +865,15 @@ class TilesetsViewSet(viewsets.ModelViewSet):
         try:
             instance = self.get_object()
             self.perform_destroy(instance)
+            tile_cache.invalidate_prefix(uuid + '.')
+            tgt.base_tile_cache.invalidate_prefix(uuid + '.')
+            tts.remove(uuid)
             filename = instance.datafile.name
             filepath = op.join(hss.MEDIA_ROOT, filename)
             if not op.isfile(filepath):
                 return JsonResponse({'error': 'Unable to locate tileset media file for deletion: {}'.format(filepath)}, status=500)
+            tfh.pool.close(filepath)
+            tmi.remove(filepath)
             os.remove(filepath)
         except dh.Http404:
             return JsonResponse({'error': 'Unable to locate tileset instance for uuid: {}'.format(uuid)}, status=404)
@@ -978,11 +985,13 @@ class TilesetsViewSet(viewsets.ModelViewSet):
 
         if self.request.user.is_anonymous:
             # can't create a private dataset as an anonymous user
-            serializer.save(
+            tileset = serializer.save(
                 owner=gu.get_anonymous_user(),
                 private=False,
                 name=name,
                 uuid=uid
             )
         else:
-            serializer.save(owner=self.request.user, name=name, uuid=uid)
+            tileset = serializer.save(owner=self.request.user, name=name, uuid=uid)
+
+        tgt.try_materialize_tileset_info(tileset)